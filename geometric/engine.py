@@ -36,7 +36,9 @@ from __future__ import print_function, division
 import shutil
 import subprocess
 from collections import OrderedDict
-from copy import deepcopy
+from concurrent.futures import Future
+from copy import copy, deepcopy
+import pickle
 import xml.etree.ElementTree as ET
 
 import numpy as np
@@ -45,7 +47,8 @@ import os
 import json
 
 from .molecule import Molecule, format_xyz_coord
-from .nifty import bak, au2ev, eqcgmx, fqcgmx, bohr2ang, logger, getWorkQueue, queue_up_src_dest, rootdir, copy_tree_over
+from .nifty import bak, au2ev, eqcgmx, fqcgmx, bohr2ang, logger, getWorkQueue, getLocalPool, queue_up_src_dest, \
+    rootdir, copy_tree_over
 from .errors import EngineError, CheckCoordError, Psi4EngineError, QChemEngineError, TeraChemEngineError, \
     ConicalIntersectionEngineError, OpenMMEngineError, GromacsEngineError, MolproEngineError, \
     QCEngineAPIEngineError, GaussianEngineError, QUICKEngineError, CFOUREngineError, BagelEngineError
@@ -190,6 +193,10 @@ def load_tcin(f_tcin, reqxyz=True):
 #| to calculate energy and gradient |#
 #====================================#
 
+def run_calc_new(engine, coords, dirname):
+    """ Run a new single-point calculation in a worker process of the local process pool. """
+    return engine.calc_new(coords, dirname)
+
 class Engine(object):
     def __init__(self, molecule):
         if len(molecule) != 1:
@@ -255,11 +262,117 @@ class Engine(object):
                     self.copy_scratch(copydir, dirname)
                 elif not os.path.exists(dirname): os.makedirs(dirname)
                 result = self.calc_new(coords, dirname)
-            self.stored_calcs[coord_hash] = {'coords':coords, 'result':result}
+            self.store_result(coords, result)
+        return result
+
+    def submit(self, coords, dirname, read_data=False, copydir=None, pool=None, threads=None):
+        """
+        Top-level method for submitting a single-point calculation to run asynchronously.
+        If a local process pool has been created (see nifty.createLocalPool), the calculation
+        runs in a worker process; otherwise it runs immediately, as in calc().
+        The result is stored in the hash table when it is retrieved using collect().
+
+        Parameters
+        ----------
+        coords : np.array
+            1-dimensional array of shape (3*N_atoms) containing atomic coordinates in Bohr
+        dirname : str
+            Relative path containing calculation files
+        read_data : bool, default=False
+            If valid calculation output files exist in dirname, read the results instead of
+            running a new calculation
+        copydir : str, default=None
+            If provided, the contents of this folder will be copied to the scratch folder
+            prior to starting a calculation
+        pool : concurrent.futures.Executor, default=None
+            Pool used to run the calculation instead of the local process pool
+        threads : int, default=None
+            If provided, the number of threads used by the calculation in the worker process
+            (for engines that have a "threads" setting)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Future to be passed to collect(), whose result() is the dictionary returned by calc()
+        """
+        coords = coords.copy()
+        coord_hash = hash(coords.tobytes())
+        if pool is None: pool = getLocalPool()
+        if pool is None or coord_hash in self.stored_calcs or not self.remote_capable():
+            future = Future()
+            try:
+                future.set_result(self.calc(coords, dirname, read_data=read_data, copydir=copydir))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if read_data and os.path.exists(dirname) and hasattr(self, 'read_result'):
+            try:
+                result = self.read_result(dirname, check_coord=coords)
+                logger.info("Successfully read existing single-point result from %s\n" % dirname)
+                self.store_result(coords, result)
+                future = Future()
+                future.set_result(result)
+                return future
+            except (EngineError, CheckCoordError): pass
+        if copydir:
+            self.copy_scratch(copydir, dirname)
+        elif not os.path.exists(dirname): os.makedirs(dirname)
+        remote = self.remote_copy()
+        if threads is not None and hasattr(remote, 'threads'):
+            remote.threads = threads
+        return pool.submit(run_calc_new, remote, coords, dirname)
+
+    def collect(self, future, coords):
+        """
+        Wait for a calculation submitted using submit() and store its result in the hash table.
+        This should be called from the thread that owns the engine, so that the hash table
+        is not modified by the threads of the process pool.
+
+        Parameters
+        ----------
+        future : concurrent.futures.Future
+            Future returned by submit()
+        coords : np.array
+            1-dimensional array of shape (3*N_atoms) containing the atomic coordinates passed to submit()
+
+        Returns
+        -------
+        result : dict
+            Dictionary returned by calc(); any exception raised by the calculation is raised again
+        """
+        result = future.result()
+        self.store_result(coords.copy(), result)
         return result
 
-    def clearCalcs(self):
+    def store_result(self, coords, result):
+        """ Store the result of a calculation in the hash table, so calc() returns it instead of recalculating. """
+        self.stored_calcs[hash(coords.tobytes())] = {'coords':coords, 'result':result}
+
+    def remote_copy(self):
+        """ Return a shallow copy of the engine without stored results, to be sent to a worker process. """
+        remote = copy(self)
+        remote.stored_calcs = OrderedDict()
+        return remote
+
+    def remote_capable(self):
+        """ Whether calculations can run in a worker process of the local pool (the engine must be picklable). """
+        if not hasattr(self, '_picklable'):
+            try:
+                pickle.dumps(self.remote_copy())
+                self._picklable = True
+            except Exception:
+                logger.warning("%s engine cannot be sent to worker processes; calculations will run serially\n"
+                               % self.__class__.__name__)
+                self._picklable = False
+        return self._picklable
+
+    def clearCalcs(self, keep=()):
+        """ Clear the stored results, except for those at the coordinates in keep. """
+        hashes = [hash(coords.tobytes()) for coords in keep]
+        kept = [self.stored_calcs[h] for h in hashes if h in self.stored_calcs]
         self.stored_calcs = OrderedDict()
+        for calc in kept:
+            self.store_result(calc['coords'], calc['result'])
 
     def calc_new(self, coords, dirname):
         raise NotImplementedError("Not implemented for the base class")
@@ -340,7 +453,7 @@ class Engine(object):
             if not os.path.exists(dirname):
                 raise RuntimeError("In read_wq, %s doesn't exist" % dirname)
             result = self.read_result(dirname)
-            self.stored_calcs[coord_hash] = {'coords':coords, 'result':result}
+            self.store_result(coords, result)
         return result
 
     def number_output(self, dirname, calcNum):
@@ -2123,6 +2236,10 @@ class QCEngineAPI(Engine):
         # **kwargs: for throwing away other arguments such as read_data and copyfiles.
         return self.calc_new(coords, dirname)
 
+    def remote_capable(self):
+        # Calculations run in the calling process because schema_traj needs to be updated
+        return False
+
     def detect_dft(self):
         return any([i.lower() in self.schema["model"]["method"].lower() for i in dft_strings])
 
@@ -52,14 +52,24 @@ def check_internal_grad(coords, molecule, IC, engine, dirname, verbose=0):
     logger.info("%20s : %14s %14s %14s\n" % ('IC Name', 'Analytic', 'Numerical', 'Abs-Diff'))
     h = 1e-3
     Gq_f = np.zeros_like(Gq)
+    # Displaced geometries along each IC in the positive and negative directions
+    xplus = []
+    xminus = []
     for i in range(len(q0)):
         dq = np.zeros_like(q0)
         dq[i] += h
-        x1 = IC.newCartesian(coords, dq, verbose)
-        EPlus = engine.calc(x1, dirname)['energy']
+        xplus.append(IC.newCartesian(coords, dq, verbose))
         dq[i] -= 2*h
-        x1 = IC.newCartesian(coords, dq, verbose)
-        EMinus = engine.calc(x1, dirname)['energy']
+        xminus.append(IC.newCartesian(coords, dq, verbose))
+    # Check that the back-transformation achieved the requested displacements
+    dq_plus = np.diag(IC.calcDiff_batch(np.array(xplus), coords))
+    dq_minus = np.diag(IC.calcDiff_batch(np.array(xminus), coords))
+    for i in np.nonzero((np.abs(dq_plus - h) > 0.1*h) | (np.abs(dq_minus + h) > 0.1*h))[0]:
+        logger.warning("Displacements along %s are %.3e / %.3e instead of +/- %.3e\n"
+                       % (IC.Internals[i], dq_plus[i], dq_minus[i], h))
+    for i in range(len(q0)):
+        EPlus = engine.calc(xplus[i], dirname)['energy']
+        EMinus = engine.calc(xminus[i], dirname)['energy']
         fdiff = (EPlus-EMinus)/(2*h)
         logger.info("%20s : % 14.6f % 14.6f % 14.6f\n" % (IC.Internals[i], Gq[i], fdiff, Gq[i]-fdiff))
         Gq_f[i] = fdiff
@@ -169,16 +179,23 @@ def write_displacements(coords, M, IC, dirname, ic_select="all", displace_range=
 
     for i in ic_select_nums:
         x = []
-        for j in np.linspace(*displace_range):
+        bork = []
+        displacements = np.linspace(*displace_range)
+        for j in displacements:
             if j != 0:
                 dq = np.zeros(len(IC.Internals))
                 dq[i] = j
                 x1 = IC.newCartesian(coords, dq, verbose=verbose)
             else:
                 x1 = coords.copy()
+            x.append(x1)
+            bork.append(IC.bork)
+        # Displacements actually achieved along the selected IC, for all frames at once
+        dq_actual = IC.calcDiff_batch(np.array(x), coords)[:, i]
+        for j, x1, dqi, borked in zip(displacements, x, dq_actual, bork):
             rms_displacement, max_displacement = calc_drms_dmax(x1, coords, align=False)
-            x.append(x1.reshape(-1,3) * bohr2ang)
-            logger.info("%i %.1f Displacement (rms/max) = %.5f / %.5f %s\n" % (i, j, rms_displacement, max_displacement, "(Bork)" if IC.bork else "(Good)"))
-        M1.xyzs = x
+            logger.info("%i %.1f Displacement (rms/max) = %.5f / %.5f IC = % .5f %s\n"
+                        % (i, j, rms_displacement, max_displacement, dqi, "(Bork)" if borked else "(Good)"))
+        M1.xyzs = [x1.reshape(-1,3) * bohr2ang for x1 in x]
         M1.write("%s/ic_%03i.xyz" % (dirname, i))
     return M1
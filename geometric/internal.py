@@ -33,16 +33,24 @@ POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import division
 
+import bisect
+import hashlib
 import itertools
 import time, sys
 from collections import OrderedDict, defaultdict
-from copy import deepcopy
+from copy import copy, deepcopy
+from multiprocessing.pool import ThreadPool
 
 import networkx as nx
 import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+import scipy.spatial
 from numpy.linalg import multi_dot
 
-from geometric.molecule import Molecule, PeriodicTable, Elements, Radii
+from geometric.molecule import Molecule, PeriodicTable, Elements, Radii, AtomContact
 from geometric.nifty import click, commadash, ang2bohr, bohr2ang, logger, pvec1d, pmat2d
 from geometric.rotate import get_expmap, get_expmap_der, calc_rot_vec_diff, get_quat, build_F, sorted_eigh
 
@@ -153,6 +161,55 @@ def d_nucross(a, b):
     return np.dot(d_unit_vector(a), d_ncross(ev, b))
 ## End vector calculus functions
 
+class Geometry(np.ndarray):
+    """
+    Read-only copy of a coordinate array that carries a token identifying its contents.
+
+    Primitive internal coordinates that cache results (such as the rotators) compare tokens
+    instead of the coordinates, so a cache check is O(1) when every primitive is evaluated
+    on the same Geometry object, and the coordinates are copied once per geometry instead
+    of once per primitive.  Reshaped views of a Geometry keep its token; other derived arrays
+    (slices, copies and results of arithmetic) do not.
+    """
+    def __new__(cls, xyz):
+        obj = np.array(xyz, dtype=float).view(cls)
+        obj.token = geometry_token(obj)
+        obj.flags.writeable = False
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.token = None
+
+    def reshape(self, *args, **kwargs):
+        # Reshaping in C order is a view with the same contents, so it keeps the token
+        obj = np.ndarray.reshape(self, *args, **kwargs)
+        if kwargs.get('order', 'C') == 'C' and self.flags.c_contiguous:
+            obj.token = self.token
+        return obj
+
+    def __array_wrap__(self, obj, context=None, return_scalar=False):
+        # Results of arithmetic on the coordinates are ordinary arrays
+        obj = obj.view(np.ndarray)
+        return obj[()] if return_scalar else obj
+
+def geometry_token(xyz):
+    """
+    Return a token identifying the contents of a coordinate array; two arrays have the same
+    token if and only if they contain the same numbers (up to hash collisions of SHA-1).
+    This is O(1) for a Geometry and a single pass over the data otherwise.
+    """
+    token = getattr(xyz, 'token', None)
+    if token is not None:
+        return token
+    xyz = np.ascontiguousarray(xyz, dtype=float)
+    return (xyz.size, hashlib.sha1(xyz.view(np.uint8)).hexdigest())
+
+def as_geometry(xyz):
+    """ Return xyz as a Geometry, without copying if it already is one. """
+    if isinstance(xyz, Geometry) and xyz.token is not None:
+        return xyz
+    return Geometry(xyz)
+
 class PrimitiveCoordinate(object):
     """
     Parent class for primitive internal coordinate objects with common methods.
@@ -481,16 +538,16 @@ class Rotator(object):
         self.clear_cache(x0)
 
     def clear_cache(self, xyz):
-        xyz = xyz.reshape(-1, 3)
-        self.stored_valxyz = np.zeros_like(xyz)
+        # The stored results are identified by the geometry_token() of the coordinates
+        self.stored_valtoken = None
         self.stored_value = None
         # A second set of xyz coordinates used only when computing
         # differences in rotation coordinates
-        self.stored_valxyz2 = np.zeros_like(xyz)
+        self.stored_valtoken2 = None
         self.stored_value2 = None
-        self.stored_derxyz = np.zeros_like(xyz)
+        self.stored_dertoken = None
         self.stored_deriv = None
-        self.stored_deriv2xyz = np.zeros_like(xyz)
+        self.stored_deriv2token = None
         self.stored_deriv2 = None
         self.stored_norm = 0.0
 
@@ -564,16 +621,17 @@ class Rotator(object):
         #     self.rquat = np.array([1.0, 0.0, 0.0, 0.0])
 
     def value(self, xyz, store=True):
-        xyz = xyz.reshape(-1, 3)
-        if np.max(np.abs(xyz-self.stored_valxyz)) < 1e-12:
+        token = geometry_token(xyz)
+        if token == self.stored_valtoken:
             return self.stored_value
         else:
+            xyz = xyz.reshape(-1, 3)
             xsel = xyz[self.a, :]
             ysel = self.x0[self.a, :]
             answer = get_expmap(xsel, ysel, r=self.rnorm*self.rquat)
             if store:
                 self.stored_norm = np.linalg.norm(answer)
-                self.stored_valxyz = xyz.copy()
+                self.stored_valtoken = token
                 self.stored_value = answer.copy()
             return answer
 
@@ -600,49 +658,64 @@ class Rotator(object):
         val1 = self.value(xyz1)
         if xyz2 is not None:
             # The "second" coordinate set is cached separately
-            xyz2 = xyz2.reshape(-1, 3)
-            if np.max(np.abs(xyz2-self.stored_valxyz2)) < 1e-12:
+            token2 = geometry_token(xyz2)
+            if token2 == self.stored_valtoken2:
                 val2 = self.stored_value2.copy()
             else:
                 val2 = self.value(xyz2, store=False)
-                self.stored_valxyz2 = xyz2.copy()
+                self.stored_valtoken2 = token2
                 self.stored_value2 = val2.copy()
         # Calculate difference in rotation vectors, modulo n*2pi displacement vectors
         return calc_rot_vec_diff(val1, val2)
 
-    def derivative(self, xyz):
-        xyz = xyz.reshape(-1, 3)
-        if np.max(np.abs(xyz-self.stored_derxyz)) < 1e-12:
+    def derivative_local(self, xyz):
+        """
+        Return the first derivatives of the rotation vector w/r.t. the
+        coordinates of the atoms in self.a only, with shape (na, 3, 3).
+        """
+        token = geometry_token(xyz)
+        if token == self.stored_dertoken:
             return self.stored_deriv
         else:
+            xyz = xyz.reshape(-1, 3)
             xsel = xyz[self.a, :]
             ysel = self.x0[self.a, :]
-            xmean = np.mean(xsel,axis=0)
-            ymean = np.mean(ysel,axis=0)
             deriv_raw = get_expmap_der(xsel, ysel, r=self.rnorm*self.rquat)
-            derivatives = np.zeros((xyz.shape[0], 3, 3), dtype=float)
-            for i, a in enumerate(self.a):
-                derivatives[a, :, :] = deriv_raw[i, :, :]
-            self.stored_derxyz = xyz.copy()
-            self.stored_deriv = derivatives.copy()
-            return derivatives
-        
-    def second_derivative(self, xyz):
+            self.stored_dertoken = token
+            self.stored_deriv = deriv_raw.copy()
+            return deriv_raw
+
+    def derivative(self, xyz):
         xyz = xyz.reshape(-1, 3)
-        if np.max(np.abs(xyz-self.stored_deriv2xyz)) < 1e-12:
+        deriv_raw = self.derivative_local(xyz)
+        derivatives = np.zeros((xyz.shape[0], 3, 3), dtype=float)
+        derivatives[self.a, :, :] = deriv_raw
+        return derivatives
+        
+    def second_derivative_local(self, xyz):
+        """
+        Return the second derivatives of the rotation vector w/r.t. the
+        coordinates of the atoms in self.a only, with shape (na, 3, na, 3, 3).
+        """
+        token = geometry_token(xyz)
+        if token == self.stored_deriv2token:
             return self.stored_deriv2
         else:
+            xyz = xyz.reshape(-1, 3)
             xsel = xyz[self.a, :]
             ysel = self.x0[self.a, :]
-            xmean = np.mean(xsel,axis=0)
-            ymean = np.mean(ysel,axis=0)
             deriv_raw, deriv2_raw = get_expmap_der(xsel, ysel, second=True, r=self.rnorm*self.rquat)
-            second_derivatives = np.zeros((xyz.shape[0], 3, xyz.shape[0], 3, 3), dtype=float)
-            for i, a in enumerate(self.a):
-                for j, b in enumerate(self.a):
-                    second_derivatives[a, :, b, :, :] = deriv2_raw[i, :, j, :, :]
-            # derivatives, second_derivatives = get_expmap_der(xsel, ysel, second=True, r=self.rnorm*self.rquat)
-            return second_derivatives
+            self.stored_deriv2token = token
+            self.stored_deriv2 = deriv2_raw.copy()
+            return deriv2_raw
+
+    def second_derivative(self, xyz):
+        xyz = xyz.reshape(-1, 3)
+        deriv2_raw = self.second_derivative_local(xyz)
+        second_derivatives = np.zeros((xyz.shape[0], 3, xyz.shape[0], 3, 3), dtype=float)
+        second_derivatives[np.ix_(self.a, range(3), self.a)] = deriv2_raw
+        # derivatives, second_derivatives = get_expmap_der(xsel, ysel, second=True, r=self.rnorm*self.rquat)
+        return second_derivatives
         
 class RotationA(PrimitiveCoordinate):
     def __init__(self, a, x0, Rotators, w=1.0):
@@ -858,7 +931,7 @@ class CentroidDistance(PrimitiveCoordinate):
         # is used for constraints
         h = 1e-4 
 
-        xyz = xyz.reshape(-1,3)
+        xyz = xyz.reshape(-1,3).copy()
         deriv2 = np.zeros((xyz.shape[0], xyz.shape[1], xyz.shape[0], xyz.shape[1]))
         for i in range(xyz.shape[0]):
             for j in range(xyz.shape[1]):
@@ -1241,7 +1314,7 @@ class LinearAngle(PrimitiveCoordinate):
         return derivatives
     
     def second_derivative(self, xyz):
-        xyz = xyz.reshape(-1,3)
+        xyz = xyz.reshape(-1,3).copy()
         a = self.a
         b = self.b
         c = self.c
@@ -1754,7 +1827,7 @@ class OutOfPlane(PrimitiveCoordinate):
         return derivatives
 
     def second_derivative(self, xyz):
-        xyz = xyz.reshape(-1,3)
+        xyz = xyz.reshape(-1,3).copy()
         a = self.a
         b = self.b
         c = self.c
@@ -1773,6 +1846,659 @@ class OutOfPlane(PrimitiveCoordinate):
                 deriv2[ii, j, :, :] = fderiv
         return deriv2
 
+def local_derivative(prim, xyz):
+    """
+    Return the first derivatives of a primitive IC w/r.t. the coordinates
+    of the atoms that it depends on.
+
+    Parameters
+    ----------
+    prim : PrimitiveCoordinate
+        The primitive internal coordinate
+    xyz : np.ndarray
+        Cartesian coordinates in a.u.
+
+    Returns
+    -------
+    atoms : np.ndarray
+        Indices of the k atoms that the primitive depends on
+    deriv : np.ndarray
+        Array with dimensions (k, 3)
+    """
+    xyz = xyz.reshape(-1,3)
+    typ = type(prim)
+    if typ in (RotationA, RotationB, RotationC):
+        # Rotators store their derivatives for the atoms in the fragment only
+        comp = {RotationA : 0, RotationB : 1, RotationC : 2}[typ]
+        deriv = prim.Rotator.derivative_local(xyz)[:, :, comp]*prim.w
+        return np.array(prim.Rotator.a, dtype=int), deriv
+    deriv = prim.derivative(xyz)
+    nz = np.nonzero(np.any(deriv != 0.0, axis=1))[0]
+    return nz, deriv[nz]
+
+def local_second_derivative(prim, xyz):
+    """
+    Return the second derivatives of a primitive IC w/r.t. the coordinates
+    of the atoms that it depends on.
+
+    Parameters
+    ----------
+    prim : PrimitiveCoordinate
+        The primitive internal coordinate
+    xyz : np.ndarray
+        Cartesian coordinates in a.u.
+
+    Returns
+    -------
+    atoms : np.ndarray
+        Indices of the k atoms that the primitive depends on
+        (empty if the second derivatives are zero)
+    deriv2 : np.ndarray
+        Array with dimensions (k, 3, k, 3)
+    """
+    xyz = xyz.reshape(-1,3)
+    typ = type(prim)
+    if typ in (CartesianX, CartesianY, CartesianZ, TranslationX, TranslationY, TranslationZ):
+        return np.zeros(0, dtype=int), np.zeros((0, 3, 0, 3), dtype=float)
+    elif typ in (RotationA, RotationB, RotationC):
+        comp = {RotationA : 0, RotationB : 1, RotationC : 2}[typ]
+        deriv2 = prim.Rotator.second_derivative_local(xyz)[:, :, :, :, comp]*prim.w
+        return np.array(prim.Rotator.a, dtype=int), deriv2
+    elif typ in (Distance, Angle, LinearAngle, Dihedral, OutOfPlane):
+        # Evaluate a copy of the primitive on the coordinates of its own atoms
+        keys = [k for k in ('a', 'b', 'c', 'd') if hasattr(prim, k)]
+        atoms = np.array([getattr(prim, k) for k in keys], dtype=int)
+        local = copy(prim)
+        for i, k in enumerate(keys):
+            setattr(local, k, i)
+        return atoms, local.second_derivative(xyz[atoms].copy())
+    else:
+        # Fall back to the full second derivative and keep the atoms it touches
+        deriv2 = prim.second_derivative(xyz)
+        nz = np.nonzero(np.any(deriv2.reshape(xyz.shape[0], -1) != 0.0, axis=1))[0]
+        return nz, deriv2[nz][:, :, nz, :]
+
+def _batch_unit(v):
+    """ Row-wise unit vectors and norms of an (n, 3) array. """
+    n = np.sqrt(np.sum(v**2, axis=1))
+    return v / n[:, np.newaxis], n
+
+def _batch_d_unit(v):
+    """ Row-wise version of d_unit_vector() for an (n, 3) array; returns (n, 3, 3). """
+    n = np.sqrt(np.sum(v**2, axis=1))
+    return (np.eye(3)[np.newaxis, :, :]/n[:, np.newaxis, np.newaxis]
+            - np.einsum('ni,nj->nij', v, v)/(n**3)[:, np.newaxis, np.newaxis])
+
+def _batch_dihedral_value(xyz, a, b, c, d):
+    vec1 = xyz[b] - xyz[a]
+    vec2 = xyz[c] - xyz[b]
+    vec3 = xyz[d] - xyz[c]
+    cross1 = np.cross(vec2, vec3)
+    cross2 = np.cross(vec1, vec2)
+    arg1 = np.sum(vec1*cross1, axis=1) * np.sqrt(np.sum(vec2**2, axis=1))
+    arg2 = np.sum(cross1*cross2, axis=1)
+    return np.arctan2(arg1, arg2)
+
+def _batch_dihedral_derivative(xyz, m, o, p, n):
+    u, u_norm = _batch_unit(xyz[m] - xyz[o])
+    w, w_norm = _batch_unit(xyz[p] - xyz[o])
+    v, v_norm = _batch_unit(xyz[n] - xyz[p])
+    uw = np.sum(u*w, axis=1)
+    vw = np.sum(v*w, axis=1)
+    cuw = np.cross(u, w)
+    cvw = np.cross(v, w)
+    # Terms are set to zero when the bond angles become linear, same as Dihedral.derivative()
+    suw = 1 - uw**2
+    svw = 1 - vw**2
+    okuw = suw >= 1e-6
+    okvw = svw >= 1e-6
+    suw = np.where(okuw, suw, 1.0)
+    svw = np.where(okvw, svw, 1.0)
+    term1 = np.where(okuw[:, np.newaxis], cuw / (u_norm * suw)[:, np.newaxis], 0.0)
+    term3 = np.where(okuw[:, np.newaxis], cuw * (uw / (w_norm * suw))[:, np.newaxis], 0.0)
+    term2 = np.where(okvw[:, np.newaxis], cvw / (v_norm * svw)[:, np.newaxis], 0.0)
+    term4 = np.where(okvw[:, np.newaxis], cvw * (vw / (w_norm * svw))[:, np.newaxis], 0.0)
+    return term1, -term1 + term3 - term4, term2 - term3 + term4, -term2
+
+def primitive_key(prim):
+    """
+    Return a hashable key for a primitive internal coordinate such that primitives
+    which compare equal (using their __eq__ methods) always have the same key,
+    e.g. Distance(a, b) and Distance(b, a).  Primitives with the same key are not
+    necessarily equal (e.g. translations with different weights), so the key is
+    only used to find candidates that are then compared with __eq__.
+    """
+    typ = type(prim)
+    if typ in (CartesianX, CartesianY, CartesianZ):
+        return (typ, prim.a)
+    elif typ in (TranslationX, TranslationY, TranslationZ, RotationA, RotationB, RotationC):
+        return (typ, frozenset(prim.a))
+    elif typ is Distance:
+        return (typ, frozenset((prim.a, prim.b)))
+    elif typ is Angle:
+        return (typ, prim.b, frozenset((prim.a, prim.c)))
+    elif typ is LinearAngle:
+        return (typ, prim.b, frozenset((prim.a, prim.c)), prim.axis)
+    elif typ is MultiAngle:
+        return (typ, prim.b, frozenset((frozenset(prim.a), frozenset(prim.c))))
+    elif typ is Dihedral:
+        return (typ, min((prim.a, prim.b, prim.c, prim.d), (prim.d, prim.c, prim.b, prim.a)))
+    elif typ is MultiDihedral:
+        return (typ, frozenset(((frozenset(prim.a), prim.b, prim.c, frozenset(prim.d)),
+                                (frozenset(prim.d), prim.c, prim.b, frozenset(prim.a)))))
+    elif typ is OutOfPlane:
+        return (typ, prim.a, frozenset((prim.b, prim.c, prim.d)))
+    elif typ is CentroidDistance:
+        return (typ, frozenset(prim.a), frozenset(prim.b))
+    elif typ is ImagePrim:
+        return (typ, prim.nr, primitive_key(prim.ic))
+    # Other types are only grouped by type
+    return (typ,)
+
+class PrimitiveList(list):
+    """
+    List of primitive internal coordinates that keeps an index from primitive_key()
+    to the stored primitives, so that membership tests, index() and remove() only
+    compare against the primitives with the same key instead of scanning the list.
+
+    The position of each stored primitive is also kept, counted before any of the
+    removals since the index was last built.  The current position is found by
+    subtracting the number of earlier removals (a bisection into the sorted removed
+    positions), so appending and removing do not touch the other entries.
+    Any other modification (insertion, item assignment, sorting) rebuilds the index.
+    """
+    def __init__(self, iterable=()):
+        super(PrimitiveList, self).__init__(iterable)
+        self._reindex()
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    def _reindex(self):
+        self._members = {}
+        self._pos = {}
+        self._removed = []
+        for i, prim in enumerate(self):
+            self._members.setdefault(primitive_key(prim), []).append(prim)
+            self._pos.setdefault(id(prim), i)
+
+    def _find(self, prim):
+        """ Return the stored primitives equal to prim. """
+        return [p for p in self._members.get(primitive_key(prim), []) if p == prim]
+
+    def _position(self, stored):
+        """ Return the current position of a stored primitive. """
+        pos = self._pos[id(stored)]
+        return pos - bisect.bisect_left(self._removed, pos)
+
+    def _unlink(self, stored, i):
+        """ Update the index after the primitive stored at position i was removed from the list. """
+        if self._pos.get(id(stored), None) is None or self._position(stored) != i:
+            # The same object is stored more than once
+            self._reindex()
+            return
+        bisect.insort(self._removed, self._pos.pop(id(stored)))
+        bucket = self._members[primitive_key(stored)]
+        del bucket[[id(p) for p in bucket].index(id(stored))]
+        if any(p is stored for p in bucket):
+            self._reindex()
+
+    def __contains__(self, prim):
+        return len(self._find(prim)) > 0
+
+    def index(self, prim, *args):
+        if args:
+            return super(PrimitiveList, self).index(prim, *args)
+        found = self._find(prim)
+        if len(found) == 0:
+            raise ValueError("%s is not in list" % str(prim))
+        return min(self._position(p) for p in found)
+
+    def append(self, prim):
+        super(PrimitiveList, self).append(prim)
+        self._members.setdefault(primitive_key(prim), []).append(prim)
+        self._pos.setdefault(id(prim), len(self) - 1 + len(self._removed))
+
+    def extend(self, prims):
+        for prim in prims:
+            self.append(prim)
+
+    def __iadd__(self, prims):
+        self.extend(prims)
+        return self
+
+    def remove(self, prim):
+        i = self.index(prim)
+        stored = self[i]
+        super(PrimitiveList, self).__delitem__(i)
+        self._unlink(stored, i)
+
+    def pop(self, i=-1):
+        if i < 0: i += len(self)
+        prim = super(PrimitiveList, self).pop(i)
+        self._unlink(prim, i)
+        return prim
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            super(PrimitiveList, self).__delitem__(i)
+            self._reindex()
+        else:
+            self.pop(i)
+
+    def insert(self, i, prim):
+        super(PrimitiveList, self).insert(i, prim)
+        self._reindex()
+
+    def __setitem__(self, i, val):
+        super(PrimitiveList, self).__setitem__(i, val)
+        self._reindex()
+
+    def sort(self, *args, **kwargs):
+        super(PrimitiveList, self).sort(*args, **kwargs)
+        self._reindex()
+
+    def reverse(self):
+        super(PrimitiveList, self).reverse()
+        self._reindex()
+
+    def clear(self):
+        del self[:]
+
+class PackedPrimitives(object):
+    """
+    Packed representation of a list of primitive internal coordinates.
+
+    Primitives of the same type are grouped into index arrays so that
+    the values, first derivatives and differences of each type are
+    computed with a single set of array operations instead of one
+    Python method call per primitive.  Types without a packed kernel
+    (e.g. rotations) are evaluated with their own methods.
+    """
+    def __init__(self, Internals):
+        # Keep references to the primitives so that the id() signature stays valid
+        self.prims = list(Internals)
+        self.signature = [id(p) for p in self.prims]
+        self.nprim = len(self.prims)
+        groups = OrderedDict()
+        self.other = []
+        for i, p in enumerate(self.prims):
+            if type(p) in PackedPrimitives.kernels:
+                groups.setdefault(type(p), []).append(i)
+            else:
+                self.other.append(i)
+        self.groups = []
+        for typ, idx in groups.items():
+            prims = [self.prims[i] for i in idx]
+            group = {'type': typ, 'idx': np.array(idx, dtype=int)}
+            if typ is Distance:
+                group['atoms'] = np.array([(p.a, p.b) for p in prims], dtype=int)
+            elif typ in (Angle, LinearAngle):
+                group['atoms'] = np.array([(p.a, p.b, p.c) for p in prims], dtype=int)
+                if typ is LinearAngle:
+                    group['axis'] = np.array([p.axis for p in prims], dtype=int)
+                    group['prims'] = prims
+            elif typ in (Dihedral, OutOfPlane):
+                group['atoms'] = np.array([(p.a, p.b, p.c, p.d) for p in prims], dtype=int)
+            elif typ in (CartesianX, CartesianY, CartesianZ):
+                group['atoms'] = np.array([p.a for p in prims], dtype=int)
+                group['w'] = np.array([p.w for p in prims], dtype=float)
+            elif typ in (TranslationX, TranslationY, TranslationZ):
+                # Flattened atom lists with the position of the owning primitive
+                group['atoms'] = np.array([a for p in prims for a in p.a], dtype=int)
+                group['w'] = np.array([w for p in prims for w in p.w], dtype=float)
+                group['seg'] = np.array([i for i, p in enumerate(prims) for a in p.a], dtype=int)
+            self.groups.append(group)
+        # Primitives whose differences need the 2*pi correction
+        self.periodic = np.array([i for i, p in enumerate(self.prims) if type(p) in (Dihedral, OutOfPlane)], dtype=int)
+        # Number of stacked geometries and atoms per geometry (see tile())
+        self.nframes = 1
+        self.na = None
+
+    def tile(self, nframes, na):
+        """
+        Return a packing that evaluates the primitives for nframes geometries of na atoms
+        stacked into one (nframes*na, 3) array.  The atom indices of frame f are offset by
+        f*na and its primitives are numbered f*nprim ... (f+1)*nprim-1, so the kernels
+        process all frames in the same array operations.
+        """
+        if self.nframes != 1:
+            raise RuntimeError("Cannot tile a packing that is already tiled")
+        tiled = copy(self)
+        tiled.prims = self.prims * nframes
+        tiled.signature = self.signature * nframes
+        tiled.nprim = self.nprim * nframes
+        tiled.nframes = nframes
+        tiled.na = na
+        prim_offset = self.nprim * np.arange(nframes)
+        atom_offset = na * np.arange(nframes)
+        tiled.groups = []
+        for group in self.groups:
+            tgroup = dict(group)
+            atoms = group['atoms']
+            tgroup['idx'] = (group['idx'][np.newaxis, :] + prim_offset[:, np.newaxis]).flatten()
+            tgroup['atoms'] = atoms[np.newaxis] + atom_offset.reshape((-1,) + (1,)*atoms.ndim)
+            tgroup['atoms'] = tgroup['atoms'].reshape((-1,) + atoms.shape[1:])
+            for key in ['w', 'axis']:
+                if key in group:
+                    tgroup[key] = np.tile(group[key], nframes)
+            if 'seg' in group:
+                seg_offset = len(group['idx'])*np.arange(nframes)
+                tgroup['seg'] = (group['seg'][np.newaxis, :] + seg_offset[:, np.newaxis]).flatten()
+            if 'prims' in group:
+                tgroup['prims'] = group['prims'] * nframes
+            tiled.groups.append(tgroup)
+        tiled.other = [i + o for o in prim_offset for i in self.other]
+        tiled.periodic = (self.periodic[np.newaxis, :] + prim_offset[:, np.newaxis]).flatten()
+        return tiled
+
+    def _frame(self, xyz, i):
+        """ Return the coordinates of the geometry containing primitive i and the offset of its atom indices. """
+        if self.nframes == 1:
+            return xyz, 0
+        offset = (i // (self.nprim // self.nframes)) * self.na
+        return xyz[offset:offset+self.na], offset
+
+    def matches(self, Internals):
+        """ Return True if this packing was built from the same list of primitive objects. """
+        if len(Internals) != self.nprim:
+            return False
+        return all(id(p) == s for p, s in zip(Internals, self.signature))
+
+    def _linear_angle_frames(self, group, xyz):
+        """ Unit vectors e1, e2 perpendicular to the A-C axis of each linear angle and the intermediate quantities. """
+        atoms = group['atoms']
+        for p in group['prims']:
+            if p.e0 is None: p.reset(xyz)
+        e0 = np.array([p.e0 for p in group['prims']])
+        v = xyz[atoms[:, 2]] - xyz[atoms[:, 0]]
+        ev, _ = _batch_unit(v)
+        c1 = np.cross(ev, e0)
+        e1, _ = _batch_unit(c1)
+        c2 = np.cross(ev, e1)
+        e2, _ = _batch_unit(c2)
+        return e0, v, ev, c1, e1, c2, e2
+
+    def calculate(self, xyz, other=True):
+        xyz = xyz.reshape(-1,3)
+        answer = np.zeros(self.nprim, dtype=float)
+        for group in self.groups:
+            typ = group['type']
+            atoms = group['atoms']
+            if typ is Distance:
+                vals = np.sqrt(np.sum((xyz[atoms[:, 0]] - xyz[atoms[:, 1]])**2, axis=1))
+            elif typ is Angle:
+                vector1 = xyz[atoms[:, 0]] - xyz[atoms[:, 1]]
+                vector2 = xyz[atoms[:, 2]] - xyz[atoms[:, 1]]
+                cosine = (np.sum(vector1*vector2, axis=1)
+                          / (np.sqrt(np.sum(vector1**2, axis=1))*np.sqrt(np.sum(vector2**2, axis=1))))
+                if np.any(cosine - 1.0 > 1e-6):
+                    raise RuntimeError('Encountered invalid value in angle')
+                vals = np.arccos(np.clip(cosine, -1.0, 1.0))
+            elif typ is LinearAngle:
+                e0, v, ev, c1, e1, c2, e2 = self._linear_angle_frames(group, xyz)
+                for p, dot2 in zip(group['prims'], np.sum(ev*e0, axis=1)**2):
+                    p.stored_dot2 = dot2
+                eba, _ = _batch_unit(xyz[atoms[:, 0]] - xyz[atoms[:, 1]])
+                ebc, _ = _batch_unit(xyz[atoms[:, 2]] - xyz[atoms[:, 1]])
+                ex = np.where((group['axis'] == 0)[:, np.newaxis], e1, e2)
+                vals = np.sum(eba*ex, axis=1) + np.sum(ebc*ex, axis=1)
+            elif typ in (Dihedral, OutOfPlane):
+                vals = _batch_dihedral_value(xyz, atoms[:, 0], atoms[:, 1], atoms[:, 2], atoms[:, 3])
+            elif typ in (CartesianX, CartesianY, CartesianZ):
+                vals = xyz[atoms, PackedPrimitives.axes[typ]]*group['w']
+            elif typ in (TranslationX, TranslationY, TranslationZ):
+                vals = np.bincount(group['seg'], weights=xyz[atoms, PackedPrimitives.axes[typ]]*group['w'],
+                                   minlength=len(group['idx']))
+            answer[group['idx']] = vals
+        if other:
+            for i in self.other:
+                answer[i] = self.prims[i].value(self._frame(xyz, i)[0])
+        return answer
+
+    def derivative_blocks(self, xyz):
+        """
+        Return the first derivatives of the primitives as a list of atom-local blocks.
+        Each block is a tuple (rows, atoms, values) where values[k] is the derivative
+        of primitive rows[k] w/r.t. the coordinates of atom atoms[k].  Atoms that a
+        primitive does not touch are not stored.
+        """
+        xyz = xyz.reshape(-1,3)
+        blocks = []
+        def from_dense(i):
+            # Atom-local derivatives of a primitive without a packed kernel
+            xyz_i, offset = self._frame(xyz, i)
+            atoms, der = local_derivative(self.prims[i], xyz_i)
+            return (np.full(len(atoms), i, dtype=int), atoms + offset, der)
+        for group in self.groups:
+            typ = group['type']
+            atoms = group['atoms']
+            idx = group['idx']
+            if typ is Distance:
+                u, _ = _batch_unit(xyz[atoms[:, 0]] - xyz[atoms[:, 1]])
+                blocks.append((idx, atoms[:, 0], u))
+                blocks.append((idx, atoms[:, 1], -u))
+            elif typ is Angle:
+                m, o, n = atoms[:, 0], atoms[:, 1], atoms[:, 2]
+                u, u_norm = _batch_unit(xyz[m] - xyz[o])
+                v, v_norm = _batch_unit(xyz[n] - xyz[o])
+                # (Anti)parallel vectors need a reference direction; use the per-object code for these.
+                special = (np.sqrt(np.sum((u+v)**2, axis=1)) < 1e-10) | (np.sqrt(np.sum((u-v)**2, axis=1)) < 1e-10)
+                w, _ = _batch_unit(np.cross(u[~special], v[~special]))
+                term1 = np.cross(u[~special], w) / u_norm[~special, np.newaxis]
+                term2 = np.cross(w, v[~special]) / v_norm[~special, np.newaxis]
+                sel = idx[~special]
+                blocks.append((sel, m[~special], term1))
+                blocks.append((sel, n[~special], term2))
+                blocks.append((sel, o[~special], -(term1 + term2)))
+                for i in idx[special]:
+                    blocks.append(from_dense(i))
+            elif typ is LinearAngle:
+                a, b, c = atoms[:, 0], atoms[:, 1], atoms[:, 2]
+                e0, v, ev, c1, e1, c2, e2 = self._linear_angle_frames(group, xyz)
+                eba, _ = _batch_unit(xyz[a] - xyz[b])
+                ebc, _ = _batch_unit(xyz[c] - xyz[b])
+                dev = _batch_d_unit(v)
+                # Same chain rule as LinearAngle.derivative(); the derivative of e0 is zero.
+                dc1 = np.cross(dev, e0[:, np.newaxis, :])
+                de1 = np.matmul(dc1, _batch_d_unit(c1))
+                dc2 = np.cross(ev[:, np.newaxis, :], de1) + np.cross(dev, e1[:, np.newaxis, :])
+                de2 = np.matmul(dc2, _batch_d_unit(c2))
+                deba = _batch_d_unit(xyz[a] - xyz[b])
+                debc = _batch_d_unit(xyz[c] - xyz[b])
+                axis0 = (group['axis'] == 0)[:, np.newaxis]
+                ex = np.where(axis0, e1, e2)
+                dex = np.where(axis0[:, :, np.newaxis], de1, de2)
+                mv = lambda M, x: np.einsum('nij,nj->ni', M, x)
+                blocks.append((idx, a, mv(deba, ex) - mv(dex, eba) - mv(dex, ebc)))
+                blocks.append((idx, b, -mv(deba, ex) - mv(debc, ex)))
+                blocks.append((idx, c, mv(dex, eba) + mv(dex, ebc) + mv(debc, ex)))
+            elif typ in (Dihedral, OutOfPlane):
+                ders = _batch_dihedral_derivative(xyz, atoms[:, 0], atoms[:, 1], atoms[:, 2], atoms[:, 3])
+                for k in range(4):
+                    blocks.append((idx, atoms[:, k], ders[k]))
+            elif typ in (CartesianX, CartesianY, CartesianZ):
+                vals = np.zeros((len(idx), 3), dtype=float)
+                vals[:, PackedPrimitives.axes[typ]] = group['w']
+                blocks.append((idx, atoms, vals))
+            elif typ in (TranslationX, TranslationY, TranslationZ):
+                vals = np.zeros((len(atoms), 3), dtype=float)
+                vals[:, PackedPrimitives.axes[typ]] = group['w']
+                blocks.append((idx[group['seg']], atoms, vals))
+        for i in self.other:
+            blocks.append(from_dense(i))
+        return blocks
+
+    def derivatives(self, xyz):
+        xyz = xyz.reshape(-1,3)
+        answer = np.zeros((self.nprim, xyz.shape[0], 3), dtype=float)
+        for rows, atoms, vals in self.derivative_blocks(xyz):
+            answer[rows, atoms, :] = vals
+        return answer
+
+    def sparse_derivatives(self, xyz):
+        """ Return the Wilson B-matrix as a (nprim, 3*natoms) CSR matrix. """
+        xyz = xyz.reshape(-1,3)
+        blocks = self.derivative_blocks(xyz)
+        if len(blocks) == 0:
+            return scipy.sparse.csr_matrix((self.nprim, xyz.size))
+        rows = np.concatenate([np.repeat(r, 3) for r, a, v in blocks])
+        cols = np.concatenate([(3*a[:, np.newaxis] + np.arange(3)).flatten() for r, a, v in blocks])
+        vals = np.concatenate([v.flatten() for r, a, v in blocks])
+        keep = vals != 0.0
+        return scipy.sparse.csr_matrix((vals[keep], (rows[keep], cols[keep])), shape=(self.nprim, xyz.size))
+
+    def calcDiff(self, xyz1, xyz2):
+        val2 = self.calculate(xyz2, other=False)
+        answer = self.calculate(xyz1, other=False) - val2
+        # Subtract out any differences of 2*pi for periodic degrees of freedom
+        if len(self.periodic) > 0:
+            diff = answer[self.periodic]
+            diff = np.where(np.abs(diff) > np.abs(diff + 2*np.pi), diff + 2*np.pi, diff)
+            diff = np.where(np.abs(diff) > np.abs(diff - 2*np.pi), diff - 2*np.pi, diff)
+            answer[self.periodic] = diff
+        # Primitives without a packed kernel (e.g. rotations) have their own calcDiff
+        for i in self.other:
+            answer[i] = self.prims[i].calcDiff(self._frame(xyz1, i)[0], self._frame(xyz2, i)[0])
+        return answer
+
+PackedPrimitives.kernels = (Distance, Angle, LinearAngle, Dihedral, OutOfPlane,
+                            CartesianX, CartesianY, CartesianZ,
+                            TranslationX, TranslationY, TranslationZ)
+PackedPrimitives.axes = {CartesianX : 0, CartesianY : 1, CartesianZ : 2,
+                         TranslationX : 0, TranslationY : 1, TranslationZ : 2}
+
+def euclidean_mst_edges(xyz, cutoff=4.0):
+    """
+    Return the edges of the minimum spanning tree of the complete graph of atoms
+    weighted by interatomic distance, without building all N^2 atom pairs.
+
+    The result is the same as running networkx.minimum_spanning_edges on the complete
+    graph (including the tie-breaking by atom indices).  Pairs within the cutoff are
+    found with a KD-tree and processed with Kruskal's algorithm; the components that
+    remain are then connected through the shortest contact between each pair of them.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        Cartesian coordinates of shape (N, 3)
+    cutoff : float
+        Distance cutoff (same units as xyz) for the first set of candidate edges
+
+    Returns
+    -------
+    list
+        Sorted list of (i, j) tuples with i < j
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    na = xyz.shape[0]
+    parent = list(range(na))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    def kruskal(pairs, cut=None):
+        if len(pairs) == 0: return []
+        # Distances are computed the same way as Molecule.distance_matrix()
+        dist = AtomContact(xyz[np.newaxis, :, :], pairs)[0]
+        if cut is not None:
+            keep = dist <= cut
+            pairs, dist = pairs[keep], dist[keep]
+        edges = []
+        for k in np.lexsort((pairs[:, 1], pairs[:, 0], dist)):
+            i, j = pairs[k]
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[ri] = rj
+                edges.append((int(i), int(j)))
+        return edges
+    tree = scipy.spatial.cKDTree(xyz)
+    # Slightly enlarge the KD-tree cutoff so that no pair within the cutoff is missed due to roundoff
+    pairs = tree.query_pairs(cutoff*(1.0+1e-8)+1e-12, output_type='ndarray').astype(int)
+    mst = kruskal(pairs, cutoff)
+    # Shortest contact between each pair of components that remain disconnected
+    roots = np.array([find(i) for i in range(na)])
+    comps = [np.nonzero(roots == r)[0] for r in np.unique(roots)]
+    if len(comps) > 1:
+        trees = [scipy.spatial.cKDTree(xyz[c]) for c in comps]
+        contacts = []
+        for a in range(len(comps)):
+            for b in range(a+1, len(comps)):
+                dist, nearest = trees[b].query(xyz[comps[a]])
+                # Among contacts of equal length, choose the lowest atom indices
+                ties = np.nonzero(dist == np.min(dist))[0]
+                cands = [tuple(sorted((comps[a][t], comps[b][nearest[t]]))) for t in ties]
+                contacts.append(min(cands))
+        mst += kruskal(np.array(contacts, dtype=int))
+    return sorted(mst)
+
+def primitive_choices(xyz, edges, LinThre=0.95):
+    """
+    Return the almost-linear angles and the out-of-plane coordinates that makePrimitives()
+    chooses for a bond graph.  The angles between neighbors of each atom are evaluated
+    together with array operations, grouping atoms by their number of neighbors.
+
+    Parameters
+    ----------
+    xyz : np.ndarray
+        Cartesian coordinates of shape (N, 3)
+    edges : iterable
+        (i, j) tuples of the bond graph, including any noncovalent edges
+    LinThre : float
+        Linear angle threshold for the cosine (same as makePrimitives)
+
+    Returns
+    -------
+    linear : set
+        (a, b, c) tuples with a < c for almost-linear angles a-b-c between neighbors of b
+    oop : set
+        (b, i, j, k) tuples for each OutOfPlane(b, i, j, k) that makePrimitives() adds
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    na = xyz.shape[0]
+    pairs = np.array(list(edges), dtype=int).reshape(-1, 2)
+    pairs = np.unique(np.concatenate([pairs, pairs[:, ::-1]]), axis=0)
+    # Neighbors of each atom in increasing order are pairs[start[b]:start[b]+degree[b], 1]
+    degree = np.bincount(pairs[:, 0], minlength=na)
+    start = np.concatenate([[0], np.cumsum(degree)[:-1]]).astype(int)
+    def neighbor_combinations(k):
+        # Rows of (b, n_1, ..., n_k) for all combinations n_1 < ... < n_k of the neighbors of b
+        rows = [np.zeros((0, k+1), dtype=int)]
+        for d in np.unique(degree[degree >= k]):
+            centers = np.nonzero(degree == d)[0]
+            combs = np.array(list(itertools.combinations(range(d), k)), dtype=int)
+            nbrs = pairs[start[centers][:, np.newaxis, np.newaxis] + combs[np.newaxis, :, :], 1]
+            rows.append(np.hstack([np.repeat(centers, len(combs))[:, np.newaxis], nbrs.reshape(-1, k)]))
+        return np.vstack(rows)
+    def angle_vectors(a, b, c):
+        return xyz[a] - xyz[b], xyz[c] - xyz[b]
+    def abs_cosine(a, b, c):
+        v1, v2 = angle_vectors(a, b, c)
+        return np.abs(np.sum(v1*v2, axis=1)) / np.sqrt(np.sum(v1**2, axis=1)*np.sum(v2**2, axis=1))
+    def normal_vector(a, b, c):
+        crs = np.cross(*angle_vectors(a, b, c))
+        return crs / np.linalg.norm(crs, axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        trip = neighbor_combinations(2)
+        is_linear = abs_cosine(trip[:, 1], trip[:, 0], trip[:, 2]) >= LinThre
+        linear = set((int(a), int(b), int(c)) for b, a, c in trip[is_linear])
+        # Permutations of the three neighbors in the order tried by makePrimitives()
+        quad = neighbor_combinations(3)
+        perms = sorted(itertools.permutations(range(3)))
+        found = np.zeros((len(quad), len(perms)), dtype=bool)
+        b = quad[:, 0]
+        for p, perm in enumerate(perms):
+            i, j, k = [quad[:, 1+q] for q in perm]
+            n1 = normal_vector(b, i, j)
+            n2 = normal_vector(i, j, k)
+            found[:, p] = ((abs_cosine(b, i, j) <= LinThre) & (abs_cosine(i, j, k) <= LinThre)
+                           & (np.abs(np.sum(n1*n2, axis=1)) > LinThre))
+    oop = set()
+    for row, p in zip(quad[found.any(axis=1)], np.argmax(found, axis=1)[found.any(axis=1)]):
+        oop.add((int(row[0]),) + tuple(int(row[1+q]) for q in perms[p]))
+    return linear, oop
+
 def convert_angstroms_degrees(prims, values):
     """ Convert values of primitive ICs (or differences) from
     weighted atomic units to Angstroms and degrees. """
@@ -1792,14 +2518,85 @@ def convert_angstroms_degrees(prims, values):
         converted[ic] *= factor
     return converted
 
-CacheWarning = False
+def cache_nbytes(obj):
+    """ Return the approximate memory used by an array, sparse matrix or tuple of them. """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif scipy.sparse.issparse(obj):
+        return sum(a.nbytes for a in (obj.data, obj.indices, obj.indptr) if a is not None)
+    elif isinstance(obj, (tuple, list)):
+        return sum(cache_nbytes(o) for o in obj)
+    return sys.getsizeof(obj)
+
+def sum_cache_stats(stats):
+    """ Add up a list of dictionaries returned by ICCache.stats(). """
+    answer = OrderedDict()
+    for st in stats:
+        for k, v in st.items():
+            answer[k] = answer.get(k, 0) + v
+    return answer
+
+class ICCache(object):
+    """
+    Least-recently-used cache of quantities that depend on the Cartesian coordinates
+    (B-matrix, G-inverse and so on), shared by all quantities of one coordinate system.
+
+    Entries are keyed by the name of the quantity and the raw bytes of the coordinates,
+    so a lookup never returns a result for different coordinates (unlike a hash alone).
+    When the memory used by the stored values exceeds the budget, the least recently
+    used entries are evicted.
+    """
+    def __init__(self, budget=512*1024**2):
+        # Memory budget in bytes
+        self.budget = budget
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, xyz):
+        """ Return the stored value of quantity (name) at xyz, or None if it is not stored. """
+        key = (name, np.ascontiguousarray(xyz).tobytes())
+        if key in self.data:
+            # Move the entry to the end (most recently used)
+            entry = self.data.pop(key)
+            self.data[key] = entry
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, name, xyz, value):
+        """ Store the value of quantity (name) at xyz, evicting old entries to stay within budget. """
+        key = (name, np.ascontiguousarray(xyz).tobytes())
+        if key in self.data:
+            self.nbytes -= self.data.pop(key)[1]
+        nbytes = cache_nbytes(value) + len(key[1])
+        self.data[key] = (value, nbytes)
+        self.nbytes += nbytes
+        self.trim()
+
+    def trim(self):
+        """ Evict the least recently used entries until the stored values fit in the budget. """
+        # The newest entry is always kept, even if it exceeds the budget by itself
+        while self.nbytes > self.budget and len(self.data) > 1:
+            self.nbytes -= self.data.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def clear(self):
+        """ Remove all entries; the counters are kept. """
+        self.data = OrderedDict()
+        self.nbytes = 0
+
+    def stats(self):
+        """ Return a dictionary of the cache counters and current memory use. """
+        return OrderedDict([('hits', self.hits), ('misses', self.misses), ('evictions', self.evictions),
+                            ('entries', len(self.data)), ('nbytes', self.nbytes)])
 
 class InternalCoordinates(object):
     def __init__(self):
-        self.stored_wilsonB = OrderedDict()
-        self.stored_Ginverse = OrderedDict()
-        self.stored_MWsqrtG = OrderedDict()
-        self.stored_MWsqrtGinverse = OrderedDict()
+        self.cache = ICCache()
 
     def addConstraint(self, cPrim, cVal):
         raise NotImplementedError("Constraints not supported with Cartesian coordinates")
@@ -1814,60 +2611,93 @@ class InternalCoordinates(object):
         raise NotImplementedError("Constraints not supported with Cartesian coordinates")
 
     def clearCache(self):
-        self.stored_wilsonB = OrderedDict()
-        self.stored_Ginverse = OrderedDict()
-        self.stored_MWsqrtG = OrderedDict()
-        self.stored_MWsqrtGinverse = OrderedDict()
+        self.cache.clear()
 
     def trimCache(self):
-        # Only keep the latest (maxCacheSize) values in the caches
-        maxCacheSize = 50
-        while len(self.stored_wilsonB) > maxCacheSize:
-            self.stored_wilsonB.popitem(last=False)
-        while len(self.stored_Ginverse) > maxCacheSize:
-            self.stored_Ginverse.popitem(last=False)
-        while len(self.stored_MWsqrtG) > maxCacheSize:
-            self.stored_MWsqrtG.popitem(last=False)
-        while len(self.stored_MWsqrtGinverse) > maxCacheSize:
-            self.stored_MWsqrtGinverse.popitem(last=False)
+        # Evict the least recently used values until the cache fits in its memory budget
+        self.cache.trim()
+
+    def setCacheBudget(self, nbytes):
+        """ Set the memory budget (in bytes) of the cache of coordinate-dependent quantities. """
+        self.cache.budget = nbytes
+        self.cache.trim()
+
+    def cacheStats(self):
+        """ Return the cache counters of this coordinate system, summed with any it contains. """
+        return self.cache.stats()
 
     def wilsonB(self, xyz):
         """
         Given Cartesian coordinates xyz, return the Wilson B-matrix
         given by dq_i/dx_j where x is flattened (i.e. x1, y1, z1, x2, y2, z2)
         """
-        global CacheWarning
-        t0 = time.time()
-        xhash = hash(xyz.tobytes())
-        ht = time.time() - t0
-        if xhash in self.stored_wilsonB:
-            ans = self.stored_wilsonB[xhash]
-            # logger.info("Using cached B-matrix : %i from end\n" % (len(self.stored_wilsonB) - list(self.stored_wilsonB.keys()).index(xhash)))
+        ans = self.cache.get('wilsonB', xyz)
+        if ans is not None:
             return ans
         WilsonB = []
         Der = self.derivatives(xyz)
         for i in range(Der.shape[0]):
             WilsonB.append(Der[i].flatten())
-        self.stored_wilsonB[xhash] = np.array(WilsonB)
-        self.trimCache()
-        if len(self.stored_wilsonB) > 1000 and not CacheWarning:
-            logger.warning("\x1b[91mWarning: more than 1000 B-matrices stored, memory leaks likely\x1b[0m\n")
-            CacheWarning = True
+        self.cache.put('wilsonB', xyz, np.array(WilsonB))
         ans = np.array(WilsonB)
         return ans
 
+    def wilsonB_sparse(self, xyz):
+        """
+        Given Cartesian coordinates xyz, return the Wilson B-matrix as a
+        scipy.sparse CSR matrix that only stores the atoms touched by each
+        internal coordinate.  Coordinate systems that do not have a sparse
+        implementation return the dense B-matrix; callers should only use
+        operations supported by both (e.g. Bmat.dot(), Bmat.T).
+        """
+        if not hasattr(self, 'sparse_derivatives'):
+            return self.wilsonB(xyz)
+        ans = self.cache.get('wilsonB_sparse', xyz)
+        if ans is not None:
+            return ans
+        ans = self.sparse_derivatives(xyz)
+        self.cache.put('wilsonB_sparse', xyz, ans)
+        return ans
+
+    def getB(self, xyz):
+        """ Return the sparse B-matrix if enabled by self.sparse, otherwise the dense one. """
+        if self.sparse:
+            return self.wilsonB_sparse(xyz)
+        return self.wilsonB(xyz)
+
+    def wilsonB_operator(self, xyz, MW=False):
+        """
+        Return the Wilson B-matrix as a WilsonBOperator that computes products with B and B^T
+        from the sparse B-matrix (if available) without forming the dense matrix.
+        If MW is True, the B-matrix is mass-weighted as in GMatrix().
+        """
+        return WilsonBOperator(self.wilsonB_sparse(xyz), scale=1.0/np.sqrt(self.mass) if MW else None)
+
+    def getBProducts(self, xyz):
+        """
+        Return the B-matrix for calcGrad() and newCartesian(), which only compute products
+        with B and B^T: a linear operator if self.sparse is enabled, otherwise the dense B-matrix.
+        """
+        if self.sparse:
+            return self.wilsonB_operator(xyz)
+        return self.wilsonB(xyz)
+
     def GMatrix(self, xyz, MW=False):
         """
         Given Cartesian coordinates xyz, return the G-matrix
         given by G = BuBt where u is an arbitrary matrix (default to identity)
         """
-        Bmat = self.wilsonB(xyz)
+        Bmat = self.getB(xyz)
+        if scipy.sparse.issparse(Bmat):
+            if MW:
+                Bmat = scipy.sparse.csr_matrix(Bmat.multiply(1.0/np.sqrt(self.mass)[np.newaxis, :]))
+            return Bmat.dot(Bmat.T).toarray()
         if MW:
             """
             Mass-weighted B matrix is used for the IRC method
             Gonzalez & Schlegel. J. Phys. Chem. 1990, 94, 5523-5527
             """
-            Bmat /= np.tile(np.sqrt(self.mass), (len(self.Internals), 1))
+            Bmat = Bmat / np.sqrt(self.mass)[np.newaxis, :]
         BuBt = np.dot(Bmat,Bmat.T)
         return BuBt
 
@@ -1880,24 +2710,23 @@ class InternalCoordinates(object):
         """
         # Perform singular value decomposition
         # GInverse Caching
-        global CacheWarning
-        xhash = hash(xyz.tobytes())
-        if xhash in self.stored_Ginverse and xhash in self.stored_MWsqrtGinverse:
-            Inv = self.stored_Ginverse[xhash]
-            Sqrt = self.stored_MWsqrtG[xhash]
-            # logger.info("Using cached G-inverse : %i from end\n" % (len(self.stored_Ginverse) - list(self.stored_Ginverse.keys()).index(xhash)))
+        cached = self.cache.get('MWGInverse_Sqrt', xyz)
+        if cached is not None:
+            Inv, Sqrt = cached
         else:
             click()
             loops = 0
+            # Perturbed coordinates are only used to retry the SVD; results are stored for xyz
+            xyz1 = xyz
             while True:
                 try:
-                    G = self.GMatrix(xyz, MW=True)
+                    G = self.GMatrix(xyz1, MW=True)
                     time_G = click()
                     U, S, VT = np.linalg.svd(G)
                     time_svd = click()
                 except np.linalg.LinAlgError:
                     logger.warning("\x1b[1;91m SVD fails, perturbing coordinates and trying again\x1b[0m\n")
-                    xyz = xyz + 1e-2 * np.random.random(xyz.shape)
+                    xyz1 = xyz1 + 1e-2 * np.random.random(xyz.shape)
                     loops += 1
                     if loops == 10:
                         raise RuntimeError('SVD failed too many times')
@@ -1923,16 +2752,7 @@ class InternalCoordinates(object):
 
             Sinv = np.diag(Sinv)
             Inv = multi_dot([V, Sinv, UT])
-
-        self.stored_MWsqrtG[xhash] = Sqrt
-        self.stored_MWsqrtGinverse[xhash] = Inv
-        self.trimCache()
-        if len(self.stored_MWsqrtG) > 10000 and not CacheWarning:
-            logger.warning("\x1b[91mWarning: more than 10000 G-inverses stored, memory leaks likely\x1b[0m\n")
-            CacheWarning = True
-        if len(self.stored_MWsqrtGinverse) > 10000 and not CacheWarning:
-            logger.warning("\x1b[91mWarning: more than 10000 sqrt(G)-inverses stored, memory leaks likely\x1b[0m\n")
-            CacheWarning = True
+            self.cache.put('MWGInverse_Sqrt', xyz, (Inv, Sqrt))
 
         # Sqrt of the G matrix is used to calculate gradients and Hessian in mass-weighted IC.
         return Inv, Sqrt
@@ -1941,52 +2761,110 @@ class InternalCoordinates(object):
         xyz = xyz.reshape(-1,3)
         # Perform singular value decomposition
         # GInverse Caching
-        global CacheWarning
-        xhash = hash(xyz.tobytes())
-        if xhash in self.stored_Ginverse:
-            Inv = self.stored_Ginverse[xhash]
-            # logger.info("Using cached G-inverse : %i from end\n" % (len(self.stored_Ginverse) - list(self.stored_Ginverse.keys()).index(xhash)))
-        else: 
+        Inv = self.cache.get('GInverse', xyz)
+        if Inv is None:
             click()
             loops = 0
+            # Perturbed coordinates are only used to retry the SVD; results are stored for xyz
+            xyz1 = xyz
             while True:
                 try:
-                    G = self.GMatrix(xyz)
+                    G = self.GMatrix(xyz1)
                     time_G = click()
                     U, S, VT = np.linalg.svd(G)
                     time_svd = click()
                 except np.linalg.LinAlgError:
                     logger.warning("\x1b[1;91m SVD fails, perturbing coordinates and trying again\x1b[0m\n")
-                    xyz = xyz + 1e-2*np.random.random(xyz.shape)
+                    xyz1 = xyz1 + 1e-2*np.random.random(xyz.shape)
                     loops += 1
                     if loops == 10:
                         raise RuntimeError('SVD failed too many times')
                     continue
                 break
             # print "Build G: %.3f SVD: %.3f" % (time_G, time_svd),
-            V = VT.T
-            UT = U.T
+            # Invert the singular values above the threshold and scale the columns of V
+            # instead of multiplying by a diagonal matrix.
+            large = np.abs(S) > 1e-6
             Sinv = np.zeros_like(S)
-            LargeVals = 0
-            for ival, value in enumerate(S):
-                # print "%.5e % .5e" % (ival,value)
-                if np.abs(value) > 1e-6:
-                    LargeVals += 1
-                    Sinv[ival] = 1/value
-
-            # print "%i atoms; %i/%i singular values are > 1e-6" % (xyz.shape[0], LargeVals, len(S))
+            Sinv[large] = 1/S[large]
+            # print "%i atoms; %i/%i singular values are > 1e-6" % (xyz.shape[0], np.sum(large), len(S))
+            Inv = np.dot(VT.T*Sinv, U.T)
+            self.cache.put('GInverse', xyz, Inv)
+        return Inv
 
-            Sinv = np.diag(Sinv)
-            Inv = multi_dot([V, Sinv, UT])
-       
+    def GFactor(self, xyz):
+        """
+        Factorize the G-matrix at xyz for repeated solves, using the method in self.gsolver.
 
-        self.stored_Ginverse[xhash] = Inv
-        self.trimCache()
-        if len(self.stored_Ginverse) > 10000 and not CacheWarning:
-            logger.warning("\x1b[91mWarning: more than 10000 G-inverses stored, memory leaks likely\x1b[0m\n")
-            CacheWarning = True
+        Returns
+        -------
+        kind : str
+            'inv' (explicit pseudo-inverse from GInverse), 'chol' (Cholesky factor),
+            'eigh' (eigenvectors and inverse eigenvalues for eigenvalues above 1e-6)
+            or 'lsqr' (the B-matrix itself, for iterative solves)
+        data : object
+            The factorization in the format expected by GSolve()
+        """
+        if self.gsolver == 'svd':
+            return 'inv', self.GInverse(xyz)
+        elif self.gsolver == 'lsqr':
+            return 'lsqr', self.getBProducts(xyz)
+        factor = self.cache.get('GFactor', xyz)
+        if factor is not None:
+            return factor
+        G = self.GMatrix(xyz)
+        factor = None
+        if self.gsolver == 'chol':
+            # Cholesky is only valid for nonredundant coordinates (e.g. DLCs) where G is
+            # well-conditioned; otherwise fall back to the eigendecomposition.
+            try:
+                cho = scipy.linalg.cho_factor(G)
+                if np.min(np.abs(np.diag(cho[0])))**2 > 1e-6:
+                    factor = ('chol', cho)
+            except np.linalg.LinAlgError:
+                pass
+        if factor is None:
+            L, Q = np.linalg.eigh(G)
+            large = np.abs(L) > 1e-6
+            factor = ('eigh', (Q[:, large], 1.0/L[large]))
+        self.cache.put('GFactor', xyz, factor)
+        return factor
+
+    def GSolve(self, xyz, rhs, factor=None):
+        """
+        Return G^-1 * rhs without forming the inverse (unless self.gsolver is 'svd'),
+        where G^-1 is the pseudo-inverse over the nonsingular subspace of G.
 
-        return Inv
+        Parameters
+        ----------
+        xyz : np.ndarray
+            Cartesian coordinates in a.u.
+        rhs : np.ndarray
+            Flat array with one element per internal coordinate
+        factor : tuple, optional
+            Factorization returned by GFactor(), possibly from a nearby geometry
+        """
+        if factor is None:
+            factor = self.GFactor(xyz)
+        kind, data = factor
+        if kind == 'inv':
+            return np.dot(data, rhs)
+        elif kind == 'chol':
+            return scipy.linalg.cho_solve(data, rhs)
+        elif kind == 'eigh':
+            Q, Linv = data
+            return np.dot(Q, Linv*np.dot(Q.T, rhs))
+        elif kind == 'lsqr':
+            # G^-1 = pinv(B^T) pinv(B) using two least-squares solves
+            return self.solveLSQR(data.T, self.solveLSQR(data, rhs))
+        raise RuntimeError("Unknown G-matrix factorization %s" % kind)
+
+    def solveLSQR(self, A, b):
+        """
+        Minimum-norm least-squares solution of A*x = b by LSQR, which equals
+        pinv(A)*b and only requires products with A and its transpose.
+        """
+        return scipy.sparse.linalg.lsqr(A, b, atol=1e-12, btol=1e-12)[0]
 
     def GInverse_EIG(self, xyz): # pragma: no cover
         # Currently unused function, but could possibly speed up calculations
@@ -2093,13 +2971,27 @@ class InternalCoordinates(object):
         
     def calcGrad(self, xyz, gradx):
         q0 = self.calculate(xyz)
-        Ginv = self.GInverse(xyz)
-        Bmat = self.wilsonB(xyz)
+        Bmat = self.getBProducts(xyz)
         # Internal coordinate gradient
         # Gq = np.matrix(Ginv)*np.matrix(Bmat)*np.matrix(gradx).T
-        Gq = multi_dot([Ginv, Bmat, gradx.T])
+        if self.gsolver == 'lsqr':
+            # Gq = G^-1 B gx is the least-squares solution of B^T Gq = gx
+            Gq = self.solveLSQR(Bmat.T, gradx.flatten())
+        else:
+            Gq = self.GSolve(xyz, Bmat.dot(gradx.flatten()))
         return Gq.flatten()
 
+    def contractSecondDerivatives(self, xyz, coeffs):
+        """
+        Return the sum over internal coordinates of coeffs[p] * d^2 q_p / dx^2
+        as a (3N, 3N) array.  This implementation builds the full second
+        derivative array; subclasses may accumulate it without doing so.
+        """
+        xyz = xyz.flatten()
+        deriv2 = self.second_derivatives(xyz)
+        Bmatp = deriv2.reshape(deriv2.shape[0], xyz.shape[0], xyz.shape[0])
+        return np.einsum('pmn,p->mn',Bmatp,coeffs)
+
     def calcHess(self, xyz, gradx, hessx):
         """
         Compute the internal coordinate Hessian. 
@@ -2110,9 +3002,7 @@ class InternalCoordinates(object):
         Ginv = self.GInverse(xyz)
         Bmat = self.wilsonB(xyz)
         Gq = self.calcGrad(xyz, gradx)
-        deriv2 = self.second_derivatives(xyz)
-        Bmatp = deriv2.reshape(deriv2.shape[0], xyz.shape[0], xyz.shape[0])
-        Hx_BptGq = hessx - np.einsum('pmn,p->mn',Bmatp,Gq)
+        Hx_BptGq = hessx - self.contractSecondDerivatives(xyz, Gq)
         Hq = np.einsum('ps,sm,mn,nr,rq', Ginv, Bmat, Hx_BptGq, Bmat.T, Ginv, optimize=True)
         return Hq
 
@@ -2123,9 +3013,7 @@ class InternalCoordinates(object):
         """
         xyz = xyz.flatten()
         Bmat = self.wilsonB(xyz)
-        deriv2 = self.second_derivatives(xyz)
-        Bmatp = deriv2.reshape(deriv2.shape[0], xyz.shape[0], xyz.shape[0])
-        BptGq = np.einsum('pmn,p->mn',Bmatp,gradq)
+        BptGq = self.contractSecondDerivatives(xyz, gradq)
         Hx = np.einsum('ai,ab,bj->ij', Bmat, hessq, Bmat, optimize=True)
         Hx += BptGq
         return Hx
@@ -2133,19 +3021,15 @@ class InternalCoordinates(object):
     def readCache(self, xyz, dQ):
         if not hasattr(self, 'stored_xyz'):
             return None
-        xyz = xyz.flatten()
-        dQ = dQ.flatten()
-        if np.linalg.norm(self.stored_xyz - xyz) < 1e-10:
-            if np.linalg.norm(self.stored_dQ - dQ) < 1e-10:
+        if geometry_token(xyz) == self.stored_xyz.token:
+            if geometry_token(dQ) == self.stored_dQ.token:
                 return self.stored_newxyz
         return None
 
     def writeCache(self, xyz, dQ, newxyz):
-        xyz = xyz.flatten()
-        dQ = dQ.flatten()
         newxyz = newxyz.flatten()
-        self.stored_xyz = xyz.copy()
-        self.stored_dQ = dQ.copy()
+        self.stored_xyz = as_geometry(xyz.flatten())
+        self.stored_dQ = as_geometry(dQ.flatten())
         self.stored_newxyz = newxyz.copy()
 
     def newCartesian(self, xyz, dQ, verbose=True):
@@ -2177,12 +3061,21 @@ class InternalCoordinates(object):
             self.writeCache(xyz, dQ, xyzsave)
             return xyzsave.flatten()
         fail_counter = 0
+        factor = None
         while True:
             microiter += 1
-            Bmat = self.wilsonB(xyz1)
-            Ginv = self.GInverse(xyz1)
+            Bmat = self.getBProducts(xyz1)
             # Get new Cartesian coordinates
-            dxyz = damp*multi_dot([Bmat.T,Ginv,dQ1.T])
+            if self.gsolver == 'lsqr':
+                # dx = B^T G^-1 dQ is the minimum-norm least-squares solution of B dx = dQ
+                dxyz = damp*self.solveLSQR(Bmat, dQ1.flatten())
+            else:
+                # The factorization of G may be reused while the geometry stays within
+                # self.greuse (RMS, in bohr) of where it was computed
+                if factor is None or np.sqrt(np.mean((xyz1-factor_xyz)**2)) >= self.greuse:
+                    factor = self.GFactor(xyz1)
+                    factor_xyz = xyz1.copy()
+                dxyz = damp*Bmat.T.dot(self.GSolve(xyz1, dQ1.flatten(), factor))
             xyz2 = xyz1 + np.array(dxyz).flatten()
             if microiter == 1:
                 xyzsave = xyz2.copy()
@@ -2246,6 +3139,160 @@ class InternalCoordinates(object):
         '''
         self._conmethod = val
 
+    @property
+    def sparse(self):
+        ''' Flag for using the sparse (CSR) Wilson B-matrix
+
+        Notes:
+            - Only the atoms touched by each primitive are stored, which makes
+              building B and G close to linear in the system size.
+            - For delocalized ICs the primitive B-matrix is sparse and
+              the DLC B-matrix is obtained from it by a sparse product.
+
+        Returns:
+            bool: True if the sparse B-matrix is used
+        '''
+        if hasattr(self, '_sparse'):
+            return self._sparse
+        return False
+
+    @sparse.setter
+    def sparse(self, val):
+        ''' set the flag for using the sparse B-matrix
+
+        Args:
+            val (bool): Whether to use the sparse B-matrix
+        '''
+        self._sparse = val
+
+    @property
+    def gsolver(self):
+        ''' Method for applying the inverse G-matrix in calcGrad and newCartesian
+
+        Notes:
+            - `svd`: Explicit pseudo-inverse from the SVD (original method)
+            - `eigh`: Eigendecomposition restricted to the nonsingular subspace
+            - `chol`: Cholesky factorization, falling back to `eigh` if G is singular
+            - `lsqr`: Iterative least-squares solves using the B-matrix only
+
+        Returns:
+            str: name of the method
+        '''
+        if hasattr(self, '_gsolver'):
+            return self._gsolver
+        return 'svd'
+
+    @gsolver.setter
+    def gsolver(self, val):
+        ''' set the method for applying the inverse G-matrix
+
+        Args:
+            val (str): One of 'svd', 'eigh', 'chol' or 'lsqr'
+        '''
+        if val not in ('svd', 'eigh', 'chol', 'lsqr'):
+            raise RuntimeError("gsolver must be one of svd, eigh, chol, lsqr (got %s)" % str(val))
+        self._gsolver = val
+
+    @property
+    def greuse(self):
+        ''' Threshold for reusing the G-matrix factorization in newCartesian
+
+        Notes:
+            - The factorization is reused across micro-iterations while the RMS
+              change in Cartesian coordinates (bohr) from where it was computed is
+              below this value; the step still uses the current B-matrix.
+            - `0.0` recomputes the factorization in every micro-iteration.
+
+        Returns:
+            float: RMS displacement threshold in bohr
+        '''
+        if hasattr(self, '_greuse'):
+            return self._greuse
+        return 0.0
+
+    @greuse.setter
+    def greuse(self, val):
+        ''' set the threshold for reusing the G-matrix factorization
+
+        Args:
+            val (float): RMS displacement threshold in bohr
+        '''
+        self._greuse = float(val)
+
+    @property
+    def dlcsolver(self):
+        ''' Method for finding the nonredundant space when building DLCs (valid for DLC only)
+
+        Notes:
+            - `eigh`: Diagonalize the (nprim x nprim) G-matrix (original method)
+            - `btb`: Diagonalize the (3N x 3N) matrix B^T.B and map its eigenvectors
+              back to the primitives, which is faster when nprim > 3N
+
+        Returns:
+            str: name of the method
+        '''
+        if hasattr(self, '_dlcsolver'):
+            return self._dlcsolver
+        return 'eigh'
+
+    @dlcsolver.setter
+    def dlcsolver(self, val):
+        ''' set the method for building DLCs
+
+        Args:
+            val (str): One of 'eigh' or 'btb'
+        '''
+        if val not in ('eigh', 'btb'):
+            raise RuntimeError("dlcsolver must be one of eigh, btb (got %s)" % str(val))
+        self._dlcsolver = val
+
+    @property
+    def blockdlc(self):
+        ''' Flag for building DLCs in blocks of primitives that don't share atoms (valid for DLC only)
+
+        Notes:
+            - For TRIC the blocks are usually the fragments; the DLC vectors are
+              stored block by block in VecBlocks and used in block products.
+            - Not used if there are constraints.
+
+        Returns:
+            bool: True if the DLCs are built in blocks
+        '''
+        if hasattr(self, '_blockdlc'):
+            return self._blockdlc
+        return False
+
+    @blockdlc.setter
+    def blockdlc(self, val):
+        ''' set the flag for building DLCs in blocks
+
+        Args:
+            val (bool): Whether to build the DLCs in blocks
+        '''
+        self._blockdlc = bool(val)
+
+    @property
+    def blockthreads(self):
+        ''' Number of threads for diagonalizing the G-matrix blocks when blockdlc is set
+
+        Returns:
+            int: number of threads
+        '''
+        if hasattr(self, '_blockthreads'):
+            return self._blockthreads
+        return 1
+
+    @blockthreads.setter
+    def blockthreads(self, val):
+        ''' set the number of threads for building DLCs in blocks
+
+        Args:
+            val (int): number of threads (at least 1)
+        '''
+        if int(val) < 1:
+            raise RuntimeError("blockthreads must be at least 1 (got %s)" % str(val))
+        self._blockthreads = int(val)
+
     @property
     def rigid(self):
         ''' Flag for rigid optimizations (valid for DLC only)
@@ -2286,18 +3333,178 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
         self.cVals = []
         self.Rotators = OrderedDict()
         self.elem = molecule.elem
+        # Evaluate primitives of the same type together (see PackedPrimitives)
+        self.packed = True
+        # Use the sparse B-matrix in GMatrix, calcGrad and newCartesian
+        self.sparse = kwargs.get('sparse', False)
+        # Method for applying G^-1 and threshold for reusing its factorization in newCartesian
+        self.gsolver = kwargs.get('gsolver', 'svd')
+        self.greuse = kwargs.get('greuse', 0.0)
         # Atomic mass array
         self.mass = np.repeat([PeriodicTable[i] for i in self.elem], 3)
         # List of fragments as determined by residue ID, distance criteria or bond order
         self.frags = []
+        # Bonds and choices of primitives made by makePrimitives() (see updatePrimitives)
+        self.primTopology = None
         for i in range(len(molecule)):
             self.makePrimitives(molecule[i], connect, addcart)
+        if len(molecule) > 1:
+            # The primitives of several structures cannot be updated for a single one
+            self.primTopology = None
         # Assume we're using the first image for constraints
         self.makeConstraints(molecule[0], constraints, cvals)
         # Reorder primitives for checking with cc's code in TC.
         # Note that reorderPrimitives() _must_ be updated with each new InternalCoordinate class written.
         self.reorderPrimitives()
 
+    def primitiveGraph(self, molecule):
+        """
+        Return the edges, fragments and noncovalent edges that makePrimitives() uses for the
+        first frame of a molecule, computed from its bonds without building its topology.
+
+        Parameters
+        ----------
+        molecule : Molecule
+            Molecule object whose bonds have been built
+
+        Returns
+        -------
+        edges : set
+            (i, j) tuples with i < j for the bonds, artificial bonds to isolated atoms and noncovalent edges
+        frags : list
+            Sorted list of atoms in each fragment
+        noncov : set
+            (i, j) tuples with i < j for the noncovalent edges (only if self.connect)
+        """
+        xyz = molecule.xyzs[0]
+        G = nx.Graph()
+        G.add_nodes_from(range(molecule.na))
+        G.add_edges_from((int(i), int(j)) for (i, j) in molecule.bonds)
+        if 'resid' in molecule.Data.keys():
+            # Connected pieces of each run of atoms with the same resID
+            frags = []
+            first = 0
+            for i in range(1, molecule.na+1):
+                if i == molecule.na or molecule.resid[i] != molecule.resid[first]:
+                    frags += [sorted(c) for c in nx.connected_components(G.subgraph(range(first, i)))]
+                    first = i
+        else:
+            if self.connect_isolated:
+                # Same as the artificial bonds to isolated atoms in makePrimitives()
+                for i in [i for i in range(molecule.na) if G.degree(i) == 0]:
+                    dist = np.sum((xyz - xyz[i])**2, axis=1)
+                    dist[i] = np.inf
+                    G.add_edge(i, int(np.argmin(dist)))
+            frags = [sorted(c) for c in nx.connected_components(G)]
+        noncov = set()
+        if self.connect:
+            noncov = set(e for e in euclidean_mst_edges(xyz) if not G.has_edge(*e))
+            G.add_edges_from(noncov)
+        edges = set((min(e), max(e)) for e in G.edges())
+        return edges, frags, noncov
+
+    def updatePrimitives(self, molecule):
+        """
+        Update the primitives in place for the bonds and geometry of a molecule (first frame),
+        adding and removing only the primitives affected by the changes since they were made.
+
+        The bond graph is compared with the one used to make the primitives.  The affected
+        primitives are the distances of bonds that were formed or broken, the angles,
+        out-of-plane and dihedral coordinates around the atoms of those bonds and of atoms
+        whose choice of out-of-plane coordinates changed, and the translations and rotations
+        of fragments that changed.  They are found and removed through the index of
+        self.Internals, then made again with the same code as makePrimitives().
+        Constraints are kept.  Almost-linear angles also change the lines of atoms and the
+        linear angle coordinates, so systems that have them are not updated here.
+
+        Parameters
+        ----------
+        molecule : Molecule
+            Molecule object whose bonds have been built; its topology is not needed
+
+        Returns
+        -------
+        bool or None
+            True if primitives were added or removed, False if the primitives are unchanged,
+            or None if the primitives could not be updated and should be made from scratch
+        """
+        old = self.primTopology
+        if old is None or len(old['linear']) > 0:
+            return None
+        coords = molecule.xyzs[0].flatten()
+        edges, frags, noncov = self.primitiveGraph(molecule)
+        linear, oop = primitive_choices(molecule.xyzs[0], edges)
+        formed = edges - old['edges']
+        broken = old['edges'] - edges
+        if formed or broken:
+            logger.info("Coordinate system check: %i bonds formed, %i bonds broken\n" % (len(formed), len(broken)))
+        if len(linear) > 0:
+            return None
+        new = {'edges': edges, 'frags': set(tuple(f) for f in frags), 'noncov': noncov, 'linear': linear, 'oop': oop}
+        # Atoms whose angles, out-of-plane and dihedral coordinates are made again
+        centers = set(itertools.chain(*(formed | broken)))
+        centers.update(o[0] for o in oop ^ old['oop'])
+        oldFrags = old['frags'] - new['frags']
+        newFrags = new['frags'] - old['frags']
+        self.primTopology = new
+        self.frags = frags
+        if not centers and not oldFrags and not newFrags:
+            return False
+        G0 = nx.Graph()
+        G0.add_nodes_from(range(molecule.na))
+        G0.add_edges_from(sorted(old['edges']))
+        G1 = nx.Graph()
+        G1.add_nodes_from(range(molecule.na))
+        G1.add_edges_from(sorted(edges))
+        # Primitives that makePrimitives() may have made from the old graph
+        stale = [Distance(a, b) for (a, b) in sorted(broken)]
+        for b in sorted(centers):
+            stale += [Angle(a, b, c) for a, c in itertools.combinations(sorted(G0.neighbors(b)), 2)]
+            for c in G0.neighbors(b):
+                stale += [Dihedral(a, b, c, d) for a in G0.neighbors(b) for d in G0.neighbors(c)
+                          if len({a, b, c, d}) == 4]
+        stale += [OutOfPlane(*o) for o in sorted(old['oop']) if o[0] in centers]
+        if not self.connect and not self.addcart:
+            for f in sorted(oldFrags):
+                if len(f) >= 2:
+                    w = np.ones(len(f))/len(f)
+                    stale += [TranslationX(list(f), w=w), TranslationY(list(f), w=w), TranslationZ(list(f), w=w),
+                              RotationA(f, coords * ang2bohr, self.Rotators),
+                              RotationB(f, coords * ang2bohr, self.Rotators),
+                              RotationC(f, coords * ang2bohr, self.Rotators)]
+                    del self.Rotators[f]
+                else:
+                    stale += [CartesianX(f[0], w=1.0), CartesianY(f[0], w=1.0), CartesianZ(f[0], w=1.0)]
+        before = set(id(p) for p in self.Internals)
+        deleted = []
+        for prim in stale:
+            if prim in self.Internals:
+                deleted.append(prim)
+                self.delete(prim)
+        # Make the primitives again from the new graph
+        for (a, b) in sorted(formed):
+            self.add(Distance(a, b))
+        if not self.connect and not self.addcart:
+            for f in sorted(newFrags):
+                self.addFragment(list(f), coords)
+        self.addAngles(G1, coords, noncov, self.connect, self.addcart, centers=sorted(centers))
+        self.addOutOfPlanes(G1, coords, noncov, centers=sorted(centers))
+        self.addDihedrals(G1, coords, noncov, sorted(set((min(e), max(e)) for e in G1.edges(sorted(centers)))))
+        for cPrim in self.cPrims:
+            if cPrim not in self.Internals:
+                self.Internals.append(cPrim)
+        added = [p for p in self.Internals if id(p) not in before]
+        deleted = PrimitiveList(deleted)
+        for prim in deleted:
+            if prim not in self.Internals:
+                logger.info("Deleting:" + str(prim) + "\n")
+        for prim in added:
+            if prim not in deleted:
+                logger.info("Adding:  " + str(prim) + "\n")
+        self.reorderPrimitives()
+        self.clearCache()
+        return len(deleted) > 0 or len(added) > 0
+
     def makePrimitives(self, molecule, connect, addcart):
         # force_bonds=False is set because we don't want to override
         # bond order-based bonds that may have been obtained earlier.
@@ -2338,18 +3545,9 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
             
         # coordinates in Angstrom
         coords = molecule.xyzs[0].flatten()
-        # Make a distance matrix mapping atom pairs to interatomic distances
-        AtomIterator, dxij = molecule.distance_matrix(pbc=False)
-        D = {}
-        for i, j in zip(AtomIterator, dxij[0]):
-            assert i[0] < i[1]
-            D[tuple(i)] = j
-        dgraph = nx.Graph()
-        for i in range(molecule.na):
-            dgraph.add_node(i)
-        for k, v in D.items():
-            dgraph.add_edge(k[0], k[1], weight=v)
-        mst = sorted(list(nx.minimum_spanning_edges(dgraph, data=False)))
+        # Minimum spanning tree of the interatomic distances, built from neighbor lists
+        mst = euclidean_mst_edges(molecule.xyzs[0])
+        topology_edges = set(molecule.topology.edges())
         # Build a list of noncovalent distances
         noncov = []
         # Connect all non-bonded fragments together
@@ -2360,7 +3558,7 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
             # dipeptide case (from OpenFF). To "fix" the bug add the following 
             # clause to the if statement on the next line:
             # and not nx.has_path(molecule.topology, edge[0], edge[1]):
-            if edge not in list(molecule.topology.edges()):
+            if edge not in topology_edges:
                 # print "Adding %s from minimum spanning tree" % str(edge)
                 if connect:
                     molecule.topology.add_edge(edge[0], edge[1])
@@ -2373,22 +3571,7 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
                     self.add(CartesianZ(i, w=1.0))
             else:
                 for i in frags:
-                    if len(i) >= 2:
-                        self.add(TranslationX(i, w=np.ones(len(i))/len(i)))
-                        self.add(TranslationY(i, w=np.ones(len(i))/len(i)))
-                        self.add(TranslationZ(i, w=np.ones(len(i))/len(i)))
-                        # Reference coordinates are given in Bohr.
-                        sel = coords.reshape(-1,3)[i,:] * ang2bohr
-                        sel -= np.mean(sel, axis=0)
-                        rg = np.sqrt(np.mean(np.sum(sel**2, axis=1)))
-                        self.add(RotationA(i, coords * ang2bohr, self.Rotators, w=rg))
-                        self.add(RotationB(i, coords * ang2bohr, self.Rotators, w=rg))
-                        self.add(RotationC(i, coords * ang2bohr, self.Rotators, w=rg))
-                    else:
-                        for j in i:
-                            self.add(CartesianX(j, w=1.0))
-                            self.add(CartesianY(j, w=1.0))
-                            self.add(CartesianZ(j, w=1.0))
+                    self.addFragment(i, coords)
         if False: # Add an overall translation/rotation coordinate.
             i = range(molecule.na)
             self.add(TranslationX(i, w=np.ones(len(i))/len(i)))
@@ -2442,67 +3625,12 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
         for (a, b) in molecule.topology.edges():
             self.add(Distance(a, b))
 
+        # Angles, linear angles and out-of-plane coordinates around each atom
+        self.addAngles(molecule.topology, coords, noncov, connect, addcart)
+        self.addOutOfPlanes(molecule.topology, coords, noncov)
+
         # Linear angle threshold - corresponds to about 162 degrees.
         LinThre   = 0.95
-        AngDict = defaultdict(list)
-        for b in molecule.topology.nodes():
-            for a in molecule.topology.neighbors(b):
-                for c in molecule.topology.neighbors(b):
-                    if a < c:
-                        # if (a, c) in molecule.topology.edges() or (c, a) in molecule.topology.edges(): continue
-                        Ang = Angle(a, b, c)
-                        nnc = (min(a, b), max(a, b)) in noncov
-                        nnc += (min(b, c), max(b, c)) in noncov
-                        # if nnc >= 2: continue
-                        # logger.info(" >>> Linear angle check: %3i %3i %3i % .3f % .3f %s\n" % (a, b, c, Ang.value(coords)*180/np.pi, np.cos(Ang.value(coords)), str(np.abs(np.cos(Ang.value(coords))) > LinThre)))
-                        if np.abs(np.cos(Ang.value(coords))) < LinThre:
-                            self.add(Angle(a, b, c))
-                            AngDict[b].append(Ang)
-                        elif connect or not addcart:
-                            # logger.info("Adding linear angle")
-                            # Add linear angle IC's
-                            # LPW 2019-02-16: Linear angle ICs work well for "very" linear angles in molecules (e.g. HCCCN)
-                            # but do not work well for "almost" linear angles in noncovalent systems (e.g. H2O6).
-                            # Bringing back old code to use "translations" for the latter case, but should be investigated
-                            # more deeply in the future.
-                            # LPW 2022-02-15: Linear angle ICs have been improved, and should no longer require resetting if the
-                            # atoms in the angle go through a large rotation. They are currently being used.
-                            if nnc == 0:
-                                self.add(LinearAngle(a, b, c, 0))
-                                self.add(LinearAngle(a, b, c, 1))
-                            else:
-                                # Unit vector connecting atoms a and c
-                                nac = molecule.xyzs[0][c] - molecule.xyzs[0][a]
-                                nac /= np.linalg.norm(nac)
-                                # Dot products of this vector with the Cartesian axes
-                                dots = [np.abs(np.dot(ei, nac)) for ei in np.eye(3)]
-                                # Functions for adding Cartesian coordinate
-                                # carts = [CartesianX, CartesianY, CartesianZ]
-                                trans = [TranslationX, TranslationY, TranslationZ]
-                                w = np.array([-1.0, 2.0, -1.0])
-                                # Add two of the most perpendicular Cartesian coordinates
-                                for i in np.argsort(dots)[:2]:
-                                    self.add(trans[i]([a, b, c], w=w))
-                            
-        for b in molecule.topology.nodes():
-            for a in molecule.topology.neighbors(b):
-                for c in molecule.topology.neighbors(b):
-                    for d in molecule.topology.neighbors(b):
-                        if a < c < d:
-                            nnc = (min(a, b), max(a, b)) in noncov
-                            nnc += (min(b, c), max(b, c)) in noncov
-                            nnc += (min(b, d), max(b, d)) in noncov
-                            # if nnc >= 1: continue
-                            for i, j, k in sorted(list(itertools.permutations([a, c, d], 3))):
-                                Ang1 = Angle(b,i,j)
-                                Ang2 = Angle(i,j,k)
-                                if np.abs(np.cos(Ang1.value(coords))) > LinThre: continue
-                                if np.abs(np.cos(Ang2.value(coords))) > LinThre: continue
-                                if np.abs(np.dot(Ang1.normal_vector(coords), Ang2.normal_vector(coords))) > LinThre:
-                                    self.delete(Angle(i, b, j))
-                                    self.add(OutOfPlane(b, i, j, k))
-                                    break
-                                
         # Find groups of atoms that are in straight lines
         atom_lines = [list(i) for i in molecule.topology.edges()]
         while True:
@@ -2540,27 +3668,13 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
         #     print "Lines of three or more atoms:", ', '.join(['-'.join(["%i" % (i+1) for i in l]) for l in lthree])
 
         # Normal dihedral code
-        for aline in atom_lines_uniq:
-            # Go over ALL pairs of atoms in a line
-            for (b, c) in itertools.combinations(aline, 2):
-                if b > c: (b, c) = (c, b)
-                # Go over all neighbors of b
-                for a in molecule.topology.neighbors(b):
-                    # Go over all neighbors of c
-                    for d in molecule.topology.neighbors(c):
-                        # Make sure the end-atoms are not in the line and not the same as each other
-                        if a not in aline and d not in aline and a != d:
-                            nnc = (min(a, b), max(a, b)) in noncov
-                            nnc += (min(b, c), max(b, c)) in noncov
-                            nnc += (min(c, d), max(c, d)) in noncov
-                            # print aline, a, b, c, d
-                            Ang1 = Angle(a,b,c)
-                            Ang2 = Angle(b,c,d)
-                            # Eliminate dihedrals containing angles that are almost linear
-                            # (should be eliminated already)
-                            if np.abs(np.cos(Ang1.value(coords))) > LinThre: continue
-                            if np.abs(np.cos(Ang2.value(coords))) > LinThre: continue
-                            self.add(Dihedral(a, b, c, d))
+        self.addDihedrals(molecule.topology, coords, noncov, atom_lines_uniq)
+
+        # Bonds and choices of primitives, used for updating the primitives incrementally (see updatePrimitives)
+        linear, oop = primitive_choices(molecule.xyzs[0], molecule.topology.edges())
+        self.primTopology = {'edges': set((min(e), max(e)) for e in molecule.topology.edges()),
+                             'frags': set(tuple(sorted(f)) for f in frags),
+                             'noncov': set(noncov), 'linear': linear, 'oop': oop}
 
         ### Following are codes that evaluate angles and dihedrals involving entire lines-of-atoms
         ### as single degrees of freedom
@@ -2634,6 +3748,132 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
         #                 self.delete(Dihedral(al[-1], b, c, dl[0]))
         #                 self.add(MultiDihedral(al, b, c, dl))
 
+    def addFragment(self, frag, coords):
+        """
+        Add the translation and rotation coordinates of a fragment, or the Cartesian
+        coordinates of a single atom.  coords are given in Angstrom.
+        """
+        i = frag
+        if len(i) >= 2:
+            self.add(TranslationX(i, w=np.ones(len(i))/len(i)))
+            self.add(TranslationY(i, w=np.ones(len(i))/len(i)))
+            self.add(TranslationZ(i, w=np.ones(len(i))/len(i)))
+            # Reference coordinates are given in Bohr.
+            sel = coords.reshape(-1,3)[i,:] * ang2bohr
+            sel -= np.mean(sel, axis=0)
+            rg = np.sqrt(np.mean(np.sum(sel**2, axis=1)))
+            self.add(RotationA(i, coords * ang2bohr, self.Rotators, w=rg))
+            self.add(RotationB(i, coords * ang2bohr, self.Rotators, w=rg))
+            self.add(RotationC(i, coords * ang2bohr, self.Rotators, w=rg))
+        else:
+            for j in i:
+                self.add(CartesianX(j, w=1.0))
+                self.add(CartesianY(j, w=1.0))
+                self.add(CartesianZ(j, w=1.0))
+
+    def addAngles(self, topology, coords, noncov, connect, addcart, centers=None):
+        """
+        Add the angles between neighbors of each of the central atoms (default: all atoms)
+        in the topology graph.  Almost-linear angles are replaced by linear angle coordinates,
+        or by translations if they contain noncovalent edges.  coords are given in Angstrom.
+        """
+        # Linear angle threshold - corresponds to about 162 degrees.
+        LinThre   = 0.95
+        for b in (topology.nodes() if centers is None else centers):
+            for a in topology.neighbors(b):
+                for c in topology.neighbors(b):
+                    if a < c:
+                        # if (a, c) in molecule.topology.edges() or (c, a) in molecule.topology.edges(): continue
+                        Ang = Angle(a, b, c)
+                        nnc = (min(a, b), max(a, b)) in noncov
+                        nnc += (min(b, c), max(b, c)) in noncov
+                        # if nnc >= 2: continue
+                        # logger.info(" >>> Linear angle check: %3i %3i %3i % .3f % .3f %s\n"
+                        #             % (a, b, c, Ang.value(coords)*180/np.pi, np.cos(Ang.value(coords)),
+                        #                str(np.abs(np.cos(Ang.value(coords))) > LinThre)))
+                        if np.abs(np.cos(Ang.value(coords))) < LinThre:
+                            self.add(Angle(a, b, c))
+                        elif connect or not addcart:
+                            # logger.info("Adding linear angle")
+                            # Add linear angle IC's
+                            # LPW 2019-02-16: Linear angle ICs work well for "very" linear angles in molecules
+                            # (e.g. HCCCN) but do not work well for "almost" linear angles in noncovalent systems
+                            # (e.g. H2O6). Bringing back old code to use "translations" for the latter case, but
+                            # should be investigated more deeply in the future.
+                            # LPW 2022-02-15: Linear angle ICs have been improved, and should no longer require
+                            # resetting if the atoms in the angle go through a large rotation. They are currently
+                            # being used.
+                            if nnc == 0:
+                                self.add(LinearAngle(a, b, c, 0))
+                                self.add(LinearAngle(a, b, c, 1))
+                            else:
+                                # Unit vector connecting atoms a and c
+                                nac = coords.reshape(-1,3)[c] - coords.reshape(-1,3)[a]
+                                nac /= np.linalg.norm(nac)
+                                # Dot products of this vector with the Cartesian axes
+                                dots = [np.abs(np.dot(ei, nac)) for ei in np.eye(3)]
+                                # Functions for adding Cartesian coordinate
+                                # carts = [CartesianX, CartesianY, CartesianZ]
+                                trans = [TranslationX, TranslationY, TranslationZ]
+                                w = np.array([-1.0, 2.0, -1.0])
+                                # Add two of the most perpendicular Cartesian coordinates
+                                for i in np.argsort(dots)[:2]:
+                                    self.add(trans[i]([a, b, c], w=w))
+
+    def addOutOfPlanes(self, topology, coords, noncov, centers=None):
+        """
+        Replace an angle with an out-of-plane coordinate for each set of three neighbors
+        of the central atoms (default: all atoms) that are close to planar.
+        Must be called after addAngles() for the same central atoms.
+        """
+        LinThre   = 0.95
+        for b in (topology.nodes() if centers is None else centers):
+            for a in topology.neighbors(b):
+                for c in topology.neighbors(b):
+                    for d in topology.neighbors(b):
+                        if a < c < d:
+                            nnc = (min(a, b), max(a, b)) in noncov
+                            nnc += (min(b, c), max(b, c)) in noncov
+                            nnc += (min(b, d), max(b, d)) in noncov
+                            # if nnc >= 1: continue
+                            for i, j, k in sorted(list(itertools.permutations([a, c, d], 3))):
+                                Ang1 = Angle(b,i,j)
+                                Ang2 = Angle(i,j,k)
+                                if np.abs(np.cos(Ang1.value(coords))) > LinThre: continue
+                                if np.abs(np.cos(Ang2.value(coords))) > LinThre: continue
+                                if np.abs(np.dot(Ang1.normal_vector(coords), Ang2.normal_vector(coords))) > LinThre:
+                                    self.delete(Angle(i, b, j))
+                                    self.add(OutOfPlane(b, i, j, k))
+                                    break
+
+    def addDihedrals(self, topology, coords, noncov, atom_lines):
+        """
+        Add the dihedral angles around each line of atoms (a single bond is a line of two atoms),
+        skipping those that contain almost-linear angles.
+        """
+        LinThre   = 0.95
+        for aline in atom_lines:
+            # Go over ALL pairs of atoms in a line
+            for (b, c) in itertools.combinations(aline, 2):
+                if b > c: (b, c) = (c, b)
+                # Go over all neighbors of b
+                for a in topology.neighbors(b):
+                    # Go over all neighbors of c
+                    for d in topology.neighbors(c):
+                        # Make sure the end-atoms are not in the line and not the same as each other
+                        if a not in aline and d not in aline and a != d:
+                            nnc = (min(a, b), max(a, b)) in noncov
+                            nnc += (min(b, c), max(b, c)) in noncov
+                            nnc += (min(c, d), max(c, d)) in noncov
+                            # print aline, a, b, c, d
+                            Ang1 = Angle(a,b,c)
+                            Ang2 = Angle(b,c,d)
+                            # Eliminate dihedrals containing angles that are almost linear
+                            # (should be eliminated already)
+                            if np.abs(np.cos(Ang1.value(coords))) > LinThre: continue
+                            if np.abs(np.cos(Ang2.value(coords))) > LinThre: continue
+                            self.add(Dihedral(a, b, c, d))
+
     def makeConstraints(self, molecule, constraints, cvals):
         # Add the list of constraints. 
         xyz = molecule.xyzs[0].flatten() * ang2bohr
@@ -2782,7 +4022,42 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
                     return True
         return False
 
+    @property
+    def Internals(self):
+        ''' List of primitive internal coordinates, stored as a PrimitiveList
+        so that membership tests and lookups do not scan the list. '''
+        return self._Internals
+
+    @Internals.setter
+    def Internals(self, val):
+        self._Internals = val if isinstance(val, PrimitiveList) else PrimitiveList(val)
+
+    @property
+    def cPrims(self):
+        ''' List of constrained primitive internal coordinates (a PrimitiveList). '''
+        return self._cPrims
+
+    @cPrims.setter
+    def cPrims(self, val):
+        self._cPrims = val if isinstance(val, PrimitiveList) else PrimitiveList(val)
+
+    def packPrimitives(self):
+        """
+        Return the packed (grouped by type) representation of the primitives,
+        or None if packed evaluation is switched off.  The packing is rebuilt
+        whenever the list of primitives has changed.
+        """
+        if not getattr(self, 'packed', False):
+            return None
+        if getattr(self, 'stored_packing', None) is None or not self.stored_packing.matches(self.Internals):
+            self.stored_packing = PackedPrimitives(self.Internals)
+        return self.stored_packing
+
     def calculate(self, xyz):
+        xyz = as_geometry(xyz)
+        packing = self.packPrimitives()
+        if packing is not None:
+            return packing.calculate(xyz)
         answer = []
         for Internal in self.Internals:
             answer.append(Internal.value(xyz))
@@ -2804,7 +4079,11 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
             logger.info("Linear Angles: " + " ".join(["% .4f" % i for i in linAngs]) + "\n")
 
     def derivatives(self, xyz):
+        xyz = as_geometry(xyz)
         self.calculate(xyz)
+        packing = self.packPrimitives()
+        if packing is not None:
+            return packing.derivatives(xyz)
         answer = []
         for Internal in self.Internals:
             answer.append(Internal.derivative(xyz))
@@ -2814,7 +4093,26 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
         # 3) 3
         return np.array(answer)
 
+    def sparse_derivatives(self, xyz):
+        """ Return the first derivatives as a (nprim, 3*natoms) CSR matrix (the sparse Wilson B-matrix). """
+        xyz = as_geometry(xyz)
+        self.calculate(xyz)
+        packing = self.packPrimitives()
+        if packing is not None:
+            return packing.sparse_derivatives(xyz)
+        rows, cols, vals = [], [], []
+        for i, Internal in enumerate(self.Internals):
+            atoms, der = local_derivative(Internal, xyz)
+            rows.append(np.full(3*len(atoms), i, dtype=int))
+            cols.append((3*atoms[:, np.newaxis] + np.arange(3)).flatten())
+            vals.append(der.flatten())
+        if len(rows) == 0:
+            return scipy.sparse.csr_matrix((len(self.Internals), xyz.size))
+        return scipy.sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                       shape=(len(self.Internals), xyz.size))
+
     def second_derivatives(self, xyz):
+        xyz = as_geometry(xyz)
         self.calculate(xyz)
         answer = []
         for Internal in self.Internals:
@@ -2827,13 +4125,86 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
         # 5) 3
         return np.array(answer)
     
+    def contractSecondDerivatives(self, xyz, coeffs):
+        """
+        Return the sum over primitives of coeffs[p] * d^2 q_p / dx^2 as a (3N, 3N) array.
+        Each primitive's second derivatives are only evaluated for the atoms it depends on
+        and accumulated directly into the result, so memory use is O(N^2) instead of O(P*N^2).
+        """
+        xyz = as_geometry(xyz.flatten())
+        self.calculate(xyz)
+        answer = np.zeros((xyz.shape[0], xyz.shape[0]), dtype=float)
+        for Internal, c in zip(self.Internals, coeffs):
+            if c == 0.0: continue
+            atoms, deriv2 = local_second_derivative(Internal, xyz)
+            if len(atoms) == 0: continue
+            cols = (3*atoms[:, np.newaxis] + np.arange(3)).flatten()
+            answer[np.ix_(cols, cols)] += c*deriv2.reshape(len(cols), len(cols))
+        return answer
+
     def calcDiff(self, xyz1, xyz2):
         """ Calculate difference in internal coordinates (coord1-coord2), accounting for changes in 2*pi of angles. """
+        xyz1 = as_geometry(xyz1)
+        xyz2 = as_geometry(xyz2)
+        packing = self.packPrimitives()
+        if packing is not None:
+            return packing.calcDiff(xyz1, xyz2)
         answer = []
         for Internal in self.Internals:
             answer.append(Internal.calcDiff(xyz1, xyz2))
         return np.array(answer)
-    
+
+    def calculate_batch(self, xyzs):
+        """
+        Calculate the primitive ICs for several geometries at once.
+
+        Parameters
+        ----------
+        xyzs : np.ndarray
+            Cartesian coordinates of shape (nframes, 3*N) in a.u.
+
+        Returns
+        -------
+        np.ndarray
+            Values of the primitives with shape (nframes, nprim)
+        """
+        xyzs = np.asarray(xyzs, dtype=float).reshape(len(xyzs), -1)
+        packing = self.packPrimitives()
+        if packing is None:
+            return np.array([self.calculate(xyz) for xyz in xyzs]).reshape(len(xyzs), -1)
+        tiled = packing.tile(xyzs.shape[0], xyzs.shape[1]//3)
+        return tiled.calculate(xyzs.reshape(-1, 3)).reshape(xyzs.shape[0], -1)
+
+    def derivatives_batch(self, xyzs):
+        """
+        Calculate the first derivatives of the primitive ICs for several geometries at once.
+        Returns an array of shape (nframes, nprim, N, 3); see derivatives().
+        """
+        xyzs = np.asarray(xyzs, dtype=float).reshape(len(xyzs), -1)
+        nframes, na = xyzs.shape[0], xyzs.shape[1]//3
+        packing = self.packPrimitives()
+        if packing is None:
+            return np.array([self.derivatives(xyz) for xyz in xyzs]).reshape(nframes, -1, na, 3)
+        answer = np.zeros((nframes, len(self.Internals), na, 3), dtype=float)
+        tiled = packing.tile(nframes, na)
+        for rows, atoms, vals in tiled.derivative_blocks(xyzs.reshape(-1, 3)):
+            answer[rows // len(self.Internals), rows % len(self.Internals), atoms % na, :] = vals
+        return answer
+
+    def calcDiff_batch(self, xyzs1, xyzs2):
+        """
+        Calculate the differences in primitive ICs (xyzs1-xyzs2) for several pairs of geometries,
+        accounting for changes in 2*pi of angles.  xyzs2 may be a single geometry, which is used
+        as the reference for all frames in xyzs1.  Returns an array of shape (nframes, nprim).
+        """
+        xyzs1 = np.asarray(xyzs1, dtype=float).reshape(len(xyzs1), -1)
+        xyzs2 = np.broadcast_to(np.asarray(xyzs2, dtype=float).reshape(-1, xyzs1.shape[1]), xyzs1.shape)
+        packing = self.packPrimitives()
+        if packing is None:
+            return np.array([self.calcDiff(xyz1, xyz2) for xyz1, xyz2 in zip(xyzs1, xyzs2)]).reshape(len(xyzs1), -1)
+        tiled = packing.tile(xyzs1.shape[0], xyzs1.shape[1]//3)
+        return tiled.calcDiff(xyzs1.reshape(-1, 3), xyzs2.reshape(-1, 3)).reshape(xyzs1.shape[0], -1)
+
     def GInverse(self, xyz):
         return self.GInverse_SVD(xyz)
 
@@ -2842,9 +4213,8 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
             self.Internals.append(dof)
 
     def delete(self, dof):
-        for ii in range(len(self.Internals))[::-1]:
-            if dof == self.Internals[ii]:
-                del self.Internals[ii]
+        while dof in self.Internals:
+            self.Internals.remove(dof)
 
     def addConstraint(self, cPrim, cVal=None, xyz=None):
         if cVal is None and xyz is None:
@@ -2988,87 +4358,333 @@ class PrimitiveInternalCoordinates(InternalCoordinates):
         M.elem = list(elem_with_r)
         return M
             
-    def guess_hessian(self, coords):
+    def atomTable(self):
         """
-        Build a guess Hessian that roughly follows Schlegel's guidelines. 
+        Return arrays of the atomic numbers and covalent radii (in Angstrom) of the atoms.
+        These are computed once since the elements do not change.
+        """
+        if getattr(self, 'stored_atom_table', None) is None or len(self.stored_atom_table[0]) != len(self.elem):
+            znum = np.array([Elements.index(e) for e in self.elem], dtype=int)
+            self.stored_atom_table = (znum, np.array(Radii, dtype=float)[znum-1])
+        return self.stored_atom_table
+
+    def guess_hessian_diagonal(self, coords):
         """
+        Return the diagonal of the guess Hessian that roughly follows Schlegel's guidelines.
+        The values for each type of primitive are computed with array operations.
+
+        Parameters
+        ----------
+        coords : np.ndarray
+            Cartesian coordinates in a.u. with shape (3*N) or (nframes, 3*N)
+
+        Returns
+        -------
+        np.ndarray
+            Diagonal with shape (nprim) or (nframes, nprim)
+        """
+        coords = np.asarray(coords, dtype=float)
+        batch = coords.ndim == 2
+        nframes = coords.shape[0] if batch else 1
         xyzs = coords.reshape(-1,3)*bohr2ang
-        Hdiag = []
+        packing = self.packPrimitives()
+        if packing is None:
+            packing = PackedPrimitives(self.Internals)
+        if batch:
+            packing = packing.tile(nframes, xyzs.shape[0]//nframes)
+        znum, radii = [np.tile(arr, nframes) for arr in self.atomTable()]
+        def dist(a, b):
+            return np.sqrt(np.sum((xyzs[a]-xyzs[b])**2, axis=-1))
         def covalent(a, b):
-            r = np.linalg.norm(xyzs[a]-xyzs[b])
-            rcov = Radii[Elements.index(self.elem[a])-1] + Radii[Elements.index(self.elem[b])-1]
-            return r/rcov < 1.2
-        
-        for ic in self.Internals:
-            if type(ic) is Distance:
-                r = np.linalg.norm(xyzs[ic.a]-xyzs[ic.b]) * ang2bohr
-                elem1 = min(Elements.index(self.elem[ic.a]), Elements.index(self.elem[ic.b]))
-                elem2 = max(Elements.index(self.elem[ic.a]), Elements.index(self.elem[ic.b]))
-                A = 1.734
-                if elem1 < 3:
-                    if elem2 < 3:
-                        B = -0.244
-                    elif elem2 < 11:
-                        B = 0.352
-                    else:
-                        B = 0.660
-                elif elem1 < 11:
-                    if elem2 < 11:
-                        B = 1.085
-                    else:
-                        B = 1.522
-                else:
-                    B = 2.068
-                if covalent(ic.a, ic.b):
-                    Hdiag.append(A/(r-B)**3)
-                else:
-                    Hdiag.append(0.1)
-            elif type(ic) in [Angle, LinearAngle, MultiAngle]:
-                if type(ic) in [Angle, LinearAngle]:
-                    a = ic.a
-                    c = ic.c
-                else:
-                    a = ic.a[-1]
-                    c = ic.c[0]
-                if min(Elements.index(self.elem[a]),
-                       Elements.index(self.elem[ic.b]),
-                       Elements.index(self.elem[c])) < 3:
-                    A = 0.160
-                else:
-                    A = 0.250
-                if covalent(a, ic.b) and covalent(ic.b, c):
-                    Hdiag.append(A)
-                else:
-                    Hdiag.append(0.1)
-            elif type(ic) in [Dihedral, MultiDihedral]:
-                r = (np.linalg.norm(xyzs[ic.b]-xyzs[ic.c]))*ang2bohr
-                rcov = (Radii[Elements.index(self.elem[ic.b])-1] + Radii[Elements.index(self.elem[ic.c])-1])*ang2bohr
-                #Hdiag.append(min(0.023, 0.005 - 0.07*min(0.0, r-rcov)))
-                Hdiag.append(0.023)
-            elif type(ic) is OutOfPlane:
-                r1 = xyzs[ic.b]-xyzs[ic.a]
-                r2 = xyzs[ic.c]-xyzs[ic.a]
-                r3 = xyzs[ic.d]-xyzs[ic.a]
-                d = 1 - np.abs(np.dot(r1,cross_product(r2,r3))/np.linalg.norm(r1)/np.linalg.norm(r2)/np.linalg.norm(r3))
-                # Hdiag.append(0.1)
-                if covalent(ic.a, ic.b) and covalent(ic.a, ic.c) and covalent(ic.a, ic.d):
-                    Hdiag.append(0.045)
-                else:
-                    Hdiag.append(0.023)
-            elif type(ic) in [CartesianX, CartesianY, CartesianZ]:
-                Hdiag.append(0.05)
-            elif type(ic) in [TranslationX, TranslationY, TranslationZ, CentroidDistance]:
-                Hdiag.append(0.05)
-            elif type(ic) in [RotationA, RotationB, RotationC]:
-                Hdiag.append(0.05)
+            return dist(a, b)/(radii[a]+radii[b]) < 1.2
+        def bond(a, b):
+            r = dist(a, b) * ang2bohr
+            elem1 = np.minimum(znum[a], znum[b])
+            elem2 = np.maximum(znum[a], znum[b])
+            A = 1.734
+            B = np.select([(elem1 < 3) & (elem2 < 3), (elem1 < 3) & (elem2 < 11), elem1 < 3,
+                           (elem1 < 11) & (elem2 < 11), elem1 < 11], [-0.244, 0.352, 0.660, 1.085, 1.522], 2.068)
+            return np.where(covalent(a, b), A/(r-B)**3, 0.1)
+        def bend(a, b, c):
+            A = np.where(np.minimum(np.minimum(znum[a], znum[b]), znum[c]) < 3, 0.160, 0.250)
+            return np.where(covalent(a, b) & covalent(b, c), A, 0.1)
+        Hdiag = np.zeros(packing.nprim, dtype=float)
+        for group in packing.groups:
+            typ = group['type']
+            atoms = group['atoms']
+            if typ is Distance:
+                vals = bond(atoms[:, 0], atoms[:, 1])
+            elif typ in (Angle, LinearAngle):
+                vals = bend(atoms[:, 0], atoms[:, 1], atoms[:, 2])
+            elif typ is Dihedral:
+                vals = 0.023
+            elif typ is OutOfPlane:
+                a, b, c, d = atoms.T
+                vals = np.where(covalent(a, b) & covalent(a, c) & covalent(a, d), 0.045, 0.023)
+            else:
+                # Cartesian and translation coordinates
+                vals = 0.05
+            Hdiag[group['idx']] = vals
+        for i in packing.other:
+            ic = packing.prims[i]
+            offset = packing._frame(xyzs, i)[1]
+            if type(ic) is MultiAngle:
+                Hdiag[i] = bend(ic.a[-1]+offset, ic.b+offset, ic.c[0]+offset)
+            elif type(ic) is MultiDihedral:
+                Hdiag[i] = 0.023
+            elif type(ic) in [CentroidDistance, RotationA, RotationB, RotationC]:
+                Hdiag[i] = 0.05
             else:
                 raise RuntimeError('Failed to build guess Hessian matrix. Make sure all IC types are supported')
-        return np.diag(Hdiag)
+        if batch:
+            return Hdiag.reshape(nframes, -1)
+        return Hdiag
+
+    def guess_hessian(self, coords):
+        """
+        Build a guess Hessian that roughly follows Schlegel's guidelines. 
+        """
+        return np.diag(self.guess_hessian_diagonal(coords))
+
+
+class BlockVectors(object):
+    """
+    Block-sparse storage of the DLC vectors, used when the primitives separate into
+    sets that do not share any atoms (e.g. the fragments in TRIC).  Each block of DLCs
+    is a linear combination of the primitives in one set, so products with the vectors
+    only involve the primitives and atoms of each block.  Blocks of the same shape are
+    stacked (as in PackedPrimitives) and evaluated together.
+    """
+    def __init__(self, nprim, blocks):
+        """
+        Parameters
+        ----------
+        nprim : int
+            Number of primitives (rows of the full matrix)
+        blocks : list
+            List of (rows, atoms, vecs) tuples in the order of the DLCs, where rows are the
+            primitive indices, atoms are the atoms those primitives depend on and vecs is
+            the (len(rows), nDLC in block) array of coefficients
+        """
+        ncol = 0
+        groups = OrderedDict()
+        for rows, atoms, vecs in blocks:
+            key = (len(rows), vecs.shape[1], len(atoms))
+            group = groups.setdefault(key, {'rows':[], 'cols':[], 'atoms':[], 'vecs':[]})
+            group['rows'].append(rows)
+            group['cols'].append(np.arange(ncol, ncol+vecs.shape[1]))
+            group['atoms'].append(atoms)
+            group['vecs'].append(vecs)
+            ncol += vecs.shape[1]
+        self.groups = []
+        for (nr, nc, na), group in groups.items():
+            if nc == 0: continue
+            self.groups.append({'rows':np.array(group['rows'], dtype=int).reshape(-1, nr),
+                                'cols':np.array(group['cols'], dtype=int).reshape(-1, nc),
+                                'atoms':np.array(group['atoms'], dtype=int).reshape(-1, na),
+                                'vecs':np.array(group['vecs'], dtype=float).reshape(-1, nr, nc)})
+        self.nblocks = len(blocks)
+        self.shape = (nprim, ncol)
+
+    def toarray(self):
+        """ Return the vectors as a dense (nprim, nDLC) array. """
+        ans = np.zeros(self.shape, dtype=float)
+        for g in self.groups:
+            ans[g['rows'][:, :, np.newaxis], g['cols'][:, np.newaxis, :]] = g['vecs']
+        return ans
+
+    def tocsr(self):
+        """ Return the vectors as a (nprim, nDLC) CSR matrix. """
+        rows = np.concatenate([np.repeat(g['rows'], g['cols'].shape[1], axis=1).flatten() for g in self.groups])
+        cols = np.concatenate([np.tile(g['cols'], (1, g['rows'].shape[1])).flatten() for g in self.groups])
+        vals = np.concatenate([g['vecs'].flatten() for g in self.groups])
+        return scipy.sparse.csr_matrix((vals, (rows, cols)), shape=self.shape)
+
+    def rdot(self, X):
+        """ Return X.dot(V) for primitive values X of shape (..., nprim). """
+        ans = np.zeros(X.shape[:-1] + (self.shape[1],), dtype=float)
+        for g in self.groups:
+            ans[..., g['cols']] = np.einsum('...br,brc->...bc', X[..., g['rows']], g['vecs'])
+        return ans
+
+    def dot(self, c):
+        """ Return V.dot(c) for DLC coefficients c of shape (nDLC,) or (nDLC, k). """
+        ans = np.zeros((self.shape[0],) + c.shape[1:], dtype=float)
+        for g in self.groups:
+            ans[g['rows']] = np.einsum('brc,bc...->br...', g['vecs'], c[g['cols']])
+        return ans
+
+    def columns(self, cols):
+        """ Return the selected columns of V as a dense (nprim, len(cols)) array. """
+        return self.tocsr()[:, cols].toarray()
+
+    def tdot_derivatives(self, D):
+        """
+        Return the contraction of V with primitive derivatives D of shape (..., nprim, N, 3)
+        over the primitive index, i.e. the DLC derivatives of shape (..., nDLC, N, 3).
+        Only the atoms of each block are touched.
+        """
+        ans = np.zeros(D.shape[:-3] + (self.shape[1],) + D.shape[-2:], dtype=float)
+        for g in self.groups:
+            sub = D[..., g['rows'][:, :, np.newaxis], g['atoms'][:, np.newaxis, :], :]
+            ans[..., g['cols'][:, :, np.newaxis], g['atoms'][:, np.newaxis, :], :] = \
+                np.einsum('brc,...brak->...bcak', g['vecs'], sub)
+        return ans
+
+    def congruence_diag(self, h):
+        """ Return V^T.diag(h).V for a diagonal primitive matrix h of shape (nprim,). """
+        ans = np.zeros((self.shape[1], self.shape[1]), dtype=float)
+        for g in self.groups:
+            V = g['vecs']
+            ans[g['cols'][:, :, np.newaxis], g['cols'][:, np.newaxis, :]] = \
+                np.einsum('brc,br,brd->bcd', V, h[g['rows']], V)
+        return ans
+
+class WilsonBOperator(scipy.sparse.linalg.LinearOperator):
+    """
+    Wilson B-matrix of a coordinate system as a linear operator.  Products with B
+    (matvec, matmat) and B^T (rmatvec, rmatmat) are computed from the primitive B-matrix
+    (usually sparse) and the DLC vectors, so the dense B-matrix in the DLC basis is
+    never formed.  Selected rows can be obtained as a dense array with block().
+
+    The operator may be used anywhere a matrix is accepted only through products,
+    e.g. Bmat.dot(x), Bmat.T.dot(y) or scipy.sparse.linalg.lsqr(Bmat, y).
+    """
+    def __init__(self, Bprim, Vecs=None, scale=None):
+        """
+        Parameters
+        ----------
+        Bprim : scipy.sparse matrix or np.ndarray
+            (nprim, 3N) B-matrix of the primitive internal coordinates
+        Vecs : np.ndarray or BlockVectors, optional
+            (nprim, nDLC) DLC vectors; if not provided, the operator is in the primitive basis
+        scale : np.ndarray, optional
+            (3N,) factors multiplying the Cartesian columns of B, e.g. 1/sqrt(mass) for
+            the mass-weighted B-matrix
+        """
+        self.Bprim = Bprim
+        self.Vecs = Vecs
+        self.scale = scale
+        nrow = Bprim.shape[0] if Vecs is None else Vecs.shape[1]
+        super(WilsonBOperator, self).__init__(dtype=np.dtype(float), shape=(nrow, Bprim.shape[1]))
+
+    def _to_ic(self, P):
+        """ Transform primitive rows P of shape (nprim, ...) to the DLC basis. """
+        if self.Vecs is None:
+            return P
+        if isinstance(self.Vecs, BlockVectors):
+            return np.moveaxis(self.Vecs.rdot(np.moveaxis(P, 0, -1)), -1, 0)
+        return np.dot(self.Vecs.T, P)
+
+    def _from_ic(self, Y):
+        """ Transform DLC rows Y of shape (nDLC, ...) to the primitive basis. """
+        if self.Vecs is None:
+            return Y
+        if isinstance(self.Vecs, BlockVectors):
+            return self.Vecs.dot(Y)
+        return np.dot(self.Vecs, Y)
+
+    def _matmat(self, X):
+        X = np.asarray(X, dtype=float)
+        if self.scale is not None:
+            X = X * self.scale.reshape((-1,) + (1,)*(X.ndim-1))
+        return self._to_ic(np.asarray(self.Bprim.dot(X)))
+
+    def _matvec(self, x):
+        return self._matmat(np.asarray(x, dtype=float).reshape(-1))
+
+    def _rmatmat(self, Y):
+        ans = np.asarray(self.Bprim.T.dot(self._from_ic(np.asarray(Y, dtype=float))))
+        if self.scale is not None:
+            ans = ans * self.scale.reshape((-1,) + (1,)*(ans.ndim-1))
+        return ans
+
+    def _rmatvec(self, y):
+        return self._rmatmat(np.asarray(y, dtype=float).reshape(-1))
+
+    def _adjoint(self):
+        return scipy.sparse.linalg.LinearOperator(shape=(self.shape[1], self.shape[0]), dtype=self.dtype,
+                                                  matvec=self._rmatvec, rmatvec=self._matvec,
+                                                  matmat=self._rmatmat, rmatmat=self._matmat)
+
+    _transpose = _adjoint
+
+    def block(self, rows):
+        """ Return the selected rows of the B-matrix as a dense (len(rows), 3N) array. """
+        rows = np.asarray(rows, dtype=int)
+        if self.Vecs is None:
+            Brows = self.Bprim[rows]
+            ans = Brows.toarray() if scipy.sparse.issparse(Brows) else np.array(Brows)
+        else:
+            V = self.Vecs.columns(rows) if isinstance(self.Vecs, BlockVectors) else self.Vecs[:, rows]
+            ans = np.asarray(self.Bprim.T.dot(V)).T
+        if self.scale is not None:
+            ans = ans * self.scale[np.newaxis, :]
+        return ans
+
+    def toarray(self):
+        """ Return the dense B-matrix. """
+        return self.block(np.arange(self.shape[0]))
+
+def orthogonalize_dlc(C, V, thre=1e-6):
+    """
+    Return an orthonormal basis for the space spanned by V, where the leading columns
+    span the columns of C in order, as in Gram-Schmidt orthogonalization of [C, V].
+
+    The columns of C are orthogonalized by a QR factorization; a column whose norm after
+    projecting out the previous columns is below thre is redundant and dropped, and all
+    redundant columns are identified from a single factorization.  The other
+    basis vectors are chosen from the projection of V onto the orthogonal complement using
+    QR with column pivoting, which always completes the basis to V.shape[1] vectors.
+
+    Parameters
+    ----------
+    C : np.ndarray
+        (nprim, m) array of normalized vectors (e.g. constraint DLCs) within the span of V
+    V : np.ndarray
+        (nprim, n) array of orthonormal vectors (e.g. DLCs)
+    thre : float
+        Threshold for the norm of a redundant column of C
+
+    Returns
+    -------
+    U : np.ndarray
+        (nprim, n) array of orthonormal vectors
+    dropped : list
+        Indices of the columns of C that were dropped as redundant
+    """
+    # The diagonal of R from a single QR factorization is the norm of each column of C after
+    # projecting out all of the previous columns; dropping redundant columns does not change
+    # the span of the previous columns, so every redundant column is found at once.
+    Qc, Rc = scipy.linalg.qr(C, mode='economic')
+    small = np.abs(np.diag(Rc)) < thre
+    dropped = list(np.where(small)[0])
+    keep = list(np.where(~small)[0])
+    if dropped and keep:
+        # The columns of Q belonging to the redundant columns are arbitrary, so factorize the others
+        Qc, Rc = scipy.linalg.qr(C[:, keep], mode='economic')
+    elif not keep:
+        Qc, Rc = np.zeros((C.shape[0], 0), dtype=float), np.zeros((0, 0), dtype=float)
+    # Choose the same signs as Gram-Schmidt
+    Qc *= np.sign(np.diag(Rc))[np.newaxis, :]
+    if len(keep) > V.shape[1]:
+        raise RuntimeError('Orthogonalization has failed (expect at most %i constraint vectors, got %i)'
+                           % (V.shape[1], len(keep)))
+    W = V - multi_dot([Qc, Qc.T, V])
+    Qw = scipy.linalg.qr(W, mode='economic', pivoting=True)[0]
+    U = np.hstack((Qc, Qw[:, :V.shape[1]-len(keep)]))
+    return U, [int(i) for i in dropped]
 
     
 class DelocalizedInternalCoordinates(InternalCoordinates):
-    def __init__(self, molecule, imagenr=0, build=False, connect=False, addcart=False, constraints=None, cvals=None, rigid=False, remove_tr=False, cart_only=False, conmethod=0, connect_isolated=True):
+    def __init__(self, molecule, imagenr=0, build=False, connect=False, addcart=False, constraints=None, cvals=None,
+                 rigid=False, remove_tr=False, cart_only=False, conmethod=0, connect_isolated=True, sparse=False,
+                 gsolver='svd', greuse=0.0, dlcsolver='eigh', blockdlc=False, blockthreads=1):
         super(DelocalizedInternalCoordinates, self).__init__()
+        # Block-sparse DLC vectors (see build_dlc_block)
+        self.VecBlocks = None
+        # Constraints found to be redundant when building the DLCs
+        self.droppedConstraints = []
         # cart_only is just because of how I set up the class structure.
         if cart_only: return
         # Set the algorithm for constraint satisfaction.
@@ -3087,9 +4703,22 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         if self.rigid:
             if connect or addcart:
                 raise RuntimeError("Rigid optimizations not available using non-TRIC coordinates")
+        # Build the DLC B-matrix from the sparse primitive B-matrix?
+        self.sparse = sparse
+        # Method for applying G^-1 and threshold for reusing its factorization in newCartesian
+        self.gsolver = gsolver
+        self.greuse = greuse
+        # Method for finding the nonredundant space of the primitives when building the DLCs
+        self.dlcsolver = dlcsolver
+        # Build and store the DLCs separately for each set of primitives that don't share atoms,
+        # diagonalizing the blocks using this number of threads
+        self.blockdlc = blockdlc
+        self.blockthreads = blockthreads
         # The DLC contains an instance of primitive internal coordinates.
         if rigid: connect_isolated = False
-        self.Prims = PrimitiveInternalCoordinates(molecule, connect=connect, addcart=addcart, constraints=constraints, cvals=cvals, connect_isolated=connect_isolated)
+        self.Prims = PrimitiveInternalCoordinates(molecule, connect=connect, addcart=addcart, constraints=constraints,
+                                                  cvals=cvals, connect_isolated=connect_isolated, sparse=sparse,
+                                                  gsolver=gsolver, greuse=greuse)
         self.frags = self.Prims.frags
         self.na = molecule.na
         # Atomic mass array
@@ -3105,10 +4734,48 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         if self.remove_tr:
             self.remove_TR(xyz)
 
+    @property
+    def Vecs(self):
+        ''' Coefficients of the DLCs in terms of the primitives (one column per DLC)
+
+        Notes:
+            - If the DLCs were built in blocks (blockdlc), this returns a dense copy of
+              self.VecBlocks that is cached until the vectors change.  The copy is read-only;
+              methods that can work with the blocks should use self.VecBlocks instead.
+              Setting Vecs replaces the blocks with the dense array.
+
+        Returns:
+            np.ndarray: (nprim, nDLC) array
+        '''
+        if getattr(self, 'VecBlocks', None) is not None:
+            cache = getattr(self, '_VecsDense', None)
+            if cache is None or cache[0] is not self.VecBlocks:
+                dense = self.VecBlocks.toarray()
+                dense.setflags(write=False)
+                cache = (self.VecBlocks, dense)
+                self._VecsDense = cache
+            return cache[1]
+        if not hasattr(self, '_Vecs'):
+            raise AttributeError("DLC vectors have not been built")
+        return self._Vecs
+
+    @Vecs.setter
+    def Vecs(self, val):
+        self.VecBlocks = None
+        self._VecsDense = None
+        self._Vecs = val
+
     def clearCache(self):
         super(DelocalizedInternalCoordinates, self).clearCache()
         self.Prims.clearCache()
 
+    def setCacheBudget(self, nbytes):
+        super(DelocalizedInternalCoordinates, self).setCacheBudget(nbytes)
+        self.Prims.setCacheBudget(nbytes)
+
+    def cacheStats(self):
+        return sum_cache_stats([self.cache.stats(), self.Prims.cacheStats()])
+
     def __repr__(self):
         outstr = self.Prims.__repr__()
         if self.rigid:
@@ -3117,6 +4784,14 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
             
     def update(self, other):
         return self.Prims.update(other.Prims)
+
+    def updatePrimitives(self, molecule):
+        changed = self.Prims.updatePrimitives(molecule)
+        if changed is not None:
+            self.frags = self.Prims.frags
+        if changed:
+            self.clearCache()
+        return changed
         
     def join(self, other):
         return self.Prims.join(other.Prims)
@@ -3299,11 +4974,11 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         if len(self.Prims.cPrims) == 0 and not self.rigid:
             return gradx
         q0 = self.calculate(xyz)
-        Ginv = self.GInverse(xyz)
-        Bmat = self.wilsonB(xyz)
+        # With self.sparse, B is applied as a linear operator without forming the DLC B-matrix
+        Bmat = self.getBProducts(xyz)
         # Internal coordinate gradient
         # Gq = np.matrix(Ginv)*np.matrix(Bmat)*np.matrix(gradx).T
-        Gq = multi_dot([Ginv, Bmat, gradx.T])
+        Gq = self.GSolve(xyz, Bmat.dot(gradx.flatten()))
         Gqc = np.array(Gq).flatten()
         # Remove the directions that are along the DLCs that we are constraining
         for i in self.cDLC:
@@ -3311,7 +4986,7 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         for i in self.rDLC:
             Gqc[i] = 0.0
         # Gxc = np.array(np.matrix(Bmat.T)*np.matrix(Gqc).T).flatten()
-        Gxc = multi_dot([Bmat.T, Gqc.T]).flatten()
+        Gxc = np.array(Bmat.T.dot(Gqc)).flatten()
         return Gxc
     
     def build_dlc_0(self, xyz):
@@ -3325,7 +5000,8 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         
         After creating the DLCs, we construct special ones corresponding to primitive
         coordinates that are constrained (cProj).  These are placed in the front (i.e. left)
-        of the list of DLCs, and then we perform a Gram-Schmidt orthogonalization.
+        of the list of DLCs, and then we orthogonalize them and complete the basis using
+        QR factorizations (see orthogonalize_dlc), dropping any redundant constraints.
 
         This function is called at the end of __init__ after the coordinate system is already
         specified (including which primitives are constraints).
@@ -3335,32 +5011,36 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         xyz : np.ndarray
             Flat array containing Cartesian coordinates in atomic units
         """
-        # Perform singular value decomposition
-        click()
-        G = self.Prims.GMatrix(xyz)
-        # Manipulate G-Matrix to increase weight of constrained coordinates
-        if self.haveConstraints():
-            for ic, c in enumerate(self.Prims.cPrims):
-                iPrim = self.Prims.Internals.index(c)
-                G[:, iPrim] *= 1.0
-                G[iPrim, :] *= 1.0
         ncon = len(self.Prims.cPrims)
-        # Water Dimer: 100.0, no check -> -151.1892668451
-        time_G = click()
-        L, Q = np.linalg.eigh(G)
-        time_eig = click()
-        # print "Build G: %.3f Eig: %.3f" % (time_G, time_eig)
-        LargeVals = 0
-        LargeIdx = []
-        for ival, value in enumerate(L):
-            # print ival, value
-            if np.abs(value) > 1e-6:
-                LargeVals += 1
-                LargeIdx.append(ival)
-        Expect = 3*self.na
-        # print "%i atoms (expect %i coordinates); %i/%i singular values are > 1e-6" % (self.na, Expect, LargeVals, len(L))
-        # if LargeVals <= Expect:
-        self.Vecs = Q[:, LargeIdx]
+        if self.dlcsolver == 'btb':
+            L, self.Vecs = self.nonredundantSpace(self.Prims.getB(xyz))
+        else:
+            # Perform singular value decomposition
+            click()
+            G = self.Prims.GMatrix(xyz)
+            # Manipulate G-Matrix to increase weight of constrained coordinates
+            if self.haveConstraints():
+                for ic, c in enumerate(self.Prims.cPrims):
+                    iPrim = self.Prims.Internals.index(c)
+                    G[:, iPrim] *= 1.0
+                    G[iPrim, :] *= 1.0
+            # Water Dimer: 100.0, no check -> -151.1892668451
+            time_G = click()
+            L, Q = np.linalg.eigh(G)
+            time_eig = click()
+            # print "Build G: %.3f Eig: %.3f" % (time_G, time_eig)
+            LargeVals = 0
+            LargeIdx = []
+            for ival, value in enumerate(L):
+                # print ival, value
+                if np.abs(value) > 1e-6:
+                    LargeVals += 1
+                    LargeIdx.append(ival)
+            Expect = 3*self.na
+            # print "%i atoms (expect %i coordinates); %i/%i singular values are > 1e-6" \
+            #     % (self.na, Expect, LargeVals, len(L))
+            # if LargeVals <= Expect:
+            self.Vecs = Q[:, LargeIdx]
 
         TRNonCon = []
         # Vecs has number of rows equal to the number of primitives, and
@@ -3403,36 +5083,21 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
                         
                     V.append(np.array(cProj).flatten())
                 # print c, cProj[iPrim]
-            # V contains the constraint vectors on the left, and the original DLCs on the right
-            V = np.hstack((np.array(V).T, np.array(self.Vecs)))
-            # Apply Gram-Schmidt to V, and produce U.
-            # The Gram-Schmidt process should produce a number of orthogonal DLCs equal to the original number
-            thre = 1e-6
-            while True:
-                U = []
-                for iv in range(V.shape[1]):
-                    v = V[:, iv].flatten()
-                    U.append(v.copy())
-                    for ui in U[:-1]:
-                        U[-1] -= ui * np.dot(ui, v)
-                    if np.linalg.norm(U[-1]) < thre:
-                        U = U[:-1]
-                        if len(projPrims) > len(U):
-                            # Untested code - automatically remove redundant constraints
-                            if self.Prims.Internals[projPrims[len(U)]] in self.Prims.cPrims:
-                                del self.Prims.cVals[self.Prims.cPrims.index(self.Prims.Internals[projPrims[len(U)]])]
-                                del self.Prims.cPrims[self.Prims.cPrims.index(self.Prims.Internals[projPrims[len(U)]])]
-                            del projPrims[len(U)]
-                        continue
-                    U[-1] /= np.linalg.norm(U[-1])
-                if len(U) > self.Vecs.shape[1]:
-                    thre *= 10
-                elif len(U) == self.Vecs.shape[1]:
-                    break
-                elif len(U) < self.Vecs.shape[1]:
-                    raise RuntimeError('Gram-Schmidt orthogonalization has failed (expect %i length %i)' % (self.Vecs.shape[1], len(U)))
-            # print "Gram-Schmidt completed with thre=%.0e" % thre
-            self.Vecs = np.array(U).T
+            # Orthogonalize the constraint vectors and complete the basis from the original DLCs
+            C = np.array(V).T if V else np.zeros((self.Vecs.shape[0], 0), dtype=float)
+            U, dropped = orthogonalize_dlc(C, self.Vecs)
+            # Automatically remove redundant constraints
+            self.droppedConstraints = []
+            for iv in dropped[::-1]:
+                Prim = self.Prims.Internals[projPrims[iv]]
+                if Prim in self.Prims.cPrims:
+                    logger.warning("Constraint %s is redundant with the other constraints and will be dropped\n"
+                                   % Prim)
+                    self.droppedConstraints.insert(0, Prim)
+                    del self.Prims.cVals[self.Prims.cPrims.index(Prim)]
+                    del self.Prims.cPrims[self.Prims.cPrims.index(Prim)]
+                del projPrims[iv]
+            self.Vecs = U
             # Constrained DLCs are on the left of self.Vecs.
             self.cDLC = [i for i in range(len(self.Prims.cPrims))]
             if self.rigid:
@@ -3489,7 +5154,6 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         xyz : np.ndarray
             Flat array containing Cartesian coordinates in atomic units
         """
-        G = self.Prims.GMatrix(xyz)
         nprim = len(self.Prims.Internals)
         cPrimIdx = []
         if self.haveConstraints():
@@ -3511,33 +5175,50 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
         # Here we include the TR-primitives with the constrained DoFs, in order to separate
         # them from the others.
         sel_con_plusTR = list(range(ncon)) + TRNonCon
-        not_sel = [i for i in range(G.shape[0]) if i not in sel_con_plusTR]
+        not_sel = [i for i in range(nprim) if i not in sel_con_plusTR]
         reorder_idx = sel_con_plusTR + not_sel
         invmap = []
         for i in range(len(reorder_idx)):
             invmap.append(reorder_idx.index(i))
         ncon = len(sel_con_plusTR)
 
-        # Reorder the G matrix so that constraints and TRNonCon are in front.
-        G = G[np.ix_(reorder_idx, reorder_idx)]
-
-        # Form a sub-G-matrix that doesn't include the constrained primitives and diagonalize it to form DLCs.
-        Gsub = G[ncon:, ncon:]
-        L, Q = np.linalg.eigh(Gsub)
-        # Sort eigenvalues and eigenvectors in descending order (for cleanliness)
-        L = L[::-1]
-        Q = Q[:, ::-1]
-        # print "Build G: %.3f Eig: %.3f" % (time_G, time_eig)
-        # Figure out which eigenvectors from the G submatrix to include
-        LargeVals = 0
-        LargeIdx = []
         GEigThre = 1e-6
-        for ival, value in enumerate(L):
-            if np.abs(value) > GEigThre:
-                LargeVals += 1
-                LargeIdx.append(ival)
-        # This is the number of nonredundant DLCs that we expect to have at the end
-        Expect = np.sum(np.linalg.eigh(G)[0] > 1e-6)
+        if self.dlcsolver == 'btb':
+            # Reorder the B matrix so that constraints and TRNonCon are in front.
+            Bmat = self.Prims.getB(xyz)[reorder_idx]
+            # Form the DLCs from the rows of B that don't include the constrained primitives,
+            # in descending order of eigenvalues.
+            L, Q = self.nonredundantSpace(Bmat[ncon:], GEigThre)
+            L = L[::-1]
+            Q = Q[:, ::-1]
+            LargeVals = len(L)
+            LargeIdx = list(range(LargeVals))
+            # This is the number of nonredundant DLCs that we expect to have at the end
+            Expect = len(self.nonredundantSpace(Bmat, GEigThre, vectors=False))
+            # The overlaps below are evaluated one pair of vectors at a time
+            if scipy.sparse.issparse(Bmat):
+                Bmat = Bmat.toarray()
+        else:
+            G = self.Prims.GMatrix(xyz)
+            # Reorder the G matrix so that constraints and TRNonCon are in front.
+            G = G[np.ix_(reorder_idx, reorder_idx)]
+
+            # Form a sub-G-matrix that doesn't include the constrained primitives and diagonalize it to form DLCs.
+            Gsub = G[ncon:, ncon:]
+            L, Q = np.linalg.eigh(Gsub)
+            # Sort eigenvalues and eigenvectors in descending order (for cleanliness)
+            L = L[::-1]
+            Q = Q[:, ::-1]
+            # print "Build G: %.3f Eig: %.3f" % (time_G, time_eig)
+            # Figure out which eigenvectors from the G submatrix to include
+            LargeVals = 0
+            LargeIdx = []
+            for ival, value in enumerate(L):
+                if np.abs(value) > GEigThre:
+                    LargeVals += 1
+                    LargeIdx.append(ival)
+            # This is the number of nonredundant DLCs that we expect to have at the end
+            Expect = np.sum(np.linalg.eigh(G)[0] > 1e-6)
 
         if (ncon + len(LargeIdx)) < Expect:
             raise RuntimeError("Expected at least %i delocalized coordinates, but got only %i" % (Expect, ncon + len(LargeIdx)))
@@ -3552,6 +5233,8 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
 
         # Perform Gram-Schmidt orthogonalization
         def ov(vi, vj):
+            if self.dlcsolver == 'btb':
+                return np.dot(Bmat.T.dot(vi), Bmat.T.dot(vj))
             return multi_dot([vi, G, vj])
 
         if self.haveConstraints() or self.rigid:
@@ -3595,13 +5278,129 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
 
         self.Internals = ["Constraint" if i < len(self.cDLC) else "DLC" + " %i" % (i+1) for i in range(self.Vecs.shape[1])]
 
+    def nonredundantSpace(self, Bmat, thre=1e-6, vectors=True):
+        """
+        Return the eigenvalues of G = B.B^T that are larger than thre and the
+        corresponding eigenvectors, which span the nonredundant space of the primitives.
+
+        With dlcsolver = 'eigh' the (nprim x nprim) G-matrix is diagonalized directly.
+        With dlcsolver = 'btb' the (3N x 3N) matrix B^T.B is diagonalized instead; it has the
+        same nonzero eigenvalues, and the eigenvectors of G are recovered from its eigenvectors
+        v as B.v/sqrt(lambda).  This is much cheaper when there are more primitives than 3N,
+        as is usually the case for TRIC.
+
+        Parameters
+        ----------
+        Bmat : np.ndarray or scipy.sparse matrix
+            Wilson B-matrix with one row for each primitive
+        thre : float
+            Eigenvalues of G below this threshold are considered to be zero
+        vectors : bool
+            If False, return only the eigenvalues
+
+        Returns
+        -------
+        L : np.ndarray
+            Eigenvalues larger than thre in ascending order
+        Q : np.ndarray
+            Eigenvectors of G stored as columns (only if vectors is True)
+        """
+        if self.dlcsolver == 'btb' and Bmat.shape[0] > Bmat.shape[1]:
+            BtB = Bmat.T.dot(Bmat)
+            if scipy.sparse.issparse(BtB):
+                BtB = BtB.toarray()
+            if not vectors:
+                L = np.linalg.eigvalsh(BtB)
+                return L[L > thre]
+            L, V = np.linalg.eigh(BtB)
+            large = L > thre
+            L = L[large]
+            Q = np.asarray(Bmat.dot(V[:, large])) / np.sqrt(L)[np.newaxis, :]
+            return L, Q
+        G = Bmat.dot(Bmat.T)
+        if scipy.sparse.issparse(G):
+            G = G.toarray()
+        if not vectors:
+            L = np.linalg.eigvalsh(G)
+            return L[np.abs(L) > thre]
+        L, Q = np.linalg.eigh(G)
+        large = np.abs(L) > thre
+        return L[large], Q[:, large]
+
+    def primitiveBlocks(self, xyz):
+        """
+        Divide the primitives into sets that don't share any atoms, so that the G-matrix is
+        block diagonal. In TRIC, these are usually the fragments.
+
+        Returns
+        -------
+        list
+            List of (rows, atoms) pairs of arrays containing the primitive indices and the
+            atoms they depend on, ordered by the first primitive in each set
+        """
+        Bmat = self.Prims.wilsonB_sparse(xyz).tocoo()
+        nprim = len(self.Prims.Internals)
+        # Map of primitives to atoms and graph of primitives that share atoms
+        PrimAtoms = scipy.sparse.csr_matrix((np.ones(len(Bmat.row)), (Bmat.row, Bmat.col//3)), shape=(nprim, self.na))
+        ncomp, labels = scipy.sparse.csgraph.connected_components(PrimAtoms.dot(PrimAtoms.T), directed=False)
+        first = np.unique(labels, return_index=True)[1]
+        blocks = []
+        for k in np.argsort(first):
+            rows = np.where(labels == k)[0]
+            atoms = np.unique(PrimAtoms[rows].indices)
+            blocks.append((rows, atoms))
+        return blocks
+
+    def build_dlc_block(self, xyz):
+        """
+        Build the DLCs separately for each set of primitives that don't share any atoms
+        (see primitiveBlocks) and store them in self.VecBlocks. Within each block, the DLCs
+        are the eigenvectors of the G-matrix block with nonzero eigenvalues, so the combined
+        set spans the same space as build_dlc_0 without constraints.
+
+        Parameters
+        ----------
+        xyz : np.ndarray
+            Flat array containing Cartesian coordinates in atomic units
+        """
+        blocks = self.primitiveBlocks(xyz)
+        Bmat = self.Prims.wilsonB_sparse(xyz)
+        def solve(block):
+            rows, atoms = block
+            cols = (3*atoms[:, np.newaxis] + np.arange(3)).flatten()
+            return self.nonredundantSpace(Bmat[rows][:, cols])[1]
+        if self.blockthreads > 1 and len(blocks) > 1:
+            # The eigensolvers release the GIL, so the blocks can be diagonalized in parallel threads
+            pool = ThreadPool(min(self.blockthreads, len(blocks)))
+            vecs = pool.map(solve, blocks)
+            pool.close()
+            pool.join()
+        else:
+            vecs = [solve(block) for block in blocks]
+        VecBlocks = BlockVectors(len(self.Prims.Internals),
+                                 [(rows, atoms, v) for (rows, atoms), v in zip(blocks, vecs)])
+        self.Vecs = None
+        self.VecBlocks = VecBlocks
+        self.Internals = ["DLC" + " %i" % (i+1) for i in range(VecBlocks.shape[1])]
+
     def build_dlc(self, xyz):
+        t0 = time.time()
+        if self.blockdlc and not self.haveConstraints():
+            self.build_dlc_block(xyz)
+            logger.debug("Built %i delocalized internal coordinates in %i blocks from %i primitives (dlcsolver %s) "
+                         "in %.3f s\n" % (len(self.Internals), self.VecBlocks.nblocks, len(self.Prims.Internals),
+                                          self.dlcsolver, time.time()-t0))
+            return
+        if self.blockdlc:
+            logger.debug("Building DLCs without blocks because of constraints\n")
         if self.conmethod == 1:
-            return self.build_dlc_1(xyz)
+            self.build_dlc_1(xyz)
         elif self.conmethod == 0:
-            return self.build_dlc_0(xyz)
+            self.build_dlc_0(xyz)
         else:
             raise RuntimeError("Unsupported value of conmethod %i" % self.conmethod)
+        logger.debug("Built %i delocalized internal coordinates from %i primitives (dlcsolver %s) in %.3f s\n"
+                    % (len(self.Internals), len(self.Prims.Internals), self.dlcsolver, time.time()-t0))
             
     def remove_TR(self, xyz):
         """
@@ -3714,8 +5513,7 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
             rmsd = np.sqrt(np.mean(np.sum(np.array(dxyz).reshape(-1,3)**2, axis=1)))
             dxdq[i] = rmsd/eps
         dxdq /= np.max(dxdq)
-        for i in range(len(self.Internals)):
-            self.Vecs[:, i] *= dxdq[i]
+        self.Vecs = self.Vecs * dxdq[np.newaxis, :]
 
     def __eq__(self, other):
         return self.Prims == other.Prims
@@ -3740,12 +5538,37 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
     def calcDiff(self, coord1, coord2):
         """ Calculate difference in internal coordinates (coord1-coord2), accounting for changes in 2*pi of angles. """
         PMDiff = self.Prims.calcDiff(coord1, coord2)
+        if self.VecBlocks is not None:
+            return self.VecBlocks.rdot(PMDiff)
         Answer = np.dot(PMDiff, self.Vecs)
         return np.array(Answer).flatten()
 
+    def calculate_batch(self, xyzs):
+        """ Calculate the DLCs for geometries of shape (nframes, 3*N); returns (nframes, nDLC). """
+        if self.VecBlocks is not None:
+            return self.VecBlocks.rdot(self.Prims.calculate_batch(xyzs))
+        return np.dot(self.Prims.calculate_batch(xyzs), self.Vecs)
+
+    def derivatives_batch(self, xyzs):
+        """
+        Calculate the DLC first derivatives for geometries of shape (nframes, 3*N).
+        Returns an array of shape (nframes, nDLC, N, 3).
+        """
+        if self.VecBlocks is not None:
+            return self.VecBlocks.tdot_derivatives(self.Prims.derivatives_batch(xyzs))
+        return np.einsum('pi,fpaj->fiaj', self.Vecs, self.Prims.derivatives_batch(xyzs), optimize=True)
+
+    def calcDiff_batch(self, xyzs1, xyzs2):
+        """ Calculate the DLC differences (xyzs1-xyzs2) for several pairs of geometries; returns (nframes, nDLC). """
+        if self.VecBlocks is not None:
+            return self.VecBlocks.rdot(self.Prims.calcDiff_batch(xyzs1, xyzs2))
+        return np.dot(self.Prims.calcDiff_batch(xyzs1, xyzs2), self.Vecs)
+
     def calculate(self, coords):
         """ Calculate the DLCs given the Cartesian coordinates. """
         PrimVals = self.Prims.calculate(coords)
+        if self.VecBlocks is not None:
+            return self.VecBlocks.rdot(PrimVals)
         Answer = np.dot(PrimVals, self.Vecs)
         # To obtain the primitive coordinates from the delocalized internal coordinates,
         # simply multiply self.Vecs*Answer.T where Answer.T is the column vector of delocalized
@@ -3758,7 +5581,15 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
 
     def derivatives(self, coords):
         """ Obtain the change of the DLCs with respect to the Cartesian coordinates. """
+        if self.sparse:
+            # Contract the DLC vectors with the sparse primitive B-matrix
+            Bprim = self.Prims.wilsonB_sparse(coords)
+            if self.VecBlocks is not None:
+                return Bprim.T.dot(self.VecBlocks.tocsr()).T.toarray().reshape(len(self.Internals), -1, 3)
+            return np.array(Bprim.T.dot(self.Vecs).T).reshape(self.Vecs.shape[1], -1, 3)
         PrimDers = self.Prims.derivatives(coords)
+        if self.VecBlocks is not None:
+            return self.VecBlocks.tdot_derivatives(PrimDers)
         # The following code does the same as "tensordot"
         # print PrimDers.shape
         # print self.Vecs.shape
@@ -3773,11 +5604,45 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
     def second_derivatives(self, coords):
         """ Obtain the second derivatives of the DLCs with respect to the Cartesian coordinates. """
         PrimDers = self.Prims.second_derivatives(coords)
+        if self.VecBlocks is not None:
+            return np.moveaxis(self.VecBlocks.tdot_derivatives(np.moveaxis(PrimDers, 0, 2)), 2, 0)
         return np.tensordot(self.Vecs, PrimDers, axes=(0, 0))
 
+    def contractSecondDerivatives(self, xyz, coeffs):
+        """ Contract the DLC second derivatives with coeffs by passing Vecs*coeffs to the primitives. """
+        if self.VecBlocks is not None:
+            return self.Prims.contractSecondDerivatives(xyz, self.VecBlocks.dot(coeffs))
+        return self.Prims.contractSecondDerivatives(xyz, np.dot(self.Vecs, coeffs))
+
     def GInverse(self, xyz):
         return self.GInverse_SVD(xyz)
 
+    def wilsonB_operator(self, xyz, MW=False):
+        """
+        Return the DLC B-matrix as a WilsonBOperator built from the sparse primitive
+        B-matrix and the DLC vectors, without forming the dense DLC B-matrix.
+        """
+        Vecs = self.VecBlocks if self.VecBlocks is not None else self.Vecs
+        return WilsonBOperator(self.Prims.wilsonB_sparse(xyz), Vecs=Vecs,
+                               scale=1.0/np.sqrt(self.mass) if MW else None)
+
+    def GMatrix(self, xyz, MW=False):
+        """
+        Return the G-matrix of the DLCs.  If self.sparse is enabled, it is obtained as V^T G_prim V
+        from the sparse primitive G-matrix without forming the dense DLC B-matrix.
+        """
+        if not self.sparse:
+            return super(DelocalizedInternalCoordinates, self).GMatrix(xyz, MW=MW)
+        Bprim = self.Prims.wilsonB_sparse(xyz)
+        if MW:
+            Bprim = scipy.sparse.csr_matrix(Bprim.multiply(1.0/np.sqrt(self.mass)[np.newaxis, :]))
+        Gprim = Bprim.dot(Bprim.T)
+        if self.VecBlocks is not None:
+            V = self.VecBlocks.tocsr()
+            return V.T.dot(Gprim.dot(V)).toarray()
+        V = self.Vecs
+        return np.dot(V.T, np.asarray(Gprim.dot(V)))
+
     def repr_diff(self, other):
         if hasattr(other, 'Prims'):
             return self.Prims.repr_diff(other.Prims)
@@ -3790,9 +5655,20 @@ class DelocalizedInternalCoordinates(InternalCoordinates):
     def guess_hessian(self, coords):
         """ Build the guess Hessian, consisting of a diagonal matrix 
         in the primitive space and changed to the basis of DLCs. """
+        if self.VecBlocks is not None:
+            return self.VecBlocks.congruence_diag(self.Prims.guess_hessian_diagonal(coords))
         Hprim = self.Prims.guess_hessian(coords)
         return multi_dot([self.Vecs.T,Hprim,self.Vecs])
 
+    def guess_hessian_diagonal(self, coords):
+        """ Return the diagonal of the guess Hessian in the basis of DLCs
+        without forming the full matrix. """
+        h = self.Prims.guess_hessian_diagonal(coords)
+        if self.VecBlocks is not None:
+            V = self.VecBlocks.tocsr()
+            return np.asarray(V.multiply(V).T.dot(h)).flatten()
+        return np.dot(h, self.Vecs**2)
+
     def resetRotations(self, xyz):
         """ Reset the reference geometries for calculating the orientational variables. """
         self.Prims.resetRotations(xyz)
@@ -3818,8 +5694,9 @@ class CartesianCoordinates(PrimitiveInternalCoordinates):
         if 'constraints' in kwargs and kwargs['constraints'] is not None:
             raise RuntimeError('Do not use constraints with Cartesian coordinates')
 
-    def guess_hessian(self, xyz):
-        return 0.5*np.eye(len(xyz.flatten()))
+    def guess_hessian_diagonal(self, coords):
+        coords = np.asarray(coords, dtype=float)
+        return 0.5*np.ones(coords.shape[:-1] + (len(self.Internals),), dtype=float)
 
 class ImagePrim(PrimitiveCoordinate):
     def __init__(self, ic, na, nr):
@@ -3939,10 +5816,7 @@ class ChainCoordinates(PrimitiveInternalCoordinates):
 
     """
     def __init__(self, molecule, connect=False, addcart=False, **kwargs):
-        self.stored_wilsonB = OrderedDict()
-        self.stored_Ginverse = OrderedDict()
-        self.stored_MWsqrtG = OrderedDict()
-        self.stored_MWsqrtGinverse = OrderedDict()
+        self.cache = ICCache()
         self.connect = connect
         self.addcart = addcart
         self.nim = len(molecule)
@@ -3962,6 +5836,13 @@ class ChainCoordinates(PrimitiveInternalCoordinates):
         for i, imageIC in self.ICIter():
             for ic in imageIC.Internals:
                 self.Internals.append(ImagePrim(ic, self.na, i))
+        # If all of the images have the same primitives, they are evaluated together
+        # using the batched methods of the first image's coordinate system
+        images = [imageIC for i, imageIC in self.ICIter()]
+        if len(images) > 0 and all(imageIC.Internals == images[0].Internals for imageIC in images[1:]):
+            self.batchIC = images[0]
+        else:
+            self.batchIC = None
 
         # 2025/3/12 HP: RMSDisplacement is experimental. It needs to be tested first.
         #guessw = kwargs.get('guessw', 0.1)
@@ -3990,6 +5871,14 @@ class ChainCoordinates(PrimitiveInternalCoordinates):
         for i, c in self.ICIter():
             c.clearCache()
 
+    def setCacheBudget(self, nbytes):
+        super(ChainCoordinates, self).setCacheBudget(nbytes)
+        for i, c in self.ICIter():
+            c.setCacheBudget(nbytes)
+
+    def cacheStats(self):
+        return sum_cache_stats([self.cache.stats()] + [c.cacheStats() for i, c in self.ICIter()])
+
     def ICIter(self):
         answer = []
         for i, imageIC in enumerate(self.ImageICs):
@@ -4008,7 +5897,28 @@ class ChainCoordinates(PrimitiveInternalCoordinates):
     def remove_TR(self, xyz):
         raise RuntimeError("Not implemented for ChainCoordinates")
 
+    def calculate(self, xyz):
+        if self.batchIC is None:
+            return super(ChainCoordinates, self).calculate(xyz)
+        xyz = xyz.reshape(self.nim, -1)
+        return self.batchIC.calculate_batch(xyz[1:-1]).flatten()
+
+    def calcDiff(self, xyz1, xyz2):
+        if self.batchIC is None:
+            return super(ChainCoordinates, self).calcDiff(xyz1, xyz2)
+        xyz1 = xyz1.reshape(self.nim, -1)
+        xyz2 = xyz2.reshape(self.nim, -1)
+        return self.batchIC.calcDiff_batch(xyz1[1:-1], xyz2[1:-1]).flatten()
+
     def derivatives(self, xyz):
+        if self.batchIC is not None:
+            # Each image's primitives only depend on the atoms of that image
+            xyz = xyz.reshape(self.nim, -1)
+            ders = self.batchIC.derivatives_batch(xyz[1:-1])
+            nframes = ders.shape[0]
+            answer = np.zeros((nframes, ders.shape[1], self.nim, self.na, 3), dtype=float)
+            answer[np.arange(nframes), :, np.arange(1, nframes+1)] = ders
+            return answer.reshape(-1, self.nim*self.na, 3)
         self.calculate(xyz)
         answer = []
         for Internal in self.Internals:
@@ -4027,6 +5937,13 @@ class ChainCoordinates(PrimitiveInternalCoordinates):
         """
         coords = coords.reshape(self.nim,-1)
         totvar = len(self.Internals)
+        if self.batchIC is not None:
+            # The guess Hessian of each image is diagonal, so the diagonals of all
+            # images are computed together and the remaining coordinates get k
+            Hdiag = np.full(totvar, k, dtype=float)
+            Himg = self.batchIC.guess_hessian_diagonal(coords[1:-1]).flatten()
+            Hdiag[:len(Himg)] = Himg
+            return np.diag(Hdiag)
         H = np.zeros((totvar, totvar), dtype=float)
         curr = 0
         for i, imageIC in self.ICIter():
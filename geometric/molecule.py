@@ -1288,6 +1288,9 @@ class Molecule(object):
         if key == 'qm_forces':
             logger.warning('qm_forces is a deprecated keyword because it actually meant gradients; setting to qm_grads.')
             key = 'qm_grads'
+        if key == 'Data' or key.startswith('__'):
+            # Data is not yet set while unpickling (e.g. when sending an Engine to a worker process)
+            raise AttributeError(key)
         if key == 'ns':
             return len(self)
         elif key == 'na': # The 'na' attribute is the number of atoms.
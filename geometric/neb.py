@@ -48,7 +48,8 @@ from .params import OptParams, NEBParams, parse_neb_args
 from .step import get_delta_prime_trm, brent_wiki, trust_step, calc_drms_dmax
 from .engine import Blank
 from .internal import CartesianCoordinates, PrimitiveInternalCoordinates, DelocalizedInternalCoordinates, ChainCoordinates
-from .nifty import flat, row, col, createWorkQueue, getWorkQueue, wq_wait, ang2bohr, bohr2ang, kcal2au, au2kcal, au2evang, logger
+from .nifty import flat, row, col, createWorkQueue, getWorkQueue, wq_wait, createLocalPool, destroyLocalPool, \
+    getLocalPool, ang2bohr, bohr2ang, kcal2au, au2kcal, au2evang, logger
 from .molecule import EqualSpacing
 from .errors import NEBStructureError, NEBChainShapeError, NEBBandTangentError, NEBBandGradientError
 from .config import config_dir
@@ -246,6 +247,14 @@ class Structure(object):
     def QueueEnergyGradient(self):
         self.engine.calc_wq(self.cartesians, self.tmpdir)
 
+    def SubmitEnergyGradient(self):
+        """Submit the energy and gradient calculation to run asynchronously; returns a Future."""
+        return self.engine.submit(self.cartesians, self.tmpdir)
+
+    def CollectEnergyGradient(self, future):
+        """Wait for a Future returned by SubmitEnergyGradient() and store the result in the engine."""
+        return self.engine.collect(future, self.cartesians)
+
     def GetEnergyGradient(self):
         """Add energy and gradient attributes"""
         result = self.engine.read_wq(self.cartesians, self.tmpdir)
@@ -363,6 +372,11 @@ class Chain(object):
             # Deleting the records
             outputs.forget()
 
+        elif getLocalPool() is not None and not result:
+            # If a local process pool is available, run the calculations concurrently.
+            futures = [self.Structures[i].SubmitEnergyGradient() for i in range(len(self))]
+            for i in range(len(self)):
+                self.Structures[i].ComputeEnergyGradient(result=self.Structures[i].CollectEnergyGradient(futures[i]))
         else:
             for i in range(len(self)):
                 if result:
@@ -1755,20 +1769,27 @@ def main():
     if args.get('wqport', 0):
         createWorkQueue(args.get('wqport'), debug=params.verbose)
 
-    if params.prefix is None:
-        tmpdir = os.path.splitext(args["input"])[0] + ".tmp"
-    else:
-        tmpdir = params.prefix + ".tmp"
+    if args.get('cores', 0):
+        createLocalPool(args.get('cores'), threads=args.get('nt') or 1)
 
-    if not os.path.exists(tmpdir):
-        os.mkdir(tmpdir)
+    try:
+        if params.prefix is None:
+            tmpdir = os.path.splitext(args["input"])[0] + ".tmp"
+        else:
+            tmpdir = params.prefix + ".tmp"
 
-    # Make the initial chain
-    chain = ElasticBand(M, engine=engine, tmpdir=tmpdir, params=params, plain=params.plain)
-    t0 = time.time()
-    OptimizeChain(chain, engine, params)
-    print_citation(logger)
-    logger.info("Time elapsed since start of OptimizeChain: %.3f seconds\n" % (time.time()-t0))
+        if not os.path.exists(tmpdir):
+            os.mkdir(tmpdir)
+
+        # Make the initial chain
+        chain = ElasticBand(M, engine=engine, tmpdir=tmpdir, params=params, plain=params.plain)
+        t0 = time.time()
+        OptimizeChain(chain, engine, params)
+        print_citation(logger)
+        logger.info("Time elapsed since start of OptimizeChain: %.3f seconds\n" % (time.time()-t0))
+    finally:
+        if args.get('cores', 0):
+            destroyLocalPool()
 
 if __name__ == "__main__":
     main()
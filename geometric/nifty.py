@@ -974,6 +974,51 @@ def wq_wait(wq, wait_time=10, wait_intvl=10, print_time=60, verbose=False):
     while not wq.empty():
         wq_wait1(wq, wait_time=wait_time, wait_intvl=wait_intvl, print_time=print_time, verbose=verbose)
 
+#==============================#
+#|   Local process pool stuff  |#
+#==============================#
+
+# Global variable corresponding to the local process pool for running calculations concurrently
+LOCAL_POOL = None
+
+def getLocalPool():
+    global LOCAL_POOL
+    return LOCAL_POOL
+
+def createLocalPool(cores, threads=1, workers=None):
+    """
+    Create a pool of worker processes for running calculations concurrently on the local machine.
+
+    Parameters
+    ----------
+    cores : int
+        Total number of CPU cores that the calculations may use
+    threads : int
+        Number of threads used by each calculation; the pool will run
+        up to cores // threads calculations at the same time
+    workers : int, optional
+        Number of worker processes, if different from cores // threads
+    """
+    global LOCAL_POOL
+    from concurrent.futures import ProcessPoolExecutor
+    destroyLocalPool()
+    threads = max(1, threads)
+    if workers is None: workers = max(1, cores // threads)
+    logger.info("Creating local process pool with %i workers (%i cores, %i threads per calculation)\n"
+                % (workers, cores, threads))
+    LOCAL_POOL = ProcessPoolExecutor(max_workers=workers)
+    LOCAL_POOL.cores = cores
+    LOCAL_POOL.threads = threads
+    LOCAL_POOL.workers = workers
+    return LOCAL_POOL
+
+def destroyLocalPool():
+    # Convenience function to shut down the local process pool.
+    global LOCAL_POOL
+    if LOCAL_POOL is not None:
+        LOCAL_POOL.shutdown(wait=True)
+    LOCAL_POOL = None
+
 #=====================================#
 #| File and process management stuff |#
 #=====================================#
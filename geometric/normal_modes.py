@@ -34,12 +34,120 @@ POSSIBILITY OF SUCH DAMAGE.
 from __future__ import division
 from __future__ import print_function
 import os, shutil
+from concurrent.futures import as_completed
+from contextlib import contextmanager
 import numpy as np
 from .errors import FrequencyError
 from .molecule import Molecule, PeriodicTable
-from .nifty import logger, kb, kb_si, hbar, au2kj, au2kcal, ang2bohr, bohr2ang, c_lightspeed, avogadro, cm2au, amu2au, ambervel2au, wq_wait, getWorkQueue, commadash, bak
+from .nifty import logger, kb, kb_si, hbar, au2kj, au2kcal, ang2bohr, bohr2ang, c_lightspeed, avogadro, cm2au, \
+    amu2au, ambervel2au, wq_wait, getWorkQueue, createLocalPool, getLocalPool, destroyLocalPool, commadash, bak
 
-def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bigchem=False, verbose=0):
+@contextmanager
+def hessian_pool(workers, cores=None):
+    """
+    Provide the local process pool (see nifty.createLocalPool) for running the gradient calculations
+    of a finite difference Hessian in a number of worker processes, dividing the cores evenly among them.
+    An existing pool of the same size is used as it is; otherwise the pool is created for the duration
+    of the context, and the previous pool (if any) is created again afterwards.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes; if less than 2, no pool is used
+    cores : int
+        Number of CPU cores divided among the workers (default: all cores on this machine)
+
+    Yields
+    ------
+    threads : int
+        Number of threads used by each gradient calculation, or None if no pool is used
+    """
+    if workers < 2:
+        yield None
+        return
+    if cores is None: cores = os.cpu_count() or 1
+    threads = max(1, cores // workers)
+    previous = getLocalPool()
+    if previous is not None and previous.workers == workers and previous.threads == threads:
+        yield threads
+        return
+    settings = None if previous is None else (previous.cores, previous.threads, previous.workers)
+    createLocalPool(cores, threads=threads, workers=workers)
+    try:
+        yield threads
+    finally:
+        if settings is None:
+            destroyLocalPool()
+        else:
+            createLocalPool(settings[0], threads=settings[1], workers=settings[2])
+
+def pool_gradients(engine, displacements, copydir, read_data=True, threads=None, callback=None):
+    """
+    Run the gradient calculations of displaced structures in the local process pool, storing the
+    results in the engine as they are completed.  If any calculation fails, the remaining ones are
+    cancelled and the error is raised.
+
+    Parameters
+    ----------
+    engine : Engine
+        Object containing methods for calculating energy and gradient
+    displacements : list
+        Tuples of the coordinates (in Bohr) and the calculation folder of each displaced structure
+    copydir : str
+        Folder whose scratch files are copied to each calculation folder
+    read_data : bool
+        Read the results from disk if they exist
+    threads : int
+        Number of threads used by each calculation
+    callback : function, optional
+        Called with the index of each displacement, its gradient and the number of completed
+        calculations, in the order that the calculations are completed
+
+    Returns
+    -------
+    grads : list
+        Gradients of the displaced structures, in the same order as the displacements
+    """
+    grads = [None for i in range(len(displacements))]
+    futures = {}
+    try:
+        for k, (coords_d, dirname_d) in enumerate(displacements):
+            futures[engine.submit(coords_d, dirname_d, read_data=read_data, copydir=copydir, threads=threads)] = k
+        for icalc, future in enumerate(as_completed(futures)):
+            k = futures[future]
+            grads[k] = engine.collect(future, displacements[k][0])['gradient']
+            if callback is not None: callback(k, grads[k], icalc+1)
+    except:
+        for future in futures:
+            future.cancel()
+        raise
+    return grads
+
+def hessian_scheme(diff='central', step=1.0e-3, atoms=None, guess=None):
+    """
+    Describe the finite difference scheme used to calculate a Hessian.  This is written in the
+    header of hessian.txt, so that Hessian data calculated using another scheme is not read.
+    Files without a header were calculated using the default scheme.
+    """
+    scheme = "%s differences, step %.1e bohr" % (diff, step)
+    if atoms is None:
+        return scheme + ", all atoms displaced"
+    fill = "zero matrix" if guess is None else "guess Hessian"
+    return scheme + ", atoms %s displaced, other elements from %s" % (commadash(atoms), fill)
+
+def read_hessian_scheme(hesstxt):
+    """
+    Return the finite difference scheme in the header of a Hessian data file
+    written by calc_cartesian_hessian() or calc_lowest_hessian().
+    """
+    with open(hesstxt) as f:
+        line = f.readline()
+    if line.startswith('#'):
+        return line[1:].strip()
+    return hessian_scheme()
+
+def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bigchem=False, workers=0, cores=None,
+                           diff='central', step=1.0e-3, atoms=None, guess=None, verbose=0):
     """ 
     Calculate the Cartesian Hessian using finite difference, and/or read data from disk. 
     Data is stored in a folder <prefix>.tmp/hessian, with gradient calculations found in
@@ -57,6 +165,24 @@ def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bi
         Directory name for files to be written, i.e. <prefix>.tmp
     read_data : bool
         Read Hessian data from disk if valid
+    bigchem : bool
+        Use BigChem to run the gradient calculations in parallel
+    workers : int
+        If larger than 1, run the gradient calculations in a local pool of this many worker processes
+    cores : int
+        Number of CPU cores divided among the workers (default: all cores on this machine)
+    diff : str
+        'central' differences (2 gradients per coordinate), or 'forward' differences
+        (1 gradient per coordinate, reusing the gradient of the central point)
+    step : float
+        Finite difference step size in Bohr
+    atoms : list, optional
+        Indices (starting from zero) of the atoms to be displaced; default is all atoms
+    guess : np.ndarray, optional
+        (Nx3)x(Nx3) array used for the Hessian elements between atoms that are not displaced;
+        default is to set them to zero
+    verbose : int
+        Print information about each gradient calculation
         
     Returns
     -------
@@ -65,6 +191,8 @@ def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bi
         Files are also written to <prefix.tmp>/hessian.
     """
     nc = len(coords)
+    if atoms is not None: atoms = sorted(set(atoms))
+    scheme = hessian_scheme(diff, step, atoms, guess)
     # Attempt to read existing Hessian data if it exists.
     # Read from files hessian.txt/coords.xyz, hessian_1.txt/coords_1.xyz, etc.
     counter = 0
@@ -80,8 +208,11 @@ def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bi
             if Hx.shape[0] == nc:
                 hess_mol = Molecule(hessxyz)
                 if np.allclose(coords.reshape(-1, 3)*bohr2ang, hess_mol.xyzs[0], atol=1e-6):
-                    logger.info("Using Hessian matrix read from file: %s\n" % hesstxt)
-                    return Hx
+                    if read_hessian_scheme(hesstxt) == scheme:
+                        logger.info("Using Hessian matrix read from file: %s\n" % hesstxt)
+                        return Hx
+                    logger.info("Hessian matrix in %s was calculated using %s; not reading it\n"
+                                % (hesstxt, read_hessian_scheme(hesstxt)))
         elif counter >= 1:
             logger.info("Valid Hessian data not found, calculating from scratch.\n")
             break
@@ -105,32 +236,68 @@ def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bi
         if os.path.exists(os.path.join(dirname, "hessian", "displace")):
             shutil.rmtree(os.path.join(dirname, "hessian", "displace"))
     # Calculate Hessian using finite difference
+    if diff not in ['central', 'forward']:
+        raise ValueError("Finite difference scheme must be either 'central' or 'forward'")
     # Finite difference step
-    h = 1.0e-3
+    h = step
+    # Indices of the Cartesian coordinates to be displaced
+    if atoms is None:
+        cidx = np.arange(nc)
+    else:
+        if len(atoms) == 0 or min(atoms) < 0 or max(atoms) >= nc//3:
+            raise ValueError("Atoms to be displaced must be a nonempty list of atom indices from 0 to %i" % (nc//3-1))
+        cidx = np.array([3*a+j for a in atoms for j in range(3)], dtype=int)
+    # Each displacement is given by the coordinate index and the sign of the step.
+    # Forward differences use the gradient of the central point instead of a backward step.
+    signs = [1, -1] if diff == 'central' else [1]
+    displacements = [(i, sign) for i in cidx for sign in signs]
+    ngrad = len(displacements)
+    def displaced(i, sign):
+        coords_d = coords.copy()
+        coords_d[i] += sign*h
+        return coords_d
+    def displaced_dirname(i, sign):
+        return os.path.join(dirname, "hessian/displace/%03i%s" % (i+1, 'p' if sign == 1 else 'm'))
+    logger.info("Calculating Cartesian Hessian using finite difference on Cartesian gradients (%i grads total)\n"
+                % ngrad)
+    # Print the cost and estimated accuracy of the chosen scheme.  The truncation error assumes
+    # energy derivatives of order 1 a.u., and the gradients are assumed to have a precision of 1e-6 a.u.
+    logger.info(" %s differences with a step of %.1e bohr; %i of %i atoms displaced, costing %i gradients"
+                " (%.0f%% of a full central difference Hessian)\n"
+                % (diff.capitalize(), h, len(cidx)//3, nc//3, ngrad, 100.0*ngrad/(2*nc)))
+    if diff == 'central':
+        logger.info(" Estimated error of Hessian elements: %.1e (truncation, O(h^2))"
+                    " + %.1e (gradient precision / 2h) a.u.\n"
+                    % (h**2/6, 1e-6/(2*h)))
+    else:
+        logger.info(" Estimated error of Hessian elements: %.1e (truncation, O(h))"
+                    " + %.1e (gradient precision / h) a.u.\n"
+                    % (h/2, 1e-6/h))
+    if atoms is not None:
+        logger.info(" Hessian elements between atoms that are not displaced are taken from the %s\n"
+                    % ("guess Hessian" if guess is not None else "zero matrix"))
     wq = getWorkQueue()
-    Hx = np.zeros((nc, nc), dtype=float)
-    logger.info("Calculating Cartesian Hessian using finite difference on Cartesian gradients (%i grads total)\n" % (2*nc))
+    grads = {}
+    # Rows of the Hessian corresponding to the displaced coordinates
+    rows = np.zeros((len(cidx), nc), dtype=float)
+    assembled = set()
+    if diff == 'forward':
+        g0 = engine.calc(coords, dirname, read_data=read_data)['gradient']
+    def assemble_row(k):
+        i = cidx[k]
+        if diff == 'central':
+            rows[k] = (grads[(i, 1)]-grads[(i, -1)])/(2*h)
+        else:
+            rows[k] = (grads[(i, 1)]-g0)/h
+        assembled.add(k)
     if wq:
-        for i in range(nc):
-            if verbose >= 2: logger.info(" Submitting gradient calculation for coordinate %i/%i\n" % (i+1, nc))
-            coords[i] += h
-            dirname_d = os.path.join(dirname, "hessian/displace/%03ip" % (i+1))
-            engine.calc_wq(coords, dirname_d, read_data=read_data, copydir=dirname)
-            coords[i] -= 2*h
-            dirname_d = os.path.join(dirname, "hessian/displace/%03im" % (i+1))
-            engine.calc_wq(coords, dirname_d, read_data=read_data, copydir=dirname)
-            coords[i] += h
+        for icalc, (i, sign) in enumerate(displacements):
+            if verbose >= 2: logger.info(" Submitting gradient calculation %i/%i\n" % (icalc+1, ngrad))
+            engine.calc_wq(displaced(i, sign), displaced_dirname(i, sign), read_data=read_data, copydir=dirname)
         wq_wait(wq, print_time=600)
-        for i in range(nc):
-            if verbose >= 2: logger.info(" Reading gradient results for coordinate %i/%i\n" % (i+1, nc))
-            coords[i] += h
-            dirname_d = os.path.join(dirname, "hessian/displace/%03ip" % (i+1))
-            gfwd = engine.read_wq(coords, dirname_d)['gradient']
-            coords[i] -= 2*h
-            dirname_d = os.path.join(dirname, "hessian/displace/%03im" % (i+1))
-            gbak = engine.read_wq(coords, dirname_d)['gradient']
-            coords[i] += h
-            Hx[i] = (gfwd-gbak)/(2*h)
+        for icalc, (i, sign) in enumerate(displacements):
+            if verbose >= 2: logger.info(" Reading gradient result %i/%i\n" % (icalc+1, ngrad))
+            grads[(i, sign)] = engine.read_wq(displaced(i, sign), displaced_dirname(i, sign))['gradient']
 
     elif bigchem:
         # If BigChem is ready, it will be used to parallelize the Hessian calculation.
@@ -149,13 +316,8 @@ def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bi
         #Hx = rec.results.hessian
 
         # Creating a list containing qcio Molecule obejcts with different geometries.
-        molecules = []
-        for i in range(nc):
-            coords[i] += h
-            molecules.append(qcio_Molecule(symbols=elems, geometry=coords.reshape(-1,3)))
-            coords[i] -= 2*h
-            molecules.append(qcio_Molecule(symbols=elems, geometry=coords.reshape(-1,3)))
-            coords[i] += h
+        molecules = [qcio_Molecule(symbols=elems, geometry=displaced(i, sign).reshape(-1,3))
+                     for (i, sign) in displacements]
 
         # Submitting calculations
         outputs = group(compute.s(engine.__class__.__name__.lower(),
@@ -166,44 +328,73 @@ def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bi
 
         # Getting the records
         records = outputs.get(disable_sync_subtasks=False)
-        assert len(records) == nc*2
+        assert len(records) == ngrad
 
-        # Grouping the recrods
-        grouped_records = list(zip(records[::2], records[1::2]))
-
-        # Iterating through the grouped records to calculate the Hessian
-        for i, (fwd_rec, bak_rec) in enumerate(grouped_records):
+        # Iterating through the records to collect the gradients
+        for icalc, rec in enumerate(records):
             # Double checking the order
-            assert fwd_rec.input_data.extras["order"] == i*2
-            assert bak_rec.input_data.extras["order"] == fwd_rec.input_data.extras["order"] + 1
-            gfwd = fwd_rec.results.gradient.ravel()
-            gbak = bak_rec.results.gradient.ravel()
-            Hx[i] = (gfwd-gbak)/(2*h)
+            assert rec.input_data.extras["order"] == icalc
+            grads[displacements[icalc]] = rec.results.gradient.ravel()
 
         # Deleting the records in the backend
         outputs.forget()
 
+    elif workers > 1:
+        # Run the displaced gradient calculations in a local process pool, giving each worker a slice of the cores.
+        # Each displacement has its own folder, so an interrupted calculation can be restarted with read_data=True.
+        with hessian_pool(workers, cores) as threads:
+            logger.info("Running gradient calculations in %i local worker processes with %i threads each\n"
+                        % (workers, threads))
+            if not hasattr(engine, 'threads'):
+                logger.info("Note: the number of threads cannot be set for %s\n" % engine.__class__.__name__)
+            # First calculate a gradient at the central point, for linking scratch files.
+            engine.calc(coords, dirname, read_data=read_data)
+            ndone = dict([(i, 0) for i in cidx])
+            kidx = dict([(i, k) for k, i in enumerate(cidx)])
+            # Assemble the rows of the Hessian as the results come in
+            def finished(k, grad, ncalc):
+                i, sign = displacements[k]
+                grads[(i, sign)] = grad
+                ndone[i] += 1
+                if ndone[i] == len(signs):
+                    assemble_row(kidx[i])
+                    if verbose >= 1:
+                        logger.info(" Gradient calculations for coordinate %i/%i complete\n" % (kidx[i]+1, len(cidx)))
+                if ncalc % 10 == 0 or ncalc == ngrad:
+                    logger.info("%i / %i gradient calculations complete\n" % (ncalc, ngrad))
+            pool_gradients(engine, [(displaced(i, sign), displaced_dirname(i, sign)) for (i, sign) in displacements],
+                           dirname, read_data=read_data, threads=threads, callback=finished)
     else:
         # First calculate a gradient at the central point, for linking scratch files.
         engine.calc(coords, dirname, read_data=read_data)
-        for i in range(nc):
-            if verbose >= 1: logger.info(" Running gradient calculation for coordinate %i/%i\n" % (i+1, nc))
-            elif i%5 == 0: logger.info("%i / %i gradient calculations complete\n" % (i*2, nc*2))
-            coords[i] += h
-            dirname_d = os.path.join(dirname, "hessian/displace/%03ip" % (i+1))
-            gfwd = engine.calc(coords, dirname_d, read_data=read_data, copydir=dirname)['gradient']
-            coords[i] -= 2*h
-            dirname_d = os.path.join(dirname, "hessian/displace/%03im" % (i+1))
-            gbak = engine.calc(coords, dirname_d, read_data=read_data, copydir=dirname)['gradient']
-            coords[i] += h
-            Hx[i] = (gfwd-gbak)/(2*h)
-            if i == (nc-1) : logger.info("%i / %i gradient calculations complete\n" % (nc*2, nc*2))
+        for icalc, (i, sign) in enumerate(displacements):
+            if verbose >= 1:
+                logger.info(" Running gradient calculation for coordinate %i (%s)\n"
+                            % (i+1, '+' if sign == 1 else '-'))
+            elif icalc%10 == 0: logger.info("%i / %i gradient calculations complete\n" % (icalc, ngrad))
+            grads[(i, sign)] = engine.calc(displaced(i, sign), displaced_dirname(i, sign), read_data=read_data,
+                                           copydir=dirname)['gradient']
+        logger.info("%i / %i gradient calculations complete\n" % (ngrad, ngrad))
+    for k in range(len(cidx)):
+        if k not in assembled:
+            assemble_row(k)
+    if atoms is None:
+        Hx = rows
+        # Forward differences are not symmetric to within the truncation error
+        if diff == 'forward':
+            Hx = 0.5*(Hx+Hx.T)
+    else:
+        # Fill in the rows and columns of the displaced atoms, and symmetrize the block between them
+        Hx = np.zeros((nc, nc), dtype=float) if guess is None else np.array(guess, dtype=float)
+        Hx[cidx, :] = rows
+        Hx[:, cidx] = rows.T
+        Hx[np.ix_(cidx, cidx)] = 0.5*(rows[:, cidx]+rows[:, cidx].T)
     # Save Hessian to text file
     oldxyz = molecule.xyzs[0].copy()
     molecule.xyzs[0] = coords.reshape(-1, 3)*bohr2ang
     molecule[0].write(hessxyz)
     molecule.xyzs[0] = oldxyz
-    np.savetxt(hesstxt, Hx)
+    np.savetxt(hesstxt, Hx, header=scheme)
     # Delete displacement calcs because they take up too much space
     keep_displace = False
     if not keep_displace:
@@ -211,6 +402,221 @@ def calc_cartesian_hessian(coords, molecule, engine, dirname, read_data=True, bi
             shutil.rmtree(os.path.join(dirname, "hessian", "displace"))
     return Hx
 
+def calc_lowest_hessian(coords, molecule, engine, dirname, guess, nmodes=2, read_data=True, workers=0, cores=None,
+                        diff='central', step=1.0e-3, conv=1.0e-4, maxiter=20, verbose=0):
+    """
+    Calculate the lowest eigenpairs of the mass-weighted Cartesian Hessian using Davidson iterations,
+    where each Hessian-vector product is a finite difference of gradients displaced along the trial vector.
+    The trial vectors are seeded from the lowest vibrational modes of the guess Hessian, and the
+    returned Hessian is the guess Hessian with the computed eigenpairs in place of its lowest modes.
+    Gradient calculations are found in <prefix>.tmp/hessian/lowest, and are deleted at the end;
+    the updated Hessian is written to <prefix>.tmp/hessian/hessian_lowest.txt with the coordinates
+    in <prefix>.tmp/hessian/coords_lowest.xyz.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Nx3 array of Cartesian coordinates in atomic units
+    molecule : Molecule
+        Molecule object
+    engine : Engine
+        Object containing methods for calculating energy and gradient
+    dirname : str
+        Directory name for files to be written, i.e. <prefix>.tmp
+    guess : np.ndarray
+        (Nx3)x(Nx3) guess Hessian in Cartesian coordinates
+    nmodes : int
+        Number of lowest vibrational modes to converge
+    read_data : bool
+        Read the Hessian from disk if it was calculated at the same coordinates using the same scheme,
+        and the gradients of the displaced structures if they exist
+    workers : int
+        If larger than 1, run the gradient calculations in a local pool of this many worker processes
+    cores : int
+        Number of CPU cores divided among the workers (default: all cores on this machine)
+    diff : str
+        'central' or 'forward' differences for the Hessian-vector products
+    step : float
+        Norm of the Cartesian displacement in Bohr
+    conv : float
+        Convergence threshold for the norm of the residual vectors in mass-weighted atomic units
+    maxiter : int
+        Maximum number of Davidson iterations
+    verbose : int
+        Print information about each gradient calculation
+
+    Returns
+    -------
+    Hx : np.ndarray
+        (Nx3)x(Nx3) array containing the updated Cartesian Hessian.
+    """
+    if diff not in ['central', 'forward']:
+        raise ValueError("Finite difference scheme must be either 'central' or 'forward'")
+    nc = len(coords)
+    na = nc//3
+    scheme = "lowest %i modes, %s" % (nmodes, hessian_scheme(diff, step))
+    hesstxt = os.path.join(dirname, "hessian", "hessian_lowest.txt")
+    hessxyz = os.path.join(dirname, "hessian", "coords_lowest.xyz")
+    if read_data and os.path.exists(hesstxt) and os.path.exists(hessxyz):
+        Hx = np.loadtxt(hesstxt)
+        if Hx.shape == (nc, nc) and read_hessian_scheme(hesstxt) == scheme:
+            hess_mol = Molecule(hessxyz)
+            if np.allclose(coords.reshape(-1, 3)*bohr2ang, hess_mol.xyzs[0], atol=1e-6):
+                logger.info("Using Hessian matrix read from file: %s\n" % hesstxt)
+                return Hx
+    mass = np.array([PeriodicTable[j] for j in molecule.elem])
+    sqrtm3 = np.sqrt(np.repeat(mass, 3))
+    invsqrtm3 = 1.0/sqrtm3
+    mwHess_wavenumber = 1e10*np.sqrt(au2kj / (bohr2ang/10)**2)/(2*np.pi*c_lightspeed)
+    def wavenumber(eig):
+        return np.sign(eig)*mwHess_wavenumber*np.sqrt(np.abs(eig))
+    # Orthonormal basis of the translations and rotations in mass-weighted coordinates
+    xyz = coords.reshape(-1, 3)
+    xcm = xyz - np.sum(xyz*mass[:, np.newaxis], axis=0)/np.sum(mass)
+    TR = []
+    for ix in range(3):
+        tvec = np.zeros((na, 3))
+        tvec[:, ix] = 1.0
+        TR.append((tvec*np.sqrt(mass)[:, np.newaxis]).ravel())
+        TR.append((np.cross(np.eye(3)[ix], xcm)*np.sqrt(mass)[:, np.newaxis]).ravel())
+    TRsvd, TRsv, _ = np.linalg.svd(np.array(TR).T, full_matrices=False)
+    TR = TRsvd[:, TRsv > 1e-6*TRsv[0]]
+    # Orthonormal basis of the vibrations in mass-weighted coordinates
+    _, Vvib = np.linalg.eigh(np.eye(nc) - np.dot(TR, TR.T))
+    Vvib = Vvib[:, TR.shape[1]:]
+    nvib = Vvib.shape[1]
+    nmodes = min(nmodes, nvib)
+    # Mass-weighted guess Hessian and the starting vectors from its lowest vibrational modes
+    Hg = np.array(guess)*np.outer(invsqrtm3, invsqrtm3)
+    Hg = 0.5*(Hg+Hg.T)
+    gEig, gVec = np.linalg.eigh(np.dot(Vvib.T, np.dot(Hg, Vvib)))
+    Hg_diag = np.diag(Hg)
+    def orthonormalize(t, V):
+        """ Remove the translations, rotations and trial vectors from t, and return the normalized vector or None """
+        norm0 = np.linalg.norm(t)
+        for _ in range(2):
+            t = t - np.dot(TR, np.dot(TR.T, t))
+            if V.shape[1] > 0:
+                t = t - np.dot(V, np.dot(V.T, t))
+        if np.linalg.norm(t) < 1e-3*norm0:
+            return None
+        return t/np.linalg.norm(t)
+
+    logger.info("Calculating the lowest %i Hessian eigenvalues using Davidson iterations on finite difference"
+                " Hessian-vector products\n" % nmodes)
+    logger.info(" %s differences with a step of %.1e bohr, %i gradients per trial vector"
+                " (a full central difference Hessian costs %i gradients)\n"
+                % (diff.capitalize(), step, 2 if diff == 'central' else 1, 2*nc))
+    lowdir = os.path.join(dirname, "hessian", "lowest")
+    if not os.path.exists(os.path.join(dirname, "hessian")):
+        os.makedirs(os.path.join(dirname, "hessian"))
+    if not read_data and os.path.exists(lowdir):
+        shutil.rmtree(lowdir)
+    signs = [1, -1] if diff == 'central' else [1]
+    wq = getWorkQueue()
+    # Gradient at the central point; also used for linking scratch files.
+    g0 = engine.calc(coords, dirname, read_data=read_data)['gradient']
+    ngrad = 0
+    def hessian_vector_products(vecs, ivec0):
+        """ Calculate the mass-weighted Hessian-vector products of new trial vectors by finite difference """
+        displacements = []
+        for k, v in enumerate(vecs.T):
+            # Scale the displacement so that its norm in Cartesian coordinates is equal to the step
+            d = invsqrtm3*v
+            h = step/np.linalg.norm(d)
+            for sign in signs:
+                dirname_d = os.path.join(lowdir, "%03i%s" % (ivec0+k+1, 'p' if sign == 1 else 'm'))
+                displacements.append((coords + sign*h*d, dirname_d))
+        if wq:
+            for coords_d, dirname_d in displacements:
+                engine.calc_wq(coords_d, dirname_d, read_data=read_data, copydir=dirname)
+            wq_wait(wq, print_time=600)
+            grads = [engine.read_wq(coords_d, dirname_d)['gradient'] for coords_d, dirname_d in displacements]
+        elif threads is not None:
+            grads = pool_gradients(engine, displacements, dirname, read_data=read_data, threads=threads)
+        else:
+            grads = []
+            for coords_d, dirname_d in displacements:
+                if verbose >= 1: logger.info(" Running gradient calculation in %s\n" % dirname_d)
+                grads.append(engine.calc(coords_d, dirname_d, read_data=read_data, copydir=dirname)['gradient'])
+        W = np.zeros_like(vecs)
+        for k, v in enumerate(vecs.T):
+            d = invsqrtm3*v
+            h = step/np.linalg.norm(d)
+            if diff == 'central':
+                W[:, k] = invsqrtm3*(grads[2*k]-grads[2*k+1])/(2*h)
+            else:
+                W[:, k] = invsqrtm3*(grads[k]-g0)/h
+        # Remove the components of the products along the translations and rotations
+        W -= np.dot(TR, np.dot(TR.T, W))
+        return W, len(displacements)
+
+    V = np.zeros((nc, 0))
+    W = np.zeros((nc, 0))
+    new = np.dot(Vvib, gVec[:, :nmodes])
+    logger.info(" Lowest guess Hessian eigenvalues (cm^-1): %s\n"
+                % ' '.join("% .1f" % i for i in wavenumber(gEig[:nmodes])))
+    # Without a local pool, threads is None and the gradients are calculated serially
+    with hessian_pool(0 if wq else workers, cores) as threads:
+        for iteration in range(maxiter):
+            Wnew, n = hessian_vector_products(new, V.shape[1])
+            ngrad += n
+            V = np.hstack((V, new))
+            W = np.hstack((W, Wnew))
+            # Rayleigh-Ritz in the space of trial vectors
+            T = np.dot(V.T, W)
+            ritzEig, ritzVec = np.linalg.eigh(0.5*(T+T.T))
+            U = np.dot(V, ritzVec[:, :nmodes])
+            R = np.dot(W, ritzVec[:, :nmodes]) - U*ritzEig[:nmodes]
+            rnorm = np.linalg.norm(R, axis=0)
+            logger.info(" Davidson iteration %i (%i gradients): frequencies (cm^-1) %s residuals %s\n"
+                        % (iteration+1, ngrad, ' '.join("% .1f" % i for i in wavenumber(ritzEig[:nmodes])),
+                           ' '.join("%.2e" % i for i in rnorm)))
+            if np.all(rnorm < conv):
+                logger.info(" Converged the lowest %i Hessian eigenvalues using %i gradients\n" % (nmodes, ngrad))
+                break
+            # Davidson correction vectors preconditioned by the diagonal of the guess Hessian
+            new = np.zeros((nc, 0))
+            for k in range(nmodes):
+                if rnorm[k] < conv: continue
+                denom = ritzEig[k] - Hg_diag
+                denom[np.abs(denom) < 1e-2] = np.copysign(1e-2, denom[np.abs(denom) < 1e-2])
+                t = orthonormalize(R[:, k]/denom, np.hstack((V, new)))
+                if t is not None:
+                    new = np.hstack((new, t[:, np.newaxis]))
+            if new.shape[1] == 0 or V.shape[1] + new.shape[1] > nvib:
+                logger.info(" Davidson iterations cannot continue, using the current estimate of the lowest"
+                            " Hessian eigenvalues\n")
+                break
+        else:
+            logger.info(" Davidson iterations did not converge in %i iterations (%i gradients)\n" % (maxiter, ngrad))
+    # Replace the guess Hessian in the space of the computed modes with their eigenvalues.
+    # Eigenvalues of the guess Hessian outside of this space are raised if they are lower than
+    # the computed eigenvalues, so that the computed modes remain the lowest ones.
+    U = np.dot(V, ritzVec[:, :nmodes])
+    PU = np.eye(nc) - np.dot(U, U.T)
+    Hmw = np.dot(PU, np.dot(Hg, PU))
+    _, C = np.linalg.eigh(np.eye(nc) - np.dot(TR, TR.T) - np.dot(U, U.T))
+    C = C[:, TR.shape[1]+nmodes:]
+    if C.shape[1] > 0:
+        cEig, cVec = np.linalg.eigh(np.dot(C.T, np.dot(Hmw, C)))
+        shift = np.maximum(0.0, ritzEig[nmodes-1] - cEig)
+        if np.any(shift > 0):
+            logger.info(" Raised %i eigenvalues of the guess Hessian to % .1f cm^-1\n"
+                        % (np.sum(shift > 0), wavenumber(ritzEig[nmodes-1])))
+            CV = np.dot(C, cVec)
+            Hmw += np.dot(CV*shift, CV.T)
+    Hmw += np.dot(U*ritzEig[:nmodes], U.T)
+    Hx = Hmw*np.outer(sqrtm3, sqrtm3)
+    oldxyz = molecule.xyzs[0].copy()
+    molecule.xyzs[0] = coords.reshape(-1, 3)*bohr2ang
+    molecule[0].write(hessxyz)
+    molecule.xyzs[0] = oldxyz
+    np.savetxt(hesstxt, Hx, header=scheme)
+    if os.path.exists(lowdir):
+        shutil.rmtree(lowdir)
+    return Hx
+
 def frequency_analysis(coords, Hessian, elem=None, mass=None, energy=0.0, temperature=300.0, pressure=1.0, verbose=0, outfnm=None, note=None, wigner=None, ignore=0, normalized=True):
     """
     Parameters
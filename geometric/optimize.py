@@ -48,12 +48,15 @@ from numpy.linalg import multi_dot
 
 from .info import print_logo, print_citation
 from .internal import CartesianCoordinates, PrimitiveInternalCoordinates, DelocalizedInternalCoordinates
+from .molecule import Molecule
 from .ic_tools import check_internal_grad, check_internal_hess, write_displacements
-from .normal_modes import calc_cartesian_hessian, frequency_analysis
-from .step import brent_wiki, Froot, calc_drms_dmax, get_cartesian_norm, get_delta_prime, trust_step, force_positive_definite, update_hessian
+from .normal_modes import calc_cartesian_hessian, calc_lowest_hessian, frequency_analysis
+from .step import brent_wiki, Froot, calc_drms_dmax, get_cartesian_norm, get_delta_prime, trust_step, \
+    force_positive_definite, update_hessian, LBFGSHessian, EighCache, hessian_eigh, hessian_eigvals
 from .prepare import get_molecule_engine, parse_constraints
 from .params import OptParams, parse_optimizer_args
-from .nifty import row, col, flat, bohr2ang, ang2bohr, logger, bak, createWorkQueue, destroyWorkQueue, printcool_dictionary
+from .nifty import row, col, flat, bohr2ang, ang2bohr, logger, bak, createWorkQueue, destroyWorkQueue, getWorkQueue, \
+    wq_wait, createLocalPool, destroyLocalPool, getLocalPool, printcool_dictionary
 from .errors import InputError, HessianExit, EngineError, IRCError, GeomOptNotConvergedError, GeomOptStructureError, LinearTorsionError
 from .config import config_dir
 
@@ -103,6 +106,8 @@ class Optimizer(object):
         self.Iteration = 0
         # Counts how many steps it has been since checking the coordinate system
         self.CoordCounter = 0
+        # Eigendecomposition of the current Hessian, reused while it is unchanged (see step.EighCache)
+        self.eigh_cache = EighCache()
         # Current state, used to control logic of optimization loop.
         self.state = OPT_STATE.NEEDS_EVALUATION
         # Some more variables to be updated throughout the course of the optimization
@@ -111,6 +116,9 @@ class Optimizer(object):
         # Sanity check - if there's only one atom, it will probably crash
         if self.molecule.na < 2:
             raise InputError("Geometry optimizer assumes there are at least two atoms in the system")
+        # The limited-memory Hessian does not support the augmented Hessian used for constraints and rigid fragments.
+        if self.params.lbfgs and (self.IC.haveConstraints() or self.IC.rigid):
+            raise InputError("L-BFGS optimization (--lbfgs) cannot be used with constraints or rigid fragments")
         # Detect poor quality steps dominated by net translation and rotation.
         # Minimum ratio of (total displacement / aligned displacement), hard-coded parameter.
         self.lowq_tr_thre  = 5.0
@@ -120,6 +128,14 @@ class Optimizer(object):
         self.lowq_tr_limit = 1
         # Recalculate the Hessian after a trigger - for example if the energy changes by a lot during TS optimization.
         self.recalcHess = False
+        # The step that would be taken if the current step is rejected, which is evaluated at the
+        # same time as the current step if speculative evaluation is requested (see getFallbackStep).
+        self.fallback = None
+        self.speculate = self.params.speculate
+        if self.speculate and getWorkQueue() is None and getLocalPool() is None:
+            logger.warning("Speculative evaluation of fallback steps requires Work Queue (--wqport) "
+                           "or a local process pool (--cores); disabling\n")
+            self.speculate = False
         # IRC related information
         self.IRC_direction = self.params.irc_direction
         self.IRC_info = {"direction" : 1, "opt" : False, "total_disp" : 0.0,
@@ -136,6 +152,11 @@ class Optimizer(object):
             logger.info("> Job type: Intrinsic Reaction Coordinate method\n")
         else:
             logger.info("> Job type: Energy minimization\n")
+        if params.lbfgs:
+            logger.info("> Limited-memory BFGS Hessian storing up to %i updates\n" % params.lbfgs)
+        if self.speculate:
+            logger.info("> Fallback steps for rejected steps will be evaluated speculatively using %s\n"
+                        % ("Work Queue" if getWorkQueue() is not None else "the local process pool"))
             
         logger.info("> Maximum number of optimization cycles: %i\n" % params.maxiter)
         logger.info("> Initial / maximum trust radius (Angstrom): %.3f / %.3f\n" % (params.trust, params.tmax))
@@ -189,10 +210,10 @@ class Optimizer(object):
         # This method can be called at a different verbose level than the master
         # because it can occur inside a nested loop
         if not verbose: verbose = self.params.verbose
-        return get_delta_prime(v0, self.X, self.G, self.H, self.IC, self.params.transition, verbose)
+        return get_delta_prime(v0, self.X, self.G, self.H, self.IC, self.params.transition, verbose, self.eigh_cache)
 
     def createFroot(self, v0):
-        return Froot(self.trust, v0, self.X, self.G, self.H, self.IC, self.params)
+        return Froot(self.trust, v0, self.X, self.G, self.H, self.IC, self.params, self.eigh_cache)
 
     def refreshCoordinates(self):
         """
@@ -214,20 +235,44 @@ class Optimizer(object):
         """
         Build a new internal coordinate system from current Cartesians and replace the current one if different.
         """
+        t0 = time.time()
         # Reset the check counter
         self.CoordCounter = 0
-        # Build a new molecule object and connectivity graph
-        newmol = deepcopy(self.molecule)
-        newmol.xyzs[0] = self.X.reshape(-1,3) * bohr2ang
-        newmol.build_topology()
+        # Build the bonds of the current structure in a molecule object holding only what is needed for them
+        newmol = Molecule()
+        newmol.elem = self.molecule.elem
+        newmol.xyzs = [self.X.reshape(-1,3) * bohr2ang]
+        for key in ['resid', 'boxes']:
+            if key in self.molecule.Data:
+                newmol.Data[key] = self.molecule.Data[key]
+        newmol.top_settings = deepcopy(self.molecule.top_settings)
+        newmol.top_settings['topframe'] = 0
+        newmol.build_bonds()
+        # Compare the bond graph with the one the primitives were made from, and add or remove
+        # only the primitives that are affected.  The DLCs are rebuilt only if the primitives changed.
+        if not recover and not cartesian and not isinstance(self.IC, CartesianCoordinates):
+            changed = self.IC.updatePrimitives(newmol)
+            if changed is not None:
+                if changed:
+                    logger.info("\x1b[1;94mInternal coordinate system may have changed\x1b[0m\n")
+                    self.refreshCoordinates()
+                    logger.info("Coordinate system check: updated primitives (%.3f s)\n" % (time.time()-t0))
+                else:
+                    logger.info("Coordinate system check: bonds and primitives unchanged (%.3f s)\n"
+                                % (time.time()-t0))
+                return changed
         # Build the new internal coordinate system
         if cartesian:
             if self.IC.haveConstraints():
                 raise ValueError("Cannot continue a constrained optimization; please implement constrained optimization in Cartesian coordinates")
             IC1 = CartesianCoordinates(newmol)
         else:
-            IC1 = self.IC.__class__(newmol, connect=self.IC.connect, addcart=self.IC.addcart, build=False, conmethod=self.IC.conmethod, rigid=self.IC.rigid)
+            IC1 = self.IC.__class__(newmol, connect=self.IC.connect, addcart=self.IC.addcart, build=False,
+                                    conmethod=self.IC.conmethod, rigid=self.IC.rigid, sparse=self.IC.sparse,
+                                    gsolver=self.IC.gsolver, greuse=self.IC.greuse, dlcsolver=self.IC.dlcsolver,
+                                    blockdlc=self.IC.blockdlc, blockthreads=self.IC.blockthreads)
             if self.IC.haveConstraints(): IC1.getConstraints_from(self.IC)
+        IC1.setCacheBudget(self.IC.cache.budget)
         # Check for differences
         changed = (IC1 != self.IC)
         if changed:
@@ -238,14 +283,17 @@ class Optimizer(object):
         if changed or recover or cartesian:
             self.IC = IC1
             self.refreshCoordinates()
+            logger.info("Coordinate system check: rebuilt coordinate system (%.3f s)\n" % (time.time()-t0))
             return True
-        else: return False
+        else:
+            logger.info("Coordinate system check: primitives unchanged (%.3f s)\n" % (time.time()-t0))
+            return False
 
     def trust_step(self, iopt, v0, verbose=None):
         # This method can be called at a different verbose level than the master
         # because it can occur inside a nested loop
         if not verbose: verbose = self.params.verbose
-        return trust_step(iopt, v0, self.X, self.G, self.H, self.IC, self.params.transition, verbose)
+        return trust_step(iopt, v0, self.X, self.G, self.H, self.IC, self.params.transition, verbose, self.eigh_cache)
 
     def newCartesian(self, dy):
         if self.IC.haveConstraints() and self.params.enforce:
@@ -280,10 +328,53 @@ class Optimizer(object):
         if self.params.irc:
             self.H0 = self.IC.calcHess(self.coords.copy(), self.Gx_init, self.Hx0)
         else:
-            self.H0 = self.IC.guess_hessian(self.coords)
-        self.H = update_hessian(self.IC, self.H0, self.X_hist, self.Gx_hist, self.params, trust_limit=True, max_updates=100)
+            self.H0 = self.guess_hessian(self.coords)
+        self.H = update_hessian(self.IC, self.H0, self.X_hist, self.Gx_hist, self.params, trust_limit=True,
+                                max_updates=100, cache=self.eigh_cache)
+
+    def guess_hessian(self, coords):
+        """
+        Return the guess Hessian for the internal coordinate system, which is a
+        limited-memory BFGS Hessian starting from the diagonal of the guess if requested.
+        """
+        if self.params.lbfgs:
+            return LBFGSHessian(self.IC.guess_hessian_diagonal(coords), self.params.lbfgs)
+        return self.IC.guess_hessian(coords)
 
-    def frequency_analysis(self, hessian, suffix, afterOpt):
+    def calcCartesianHessian(self, read_data=True, final=False):
+        """
+        Calculate the Cartesian Hessian by finite difference at the current coordinates
+        using the options in self.params.  When only some atoms are displaced or only the
+        lowest eigenpairs are calculated, the other elements come from the guess Hessian
+        transformed to Cartesian coordinates.  The Hessian of the final structure (final=True)
+        is used for frequency analysis, so the lowest eigenpairs are not used for it.
+        """
+        lowest = self.params.hessian_modes and not final
+        guess = None
+        if lowest or (self.params.hessian_atoms is not None and self.params.hessian_fill == 'guess'):
+            guess = self.IC.calcHessCart(self.X, self.IC.calcGrad(self.X, self.gradx), self.IC.guess_hessian(self.X))
+        if lowest:
+            return calc_lowest_hessian(self.X, self.molecule, self.engine, self.dirname, guess,
+                                       nmodes=self.params.hessian_modes, read_data=read_data,
+                                       workers=self.params.hessian_workers, cores=self.params.cores,
+                                       diff=self.params.hessian_diff, step=self.params.hessian_step,
+                                       verbose=self.params.verbose)
+        return calc_cartesian_hessian(self.X, self.molecule, self.engine, self.dirname, read_data=read_data,
+                                      bigchem=self.params.bigchem, workers=self.params.hessian_workers,
+                                      cores=self.params.cores, diff=self.params.hessian_diff,
+                                      step=self.params.hessian_step, atoms=self.params.hessian_atoms, guess=guess,
+                                      verbose=self.params.verbose)
+
+    def frequency_analysis(self, hessian, suffix, afterOpt, lowest=False):
+        if lowest:
+            # Apart from the lowest modes, the Hessian is the guess Hessian;
+            # only the modes needed to start an IRC are kept.
+            logger.warning("Skipping frequency analysis because only the lowest %i modes of the Hessian "
+                           "were calculated (--hessian-modes)\n" % self.params.hessian_modes)
+            if self.params.irc:
+                self.TSWavenum, self.TSNormal_modes_x, _ = frequency_analysis(self.X, hessian, self.molecule.elem,
+                                                                              ignore=self.params.ignore_modes)
+            return
         do_wigner = False
         if self.params.wigner:
             # Wigner sampling should only be performed on the final Hessian calculation of a run
@@ -332,9 +423,10 @@ class Optimizer(object):
         if self.params.hessian == 'each' or self.recalcHess:
             # Hx is assumed to be the Cartesian Hessian at the current step.
             # Otherwise we use the variable name Hx0 to avoid almost certain confusion.
-            self.Hx = calc_cartesian_hessian(self.X, self.molecule, self.engine, self.dirname, read_data=True, bigchem=self.params.bigchem, verbose=self.params.verbose)
+            self.Hx = self.calcCartesianHessian(read_data=True)
             if self.params.frequency:
-                self.frequency_analysis(self.Hx, 'iter%03i' % self.Iteration, False)
+                self.frequency_analysis(self.Hx, 'iter%03i' % self.Iteration, False,
+                                        lowest=bool(self.params.hessian_modes))
             if self.recalcHess:
                 logger.info(">>> Recomputed the Hessian from scratch <<<\n")
                 self.H0 = self.IC.calcHess(self.X, self.gradx, self.Hx)
@@ -344,14 +436,15 @@ class Optimizer(object):
                 self.recalcHess = False
         elif self.Iteration == 0:
             if self.params.hessian in ['first', 'stop', 'first+last'] and not hasattr(self.params, 'hess_data'):
-                self.Hx0 = calc_cartesian_hessian(self.X, self.molecule, self.engine, self.dirname, read_data=True, bigchem=self.params.bigchem, verbose=self.params.verbose)
+                self.Hx0 = self.calcCartesianHessian(read_data=True)
                 logger.info(">> Initial Cartesian Hessian Eigenvalues\n")
                 self.SortedEigenvalues(self.Hx0)
                 if self.params.frequency:
-                    self.frequency_analysis(self.Hx0, 'first', False)
+                    self.frequency_analysis(self.Hx0, 'first', False, lowest=bool(self.params.hessian_modes))
                 if self.params.hessian == 'stop':
                     logger.info("Exiting as requested after Hessian calculation.\n")
-                    logger.info("Cartesian Hessian is stored in %s/hessian/hessian.txt.\n" % self.dirname)
+                    logger.info("Cartesian Hessian is stored in %s/hessian/%s.\n"
+                                % (self.dirname, "hessian_lowest.txt" if self.params.hessian_modes else "hessian.txt"))
                     raise HessianExit
                     # sys.exit(0)
             elif hasattr(self.params, 'hess_data'):
@@ -415,11 +508,16 @@ class Optimizer(object):
             self.H0 = self.IC.calcHess(self.X, self.gradx, self.Hx0)
         else:
             # Form guess Hessian if initial Hessian is not provided
-            self.H0 = self.IC.guess_hessian(self.coords)
+            self.H0 = self.guess_hessian(self.coords)
         self.H = self.H0.copy()
 
     def SortedEigenvalues(self, H):
-        Eig = sorted(np.linalg.eigh(H)[0])
+        if isinstance(H, LBFGSHessian):
+            # Eigenvalues are not computed for the limited-memory Hessian
+            logger.info("L-BFGS Hessian: %i updates stored\n" % len(H.S))
+            return None
+        # Uses the stored eigendecomposition if the Hessian has not changed
+        Eig = hessian_eigvals(H, self.eigh_cache)
         if self.params.transition and len(Eig) >= 12:
             # logger.info("Hessian Eigenvalues:  %.3e %.3e %.3e %.3e %.3e %.3e %.3e %.3e %.3e ... %.3e %.3e %.3e\n" %
             #             (Eig[0],Eig[1],Eig[2],Eig[3],Eig[4],Eig[5],Eig[6],Eig[7],Eig[8],Eig[-3],Eig[-2],Eig[-1]))
@@ -593,31 +691,50 @@ class Optimizer(object):
         self.Iteration += 1
         return dy
 
-    def optimize_step(self):
-        # This function is identical to the previous version without IRC (a copy of lines 426-504)
-        params = self.params
+    def prepare_step(self):
+        """
+        Checks and bookkeeping at the start of each step, for steps obtained in optimize_step()
+        as well as fallback steps that were evaluated together with the rejected step.
+        """
         if np.isnan(self.G).any():
             raise RuntimeError("Gradient contains nan - check output and temp-files for possible errors")
-        if np.isnan(self.H).any():
+        if not self.params.lbfgs and np.isnan(self.H).any():
             raise RuntimeError("Hessian contains nan - check output and temp-files for possible errors")
         self.Iteration += 1
         if (self.Iteration%5) == 0:
-            self.engine.clearCalcs()
-            self.IC.clearCache()
+            # Keep the result of an evaluated fallback step, which is used after taking the step
+            keep = [self.fallback['X']] if (self.fallback is not None and self.fallback['evaluated']) else []
+            self.engine.clearCalcs(keep=keep)
+        # Are we far from constraint satisfaction?
+        self.farConstraints = self.IC.haveConstraints() and self.IC.maxConstraintViolation(self.X) > 1e-1
+
+    def optimize_step(self):
+        # This function is identical to the previous version without IRC (a copy of lines 426-504)
+        params = self.params
+        self.fallback = None
+        self.prepare_step()
 
         # At the start of the loop, the optimization variables, function value, gradient and Hessian are known.
         # (i.e. self.Y, self.E, self.G, self.H)
         if params.verbose: self.IC.printRotations(self.X)
-        Eig = self.SortedEigenvalues(self.H)
-        Emin = Eig[0].real
-        if params.transition:
-            v0 = 1.0
-        elif Emin < params.epsilon:
-            v0 = params.epsilon-Emin
-        else:
+        if params.lbfgs:
+            # The L-BFGS Hessian is positive definite, so the eigenvalues are not needed
+            # and the multiple of the identity added to the Hessian starts from zero.
+            self.SortedEigenvalues(self.H)
             v0 = 0.0
-        # Are we far from constraint satisfaction?
-        self.farConstraints = self.IC.haveConstraints() and self.IC.maxConstraintViolation(self.X) > 1e-1
+        else:
+            if not (self.IC.haveConstraints() or self.IC.rigid):
+                # The step is computed from the eigendecomposition of the Hessian, which is
+                # obtained here (if not already stored) and reused for each trial step.
+                hessian_eigh(self.H, self.eigh_cache)
+            Eig = self.SortedEigenvalues(self.H)
+            Emin = Eig[0].real
+            if params.transition:
+                v0 = 1.0
+            elif Emin < params.epsilon:
+                v0 = params.epsilon-Emin
+            else:
+                v0 = 0.0
         ### OBTAIN AN OPTIMIZATION STEP ###
         # The trust radius is to be computed in Cartesian coordinates.
         # First take a full-size optimization step
@@ -675,8 +792,89 @@ class Optimizer(object):
             # Finally, take an internal coordinate step of the desired length.
             dy, _ = self.trust_step(iopt, v0, verbose=(self.params.verbose+1 if self.params.verbose >= 2 else 0))
 
+        if self.speculate:
+            self.fallback = self.getFallbackStep(v0, dy)
         return dy
 
+    def getFallbackStep(self, v0, dy):
+        """
+        Obtain the step that would be taken if the step dy is rejected, i.e. the step
+        from the current coordinates with the trust radius reduced as in evaluateStep().
+
+        Parameters
+        ----------
+        v0 : float
+            Initial guess for the number that is added to the Hessian diagonal
+        dy : np.ndarray
+            Internal coordinate step that is about to be taken
+
+        Returns
+        -------
+        dict or None
+            Contains the internal coordinate step 'dy', the new Cartesian coordinates 'X', their
+            Cartesian step size 'cnorm', the reduced trust radius 'trust' and the starting
+            coordinates 'Xbase'.  None is returned if the step cannot be rejected (i.e. the
+            trust radius is already at the minimum), or if a valid step could not be obtained.
+        """
+        params = self.params
+        cnorm = self.get_cartesian_norm(dy)
+        trust = max(params.tmin, min(self.trust, cnorm)/2)
+        if self.trust <= params.tmin or trust >= cnorm:
+            return None
+        # Find the step whose Cartesian step size matches the reduced trust radius, same as optimize_step()
+        dy_full, _, __ = self.get_delta_prime(v0)
+        inorm = np.linalg.norm(dy_full)
+        froot = Froot(trust, v0, self.X, self.G, self.H, self.IC, params, self.eigh_cache)
+        froot.stores[inorm] = self.get_cartesian_norm(dy_full)
+        if froot.stores[inorm] <= trust:
+            return None
+        iopt = brent_wiki(froot.evaluate, 0.0, inorm, trust, cvg=0.1, obj=froot, verbose=params.verbose)
+        if froot.brentFailed and froot.stored_arg is not None:
+            iopt = froot.stored_arg
+        dy_fb, _ = self.trust_step(iopt, v0)
+        if self.IC.haveConstraints() and params.enforce:
+            X_fb = self.IC.newCartesian_withConstraint(self.X, dy_fb, thre=params.enforce, verbose=params.verbose)
+        else:
+            X_fb = self.IC.newCartesian(self.X, dy_fb, params.verbose)
+        if self.IC.bork:
+            return None
+        if params.verbose: logger.info("  Optimizer.step : Fallback step with trust radius %.4f obtained\n" % trust)
+        return {'dy' : dy_fb, 'X' : X_fb, 'cnorm' : calc_drms_dmax(X_fb, self.X)[int(params.usedmax)],
+                'trust' : trust, 'Xbase' : self.X.copy(), 'evaluated' : False}
+
+    def evaluateSpeculative(self):
+        """
+        Evaluate the energies and gradients of the current step and the fallback step at the same
+        time using Work Queue or the local process pool.  The results are stored in the engine and
+        used by calcEnergyForce().
+        """
+        dirname_fb = os.path.join(self.dirname, "fallback")
+        if getWorkQueue() is None:
+            # The fallback step is submitted first, so the scratch files are copied
+            # before the current step overwrites them
+            futures = [self.engine.submit(self.fallback['X'], dirname_fb, copydir=self.dirname),
+                       self.engine.submit(self.X, self.dirname)]
+            # If the current step failed, the error will be raised again by calcEnergyForce()
+            if futures[1].exception() is None:
+                self.engine.collect(futures[1], self.X)
+            if futures[0].exception() is None:
+                self.engine.collect(futures[0], self.fallback['X'])
+                self.fallback['evaluated'] = True
+            return
+        try:
+            self.engine.calc_wq(self.X, self.dirname)
+            self.engine.calc_wq(self.fallback['X'], dirname_fb, copydir=self.dirname)
+        except NotImplementedError:
+            logger.warning("Speculative evaluation of fallback steps requires Work Queue support in the engine; "
+                           "disabling\n")
+            self.speculate = False
+            self.fallback = None
+            return
+        wq_wait(getWorkQueue(), print_time=600)
+        self.engine.read_wq(self.X, self.dirname)
+        self.engine.read_wq(self.fallback['X'], dirname_fb)
+        self.fallback['evaluated'] = True
+
 
     def step(self):
         if self.params.irc:
@@ -688,6 +886,13 @@ class Optimizer(object):
                 dy = self.optimize_step()
             else:
                 dy = self.IRC_step()
+        elif self.fallback is not None:
+            """
+            Take the fallback step that was evaluated together with the rejected step.
+            """
+            self.prepare_step()
+            dy = self.fallback['dy']
+            logger.info("Taking the fallback step evaluated together with the rejected step\n")
         else:
             """
             Take an optimization step.
@@ -697,7 +902,8 @@ class Optimizer(object):
         if dy is None: return
 
         ### Before updating any of our variables, copy current variables to "previous"
-        self.cnorm = self.get_cartesian_norm(dy)
+        fallback = self.fallback if (self.fallback is not None and self.fallback['evaluated']) else None
+        self.cnorm = fallback['cnorm'] if fallback is not None else self.get_cartesian_norm(dy)
         ### DONE OBTAINING THE STEP ###
         if isinstance(self.IC, PrimitiveInternalCoordinates):
             idx = np.argmax(np.abs(dy))
@@ -716,15 +922,24 @@ class Optimizer(object):
         self.Eprev = self.E
         ### Update the Internal Coordinates ###
         X0 = self.X.copy()
-        self.newCartesian(dy)
+        if fallback is not None:
+            self.X = fallback['X'].copy()
+            self.fallback = None
+        else:
+            self.newCartesian(dy)
         ## The "actual" dy may be different from the one passed to newCartesian(),
         ## for example if we enforce constraints or don't get the step we expect.
         dy = self.IC.calcDiff(self.X, X0)
         # dyp = self.IC.Prims.calcDiff(self.X, X0)
         # print("Actual dy:", dy)
         self.Y += dy
-        self.expect = flat(0.5*multi_dot([row(dy),self.H,col(dy)]))[0] + np.dot(dy,self.G)
+        if self.params.lbfgs:
+            self.expect = 0.5*np.dot(dy, self.H.dot(dy)) + np.dot(dy,self.G)
+        else:
+            self.expect = flat(0.5*multi_dot([row(dy),self.H,col(dy)]))[0] + np.dot(dy,self.G)
         # self.expectdG = np.dot(self.H, col(dy).flatten())
+        if self.fallback is not None:
+            self.evaluateSpeculative()
         self.state = OPT_STATE.NEEDS_EVALUATION
 
     def reset_irc(self):
@@ -857,6 +1072,9 @@ class Optimizer(object):
         assert self.state == OPT_STATE.NEEDS_EVALUATION
         # Shorthand for self.params
         params = self.params
+        # The fallback step is only kept if this step is rejected
+        fallback = self.fallback
+        self.fallback = None
         # Write current optimization trajectory to file
         if self.params.xyzout is not None: 
             self.progress.write(self.params.xyzout)
@@ -1021,6 +1239,10 @@ class Optimizer(object):
                 self.E = self.Eprev
                 self.engine.load_guess_files(self.dirname)
                 self.recalcHess = False
+                # If the fallback step was evaluated together with this step, it is taken next
+                if (fallback is not None and fallback['evaluated'] and np.array_equal(fallback['Xbase'], self.X)
+                    and np.abs(fallback['trust']-self.trust) < 1e-3*self.trust):
+                    self.fallback = fallback
                 return
 
         # Append steps to history (for rebuilding Hessian)
@@ -1058,7 +1280,8 @@ class Optimizer(object):
         return
 
     def UpdateHessian(self):
-        self.H = update_hessian(self.IC, self.H, [self.X, self.Xprev], [self.gradx, self.Gxprev], self.params, trust_limit=False, max_updates=1)
+        self.H = update_hessian(self.IC, self.H, [self.X, self.Xprev], [self.gradx, self.Gxprev], self.params,
+                                trust_limit=False, max_updates=1, cache=self.eigh_cache)
         
     def optimizeGeometry(self):
         """
@@ -1077,17 +1300,29 @@ class Optimizer(object):
                 # call calcEnergyForce() which will compute the cartesian Hessian,
                 # convert it to IC, and then store it.
                 self.calcEnergyForce()
+        if self.params.verbose:
+            stats = self.IC.cacheStats()
+            logger.info("Internal coordinate cache: %i hits, %i misses, %i evictions, %i entries using %.1f MB\n"
+                        % (stats['hits'], stats['misses'], stats['evictions'], stats['entries'],
+                           stats['nbytes']/1024**2))
         if self.state == OPT_STATE.FAILED:
             raise GeomOptNotConvergedError("Optimizer.optimizeGeometry() failed to converge.")
+        return self.finishOptimization()
+
+    def finishOptimization(self):
+        """
+        Tasks performed after the optimization has converged, such as
+        writing out the approximate Hessian or calculating the final Hessian.
+        """
         # If we want to save the Hessian used by the optimizer (in Cartesian coordinates)
         if self.params.write_cart_hess:
             # One last Hessian update before writing it out
             self.UpdateHessian()
             logger.info("Saving current approximate Hessian (Cartesian coordinates) to %s" % self.params.write_cart_hess)
-            Hx = self.IC.calcHessCart(self.X, self.G, self.H)
+            Hx = self.IC.calcHessCart(self.X, self.G, self.H.toarray() if self.params.lbfgs else self.H)
             np.savetxt(self.params.write_cart_hess, Hx, fmt='% 14.10f')
         if self.params.hessian in ['last', 'first+last', 'each']:
-            Hx = calc_cartesian_hessian(self.X, self.molecule, self.engine, self.dirname, read_data=False, bigchem=self.params.bigchem, verbose=self.params.verbose)
+            Hx = self.calcCartesianHessian(read_data=False, final=True)
             if self.params.frequency:
                 self.frequency_analysis(Hx, 'last', True)
         return self.progress
@@ -1154,6 +1389,174 @@ def Optimize(coords, molecule, IC, engine, dirname, params, print_info=True):
     optimizer = Optimizer(coords, molecule, IC, engine, dirname, params, print_info)
     return optimizer.optimizeGeometry()
 
+class BatchOptimizer(object):
+    """
+    Run many geometry optimizations at the same time by driving their Optimizer objects in lockstep.
+    In each round, every optimizer takes a step and the energies and gradients of all new structures
+    are evaluated together by calcBatch(), which may be overridden to use a batched engine (for example
+    a neural network potential evaluating all structures at once on the GPU).  Optimizations that
+    converge or fail are retired independently while the others continue.
+    """
+    def __init__(self, optimizers, verbose=0):
+        """
+        Parameters
+        ----------
+        optimizers : list of Optimizer
+            Newly created Optimizer objects, each with its own engine and temporary directory
+        verbose : int
+            Print information about each round
+        """
+        self.optimizers = list(optimizers)
+        self.verbose = verbose
+        # Status of each optimization is one of 'running', 'converged' or 'failed'
+        self.status = ['running' for i in range(len(self.optimizers))]
+        # Exception raised by each failed optimization
+        self.errors = [None for i in range(len(self.optimizers))]
+        self.stats = {'rounds' : 0, 'gradients' : 0, 'time' : 0.0}
+
+    def calcBatch(self, optimizers):
+        """
+        Calculate the energies and gradients of the current structures of a number of optimizers.
+        Calculations are submitted to Work Queue if it has been created, otherwise they are submitted to the engines
+        using Engine.submit(), which run at the same time if a local process pool has been created.
+
+        Parameters
+        ----------
+        optimizers : list of Optimizer
+            Optimizers whose current structures need to be evaluated
+
+        Returns
+        -------
+        list
+            For each optimizer, the result dictionary with keys 'energy' and 'gradient'
+            (in the same format as Engine.calc()), or the exception raised if the calculation failed
+        """
+        wq = getWorkQueue()
+        submitted = [False for i in range(len(optimizers))]
+        if wq is not None:
+            for i, opt in enumerate(optimizers):
+                try:
+                    opt.engine.calc_wq(opt.X, opt.dirname, read_data=(opt.Iteration==0))
+                    submitted[i] = True
+                except NotImplementedError:
+                    pass
+            if any(submitted):
+                wq_wait(wq, print_time=600)
+        futures = [None if submitted[i] else opt.engine.submit(opt.X, opt.dirname, read_data=(opt.Iteration==0))
+                   for i, opt in enumerate(optimizers)]
+        results = []
+        for i, opt in enumerate(optimizers):
+            try:
+                if submitted[i]:
+                    results.append(opt.engine.read_wq(opt.X, opt.dirname))
+                else:
+                    results.append(opt.engine.collect(futures[i], opt.X))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _retire(self, i, error=None):
+        """ Mark optimization i as converged or failed and finish it. """
+        opt = self.optimizers[i]
+        if error is None and opt.state == OPT_STATE.FAILED:
+            error = GeomOptNotConvergedError("Optimizer.optimizeGeometry() failed to converge.")
+        if error is None:
+            try:
+                opt.finishOptimization()
+            except HessianExit:
+                raise
+            except Exception as e:
+                error = e
+        if error is None:
+            self.status[i] = 'converged'
+            logger.info("Batch optimization %i converged after %i iterations\n" % (i, opt.Iteration))
+        else:
+            self.status[i] = 'failed'
+            self.errors[i] = error
+            logger.warning("Batch optimization %i failed after %i iterations: %s: %s\n"
+                           % (i, opt.Iteration, type(error).__name__, error))
+
+    def _evaluate(self, active, first=False):
+        """
+        Calculate the energies and gradients of the optimizations in the active list that need it
+        in one batch, then evaluate the steps (or prepare the first step).  Returns the list of
+        optimizations that are still running.
+        """
+        pending = [i for i in active if self.optimizers[i].state == OPT_STATE.NEEDS_EVALUATION]
+        results = self.calcBatch([self.optimizers[i] for i in pending]) if pending else []
+        results = dict(zip(pending, results))
+        self.stats['gradients'] += len(pending)
+        running = []
+        for i in active:
+            opt = self.optimizers[i]
+            try:
+                if i in results:
+                    if isinstance(results[i], Exception):
+                        raise results[i]
+                    # Store the result in the engine so calcEnergyForce() does not repeat the calculation
+                    opt.engine.store_result(opt.X.copy(), results[i])
+                    opt.calcEnergyForce()
+                    if first:
+                        opt.prepareFirstStep()
+                    elif opt.state == OPT_STATE.NEEDS_EVALUATION:
+                        opt.evaluateStep()
+                if opt.recalcHess:
+                    # Compute the Cartesian Hessian at the current structure, same as optimizeGeometry()
+                    opt.calcEnergyForce()
+            except HessianExit:
+                raise
+            except Exception as e:
+                self._retire(i, e)
+                continue
+            if opt.state in [OPT_STATE.CONVERGED, OPT_STATE.FAILED]:
+                self._retire(i)
+            else:
+                running.append(i)
+        return running
+
+    def optimizeBatch(self):
+        """
+        Run all of the optimizations until each one has converged or failed.
+
+        Returns
+        -------
+        list of Molecule
+            Optimization trajectory of each optimizer in the order they were provided,
+            including those that failed (see self.status and self.errors)
+        """
+        t0 = time.time()
+        active = self._evaluate(list(range(len(self.optimizers))), first=True)
+        while active:
+            t1 = time.time()
+            nactive = len(active)
+            self.stats['rounds'] += 1
+            stepped = []
+            for i in active:
+                try:
+                    self.optimizers[i].step()
+                except HessianExit:
+                    raise
+                except Exception as e:
+                    self._retire(i, e)
+                    continue
+                stepped.append(i)
+            active = self._evaluate(stepped)
+            if self.verbose:
+                logger.info("Batch round %i: %i optimizations running, %i finished, %.3f seconds\n"
+                            % (self.stats['rounds'], len(active), nactive-len(active), time.time()-t1))
+        self.stats['time'] = time.time() - t0
+        self.printStats()
+        return [opt.progress for opt in self.optimizers]
+
+    def printStats(self):
+        """ Print the outcome and throughput of the batch optimization. """
+        nopt = len(self.optimizers)
+        t = max(self.stats['time'], 1e-6)
+        logger.info("Batch optimization: %i converged, %i failed out of %i optimizations in %i rounds\n"
+                    % (self.status.count('converged'), self.status.count('failed'), nopt, self.stats['rounds']))
+        logger.info("%i gradients calculated in %.3f seconds (%.2f gradients/s, %.2f optimizations/min)\n"
+                    % (self.stats['gradients'], t, self.stats['gradients']/t, 60*nopt/t))
+
 def run_optimizer(**kwargs):
     """
     Run geometry optimization, constrained optimization, or
@@ -1236,157 +1639,182 @@ def run_optimizer(**kwargs):
         logger.info("Creating Work Queue object for distributed Hessian calculation\n")
         createWorkQueue(kwargs['wqport'], debug=verbose>1)
 
-    # Get initial coordinates in bohr
-    coords = M.xyzs[0].flatten() * ang2bohr
-
-    # Read in the constraints
-    constraints = kwargs.get('constraints', None) # Constraint input file (optional)
-    conmethod = kwargs.get('conmethod', 0) # Constraint algorithm - 0, original; 1, alternative
-    rigid = kwargs.get('rigid', False) # Whether to keep molecules rigid during optimization (TRIC only)
-
-    if constraints is not None:
-        Cons, CVals = parse_constraints(M, open(constraints).read())
-    else:
-        Cons = None
-        CVals = None
-
-    #=========================================#
-    #| Set up the internal coordinate system |#
-    #=========================================#
-    # First item in tuple: The class to be initialized
-    # Second item in tuple: Whether to connect nonbonded fragments
-    # Third item in tuple: Whether to throw in all Cartesians (no effect if second item is True)
-    CoordSysDict = {'cart':(CartesianCoordinates, False, False),
-                    'prim':(PrimitiveInternalCoordinates, True, False),
-                    'dlc':(DelocalizedInternalCoordinates, True, False),
-                    'hdlc':(DelocalizedInternalCoordinates, False, True),
-                    'tric-p':(PrimitiveInternalCoordinates, False, False),
-                    'tric':(DelocalizedInternalCoordinates, False, False)}
-    coordsys = kwargs.get('coordsys', 'tric')
-    CoordClass, connect, addcart = CoordSysDict[coordsys.lower()]
-
-    # Perform an initial single-point QM calculation to determine bonding & fragments, if using TRIC
-    if hasattr(engine, 'calc_bondorder') and coordsys.lower() in ['hdlc', 'tric'] and params.bothre > 1e-3:
-        bothre = params.bothre
-        logger.info("Calculating QM bond order and forming bonds using criterion of %.2f\n" % bothre)
-        qm_bo = engine.calc_bondorder(coords, dirname)
-        M.qm_bondorder = [qm_bo]
-        M.build_topology(bond_order=bothre)
-        if len(M.molecules) == 1 and bothre < 0.75:
-            logger.info("Only one fragment found; increasing threshold\n")
-            # Increase the bond order threshold until there are at least 2 fragments of size >1
-            while bothre < 0.75 and len([m for m in M.molecules if len(m.e()) > 1]) == 1:
-                bothre += 0.01
-                M.build_topology(bond_order=bothre)
-            logger.info("Using threshold of %.2f, there are now %i molecules\n" % (bothre, len(M.molecules)))
-        M.top_settings['read_bonds'] = True
-        # Delete the QM bond order to avoid problems when more structures are added
-        del M.Data['qm_bondorder']
-    else:
-        if coordsys.lower() in ['hdlc', 'tric'] and params.bothre > 1e-3:
-            logger.info("Requested bond order-based connectivity but it is not available in the current engine\n")
-        logger.info("Bonds will be generated from interatomic distances less than %.2f times sum of covalent radii\n" % M.top_settings['Fac'])
-
-    # TRIC IRC will fail when there is only one molecule due to the small Hessian eigenvalues.
-    if params.irc and len(M.molecules) == 1 and coordsys == 'tric':
-        coordsys = 'dlc'
+    # Create local process pool for running calculations concurrently
+    if kwargs.get('cores', 0):
+        createLocalPool(kwargs['cores'], threads=kwargs.get('nt') or 1)
 
-    CoordClass, connect, addcart = CoordSysDict[coordsys.lower()]
-
-    IC = CoordClass(M, build=True, connect=connect, addcart=addcart, constraints=Cons, cvals=CVals[0] if CVals is not None else None,
-                    conmethod=conmethod, rigid=rigid)
+    try:
+        # Get initial coordinates in bohr
+        coords = M.xyzs[0].flatten() * ang2bohr
+
+        # Read in the constraints
+        constraints = kwargs.get('constraints', None) # Constraint input file (optional)
+        conmethod = kwargs.get('conmethod', 0) # Constraint algorithm - 0, original; 1, alternative
+        rigid = kwargs.get('rigid', False) # Whether to keep molecules rigid during optimization (TRIC only)
+        sparse = kwargs.get('sparse', False) # Whether to use the sparse Wilson B-matrix
+        gsolver = kwargs.get('gsolver', 'svd') # Method for applying the inverse G-matrix
+        greuse = kwargs.get('greuse', 0.0) # Displacement threshold for reusing the G-matrix factorization
+        dlcsolver = kwargs.get('dlcsolver', 'eigh') # Method for finding the nonredundant space when building DLCs
+        blockdlc = kwargs.get('blockdlc', False) # Whether to build DLCs separately for each fragment
+        blockthreads = kwargs.get('blockthreads', 1) # Number of threads for building DLCs in blocks
+        cachemem = kwargs.get('cachemem', 512) # Memory budget for cached B-matrices and G-inverses in MB
+
+        if constraints is not None:
+            Cons, CVals = parse_constraints(M, open(constraints).read())
+        else:
+            Cons = None
+            CVals = None
+
+        #=========================================#
+        #| Set up the internal coordinate system |#
+        #=========================================#
+        # First item in tuple: The class to be initialized
+        # Second item in tuple: Whether to connect nonbonded fragments
+        # Third item in tuple: Whether to throw in all Cartesians (no effect if second item is True)
+        CoordSysDict = {'cart':(CartesianCoordinates, False, False),
+                        'prim':(PrimitiveInternalCoordinates, True, False),
+                        'dlc':(DelocalizedInternalCoordinates, True, False),
+                        'hdlc':(DelocalizedInternalCoordinates, False, True),
+                        'tric-p':(PrimitiveInternalCoordinates, False, False),
+                        'tric':(DelocalizedInternalCoordinates, False, False)}
+        coordsys = kwargs.get('coordsys', 'tric')
+        CoordClass, connect, addcart = CoordSysDict[coordsys.lower()]
+
+        # Perform an initial single-point QM calculation to determine bonding & fragments, if using TRIC
+        if hasattr(engine, 'calc_bondorder') and coordsys.lower() in ['hdlc', 'tric'] and params.bothre > 1e-3:
+            bothre = params.bothre
+            logger.info("Calculating QM bond order and forming bonds using criterion of %.2f\n" % bothre)
+            qm_bo = engine.calc_bondorder(coords, dirname)
+            M.qm_bondorder = [qm_bo]
+            M.build_topology(bond_order=bothre)
+            if len(M.molecules) == 1 and bothre < 0.75:
+                logger.info("Only one fragment found; increasing threshold\n")
+                # Increase the bond order threshold until there are at least 2 fragments of size >1
+                while bothre < 0.75 and len([m for m in M.molecules if len(m.e()) > 1]) == 1:
+                    bothre += 0.01
+                    M.build_topology(bond_order=bothre)
+                logger.info("Using threshold of %.2f, there are now %i molecules\n" % (bothre, len(M.molecules)))
+            M.top_settings['read_bonds'] = True
+            # Delete the QM bond order to avoid problems when more structures are added
+            del M.Data['qm_bondorder']
+        else:
+            if coordsys.lower() in ['hdlc', 'tric'] and params.bothre > 1e-3:
+                logger.info("Requested bond order-based connectivity but it is not available in the current engine\n")
+            logger.info("Bonds will be generated from interatomic distances less than %.2f times "
+                        "sum of covalent radii\n"
+                        % M.top_settings['Fac'])
+
+        # TRIC IRC will fail when there is only one molecule due to the small Hessian eigenvalues.
+        if params.irc and len(M.molecules) == 1 and coordsys == 'tric':
+            coordsys = 'dlc'
+
+        CoordClass, connect, addcart = CoordSysDict[coordsys.lower()]
+
+        IC = CoordClass(M, build=True, connect=connect, addcart=addcart, constraints=Cons,
+                        cvals=CVals[0] if CVals is not None else None, conmethod=conmethod, rigid=rigid, sparse=sparse,
+                        gsolver=gsolver, greuse=greuse, dlcsolver=dlcsolver, blockdlc=blockdlc,
+                        blockthreads=blockthreads)
+        IC.setCacheBudget(int(cachemem*1024**2))
     
-    #========================================#
-    #| End internal coordinate system setup |#
-    #========================================#
-
-    # Auxiliary functions (will not do optimization):
-    displace = kwargs.get('displace', False) # Write out the displacements of the coordinates.
-    if displace:
-        write_displacements(coords, M, IC, dirname, verbose)
-        return
-
-    fdcheck = kwargs.get('fdcheck', False) # Check internal coordinate gradients using finite difference..
-    if fdcheck:
-        IC.Prims.checkFiniteDifferenceGrad(coords)
-        IC.Prims.checkFiniteDifferenceHess(coords)
-        check_internal_grad(coords, M, IC.Prims, engine, dirname, verbose)
-        check_internal_hess(coords, M, IC.Prims, engine, dirname, verbose)
-        return
-
-    # Print out information about the coordinate system
-    if isinstance(IC, CartesianCoordinates):
-        logger.info("%i Cartesian coordinates being used\n" % (3*M.na))
-    else:
-        logger.info("%i internal coordinates being used (instead of %i Cartesians)\n" % (len(IC.Internals), 3*M.na))
-    logger.info(IC)
-    logger.info("\n")
-
-    # Print out a note if DFT is used for non-fragmented systems; recommend --dlc and --subfrctor 2.
-    if engine.detect_dft() and coordsys != "dlc" and len(IC.frags) == 1:
-        logger.info("#===================================================================================#\n")
-        logger.info("#| \x1b[91mNote: Detected the use of DFT for a system containing only one fragment.\x1b[0m        |#\n")
-        logger.info("#|                                                                                 |#\n")
-        logger.info("#| DFT calculations that use small to medium-sized grids can sometimes result in   |#\n")
-        logger.info("#| energies and/or gradients that are not translationally/rotationally invariant,  |#\n")
-        logger.info("#| which varies depending on the QC program used.                                  |#\n")
-        logger.info("#|                                                                                 |#\n")
-        logger.info("#| Spurious translation/rotation contributions to the energy and/or gradient       |#\n")
-        logger.info("#| may cause convergence failure that is observable as 'movement' or 'tumbling'    |#\n")
-        logger.info("#| of the molecule in the optimization output. If observed, rerun the calculation  |#\n")
-        logger.info("#| using --coordsys dlc and --subfrctor 2. It will project out overall translation |#\n")
-        logger.info("#| and rotation from the optimization space.                                       |#\n")
-        logger.info("#===================================================================================#\n")
-
-    if Cons is None:
-        # Run a standard geometry optimization
-        add = "_optim.xyz"
-        if params.irc:
-            if params.irc_direction == 'both':
-                prefix = prefix.replace('_forward', '')
-            add = "_irc.xyz"
-        params.xyzout = prefix+add
-        progress = Optimize(coords, M, IC, engine, dirname, params)
-    else:
-        # Run a single constrained geometry optimization or scan over a grid of values
-        if isinstance(IC, (CartesianCoordinates, PrimitiveInternalCoordinates)):
-            raise RuntimeError("Constraints only work with delocalized internal coordinates")
-        Mfinal = None
-        for ic, CVal in enumerate(CVals):
-            if len(CVals) > 1:
-                logger.info("---=== Scan %i/%i : Constrained Optimization ===---\n" % (ic+1, len(CVals)))
-            IC = CoordClass(M, build=True, connect=connect, addcart=addcart, constraints=Cons, cvals=CVal, conmethod=conmethod, rigid=rigid)
-            IC.printConstraints(coords, thre=-1)
+        #========================================#
+        #| End internal coordinate system setup |#
+        #========================================#
+
+        # Auxiliary functions (will not do optimization):
+        displace = kwargs.get('displace', False) # Write out the displacements of the coordinates.
+        if displace:
+            write_displacements(coords, M, IC, dirname, verbose)
+            return
+
+        fdcheck = kwargs.get('fdcheck', False) # Check internal coordinate gradients using finite difference..
+        if fdcheck:
+            IC.Prims.checkFiniteDifferenceGrad(coords)
+            IC.Prims.checkFiniteDifferenceHess(coords)
+            check_internal_grad(coords, M, IC.Prims, engine, dirname, verbose)
+            check_internal_hess(coords, M, IC.Prims, engine, dirname, verbose)
+            return
+
+        # Print out information about the coordinate system
+        if isinstance(IC, CartesianCoordinates):
+            logger.info("%i Cartesian coordinates being used\n" % (3*M.na))
+        else:
+            logger.info("%i internal coordinates being used (instead of %i Cartesians)\n"
+                        % (len(IC.Internals), 3*M.na))
+        logger.info(IC)
+        logger.info("\n")
+
+        # Print out a note if DFT is used for non-fragmented systems; recommend --dlc and --subfrctor 2.
+        if engine.detect_dft() and coordsys != "dlc" and len(IC.frags) == 1:
+            logger.info("#===================================================================================#\n")
+            logger.info("#| \x1b[91mNote: Detected the use of DFT for a system containing only one fragment.\x1b[0m"
+                        "        |#\n")
+            logger.info("#|                                                                                 |#\n")
+            logger.info("#| DFT calculations that use small to medium-sized grids can sometimes result in   |#\n")
+            logger.info("#| energies and/or gradients that are not translationally/rotationally invariant,  |#\n")
+            logger.info("#| which varies depending on the QC program used.                                  |#\n")
+            logger.info("#|                                                                                 |#\n")
+            logger.info("#| Spurious translation/rotation contributions to the energy and/or gradient       |#\n")
+            logger.info("#| may cause convergence failure that is observable as 'movement' or 'tumbling'    |#\n")
+            logger.info("#| of the molecule in the optimization output. If observed, rerun the calculation  |#\n")
+            logger.info("#| using --coordsys dlc and --subfrctor 2. It will project out overall translation |#\n")
+            logger.info("#| and rotation from the optimization space.                                       |#\n")
+            logger.info("#===================================================================================#\n")
+
+        if Cons is None:
+            # Run a standard geometry optimization
+            add = "_optim.xyz"
+            if params.irc:
+                if params.irc_direction == 'both':
+                    prefix = prefix.replace('_forward', '')
+                add = "_irc.xyz"
+            params.xyzout = prefix+add
+            progress = Optimize(coords, M, IC, engine, dirname, params)
+        else:
+            # Run a single constrained geometry optimization or scan over a grid of values
+            if isinstance(IC, (CartesianCoordinates, PrimitiveInternalCoordinates)):
+                raise RuntimeError("Constraints only work with delocalized internal coordinates")
+            Mfinal = None
+            for ic, CVal in enumerate(CVals):
+                if len(CVals) > 1:
+                    logger.info("---=== Scan %i/%i : Constrained Optimization ===---\n" % (ic+1, len(CVals)))
+                IC = CoordClass(M, build=True, connect=connect, addcart=addcart, constraints=Cons, cvals=CVal,
+                                conmethod=conmethod, rigid=rigid, sparse=sparse, gsolver=gsolver, greuse=greuse,
+                                dlcsolver=dlcsolver, blockdlc=blockdlc, blockthreads=blockthreads)
+                IC.setCacheBudget(int(cachemem*1024**2))
+                IC.printConstraints(coords, thre=-1)
+                if len(CVals) > 1:
+                    params.xyzout = prefix+"_scan-%03i.xyz" % (ic+1)
+                    # In the special case of a constraint scan, we write out multiple qdata.txt files
+                    if params.qdata is not None: params.qdata = 'qdata_scan-%03i.txt' % (ic+1)
+                else:
+                    params.xyzout = prefix+"_optim.xyz"
+                if ic == 0:
+                    progress = Optimize(coords, M, IC, engine, dirname, params)
+                else:
+                    progress += Optimize(coords, M, IC, engine, dirname, params, print_info=False)
+                # update the structure for next optimization in SCAN (by CNH)
+                M.xyzs[0] = progress.xyzs[-1]
+                coords = progress.xyzs[-1].flatten() * ang2bohr
+                if Mfinal:
+                    Mfinal += progress[-1]
+                else:
+                    Mfinal = progress[-1]
+                cNames = IC.getConstraintNames()
+                cVals = IC.getConstraintTargetVals()
+                comment = ', '.join(["%s = %.2f" % (cName, cVal) for cName, cVal in zip(cNames, cVals)])
+                Mfinal.comms[-1] = "Scan Cycle %i/%i ; %s ; %s" % (ic+1, len(CVals), comment, progress.comms[-1])
+                #print
             if len(CVals) > 1:
-                params.xyzout = prefix+"_scan-%03i.xyz" % (ic+1)
-                # In the special case of a constraint scan, we write out multiple qdata.txt files
-                if params.qdata is not None: params.qdata = 'qdata_scan-%03i.txt' % (ic+1)
-            else:
-                params.xyzout = prefix+"_optim.xyz"
-            if ic == 0:
-                progress = Optimize(coords, M, IC, engine, dirname, params)
-            else:
-                progress += Optimize(coords, M, IC, engine, dirname, params, print_info=False)
-            # update the structure for next optimization in SCAN (by CNH)
-            M.xyzs[0] = progress.xyzs[-1]
-            coords = progress.xyzs[-1].flatten() * ang2bohr
-            if Mfinal:
-                Mfinal += progress[-1]
-            else:
-                Mfinal = progress[-1]
-            cNames = IC.getConstraintNames()
-            cVals = IC.getConstraintTargetVals()
-            comment = ', '.join(["%s = %.2f" % (cName, cVal) for cName, cVal in zip(cNames, cVals)])
-            Mfinal.comms[-1] = "Scan Cycle %i/%i ; %s ; %s" % (ic+1, len(CVals), comment, progress.comms[-1])
-            #print
-        if len(CVals) > 1:
-            Mfinal.write('scan-final.xyz')
-            if params.qdata is not None: Mfinal.write('qdata-final.txt')
-    print_citation(logger)
-    logger.info("Time elapsed since start of run_optimizer: %.3f seconds\n" % (time.time()-t0))
-    if kwargs.get('wqport', 0):
-        destroyWorkQueue()
-    return progress
+                Mfinal.write('scan-final.xyz')
+                if params.qdata is not None: Mfinal.write('qdata-final.txt')
+        print_citation(logger)
+        logger.info("Time elapsed since start of run_optimizer: %.3f seconds\n" % (time.time()-t0))
+        if kwargs.get('wqport', 0):
+            destroyWorkQueue()
+        return progress
+    finally:
+        if kwargs.get('cores', 0):
+            destroyLocalPool()
 
 def main(): # pragma: no cover
     # Read user input (look in params.py for full list of options).
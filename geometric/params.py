@@ -35,7 +35,7 @@ from __future__ import division
 import os, argparse
 import numpy as np
 from .errors import ParamError
-from .nifty import logger
+from .nifty import logger, commadash, uncommadash
 
 class OptParams(object):
     """
@@ -109,6 +109,34 @@ class OptParams(object):
         self.hessian = kwargs.get('hessian', None)
         # Whether to use BigChem to carry the Hessian and NEB calculations.
         self.bigchem = kwargs.get('bigchem', False)
+        # Number of local worker processes for the gradient calculations of the finite difference Hessian,
+        # and the number of CPU cores divided among them (default: all cores on this machine).
+        self.hessian_workers = kwargs.get('hessian_workers', 0)
+        if self.hessian_workers < 0:
+            raise ParamError("Number of Hessian workers (--hessian-workers) cannot be negative")
+        self.cores = kwargs.get('cores', None)
+        # Finite difference scheme ('central' or 'forward') and step size (in bohr) for the Hessian.
+        self.hessian_diff = kwargs.get('hessian_diff', 'central').lower()
+        if self.hessian_diff not in ['central', 'forward']:
+            raise ParamError("Hessian finite difference scheme (--hessian-diff) must be central or forward")
+        self.hessian_step = kwargs.get('hessian_step', 1.0e-3)
+        if self.hessian_step <= 0:
+            raise ParamError("Hessian finite difference step (--hessian-step) must be positive")
+        # Atoms to be displaced in the finite difference Hessian (default all), and whether
+        # the remaining elements are filled in from the guess Hessian or set to zero.
+        self.hessian_atoms = kwargs.get('hessian_atoms', None)
+        if isinstance(self.hessian_atoms, str):
+            self.hessian_atoms = uncommadash(self.hessian_atoms)
+        self.hessian_fill = kwargs.get('hessian_fill', 'guess').lower()
+        if self.hessian_fill not in ['guess', 'zero']:
+            raise ParamError("Hessian fill (--hessian-fill) must be guess or zero")
+        # Number of lowest Hessian eigenpairs to calculate using Davidson iterations on finite difference
+        # Hessian-vector products instead of the full finite difference Hessian (default 0 for the full Hessian).
+        self.hessian_modes = kwargs.get('hessian_modes', 0)
+        if self.hessian_modes < 0:
+            raise ParamError("Number of lowest Hessian modes (--hessian-modes) cannot be negative")
+        if self.hessian_modes and (self.hessian_atoms is not None or self.bigchem):
+            raise ParamError("--hessian-modes cannot be combined with --hessian-atoms or --bigchem")
 
         if self.hessian is None:
             # Default is to calculate Hessian in the first step if searching for a transition state.
@@ -135,6 +163,22 @@ class OptParams(object):
         # If the initial Hessian is provided in the hess_data list, store it in self.hess_data.
         if kwargs.get('hess_data', None):
             self.hess_data = np.array(kwargs.get('hess_data'))
+        # Number of updates stored in a limited-memory BFGS Hessian; 0 = use the full Hessian.
+        # The L-BFGS Hessian starts from the diagonal of the guess Hessian, so it is for energy minimization only.
+        self.lbfgs = kwargs.get('lbfgs', 0)
+        if self.lbfgs < 0:
+            raise ParamError("Number of L-BFGS updates must be a positive integer (or 0 to disable)")
+        if self.lbfgs and (self.transition or self.irc):
+            raise ParamError("L-BFGS Hessian (--lbfgs) cannot be used for transition state or IRC calculations")
+        if self.lbfgs and (self.hessian in ['first', 'each', 'first+last'] or hasattr(self, 'hess_data')):
+            raise ParamError("L-BFGS Hessian (--lbfgs) cannot be used with an initial Hessian "
+                             "(--hessian first, each, first+last, or file)")
+        # Evaluate the step that would be taken if the current step is rejected (the "fallback" step with
+        # a reduced trust radius) at the same time as the current step, using Work Queue or the local process pool.
+        self.speculate = kwargs.get('speculate', False)
+        if self.speculate and self.irc:
+            raise ParamError("Speculative evaluation of fallback steps (--speculate) cannot be used for IRC "
+                             "calculations")
         # Perform a frequency analysis whenever a cartesian Hessian is computed
         self.frequency = kwargs.get('frequency', None)
         if self.frequency is None: self.frequency = True
@@ -213,6 +257,10 @@ class OptParams(object):
     def printInfo(self):
         if self.subfrctor == 2:
             logger.info(' Net force and torque will be projected out of gradient.\n')
+        if self.lbfgs:
+            logger.info(' Limited-memory BFGS Hessian will store %i updates.\n' % self.lbfgs)
+        if self.speculate:
+            logger.info(' Fallback steps will be evaluated together with each step in case it is rejected.\n')
         if self.transition:
             logger.info(' Transition state optimization requested.\n')
         if self.irc:
@@ -231,6 +279,12 @@ class OptParams(object):
             logger.info(' Hessian data will be read from file: %s\n' % self.hessian[5:])
         elif self.hessian.startswith('file+last:'):
             logger.info(' Hessian data will be read from file: %s, then computed for the last step.\n' % self.hessian[5:])
+        if self.hessian_atoms is not None and self.hessian != 'never':
+            fill = 'taken from the guess Hessian' if self.hessian_fill == 'guess' else 'set to zero'
+            logger.warning(' Only atoms %s will be displaced in the finite difference Hessian, and the other\n'
+                           ' elements are %s; vibrational frequencies and thermochemistry from this Hessian\n'
+                           ' are not reliable.\n'
+                           % (commadash(self.hessian_atoms), fill))
 
 class NEBParams(object):
     """
@@ -338,6 +392,10 @@ def parse_optimizer_args(*args):
                           '"gaussian" = Gaussian09/16          "ase" = ASE calculator, use --ase-class/--ase-kwargs\n '
                           '"quick" = QUICK                     "bagel" = Bagel\n')
     grp_univ.add_argument('--nt', type=int, help='Specify number of threads for running in parallel\n(for TeraChem this should be number of GPUs)')
+    grp_univ.add_argument('--cores', type=int,
+                          help='Number of CPU cores for running calculations concurrently on this machine using a\n'
+                          'local process pool, for example the fallback steps of --speculate; up to cores/nt\n'
+                          'calculations run at once.\n ')
 
     grp_jobtype = parser.add_argument_group('jobtype', 'Control the type of optimization job')
     grp_jobtype.add_argument('--transition', type=str2bool, help='Provide "yes" to Search for a first order saddle point / transition state.\n ')
@@ -365,6 +423,26 @@ def parse_optimizer_args(*args):
     grp_hessian.add_argument('--wqport', type=int, help='Work Queue port used to distribute Hessian calculations. Workers must be started separately. \n ')
     grp_hessian.add_argument('--bigchem', type=str2bool, help='Provide "Yes" to use BigChem for performing the Hessian calculation in parallel. \n'
                                                               'Please ensure that BigChem is running with workers properly. \n ')
+    grp_hessian.add_argument('--hessian-workers', type=int,
+                             help='Number of local worker processes for running the Hessian gradient calculations in\n'
+                             'parallel without Work Queue; the cores (--cores, default all) are divided evenly\n'
+                             'among the workers.\n ')
+    grp_hessian.add_argument('--hessian-diff', type=str,
+                             help='Finite difference scheme for the Hessian: "central" (default, 2 gradients per\n'
+                             'coordinate) or "forward" (1 gradient per coordinate, less accurate).\n ')
+    grp_hessian.add_argument('--hessian-step', type=float,
+                             help='Finite difference step size for the Hessian in bohr, default 1e-3.\n ')
+    grp_hessian.add_argument('--hessian-atoms', type=str,
+                             help='Only displace these atoms when calculating the Hessian, e.g. "1-5,8" (numbered\n'
+                             'from 1). Other Hessian elements are filled in according to --hessian-fill.\n ')
+    grp_hessian.add_argument('--hessian-fill', type=str,
+                             help='Provide the Hessian elements between atoms that are not displaced from the\n'
+                             '"guess" Hessian (default) or set them to "zero".\n ')
+    grp_hessian.add_argument('--hessian-modes', type=int,
+                             help='Instead of the full finite difference Hessian, calculate this many lowest\n'
+                             'eigenpairs using Davidson iterations on finite difference Hessian-vector\n'
+                             'products, and use them to update the guess Hessian. Requires far fewer gradients\n'
+                             'for TS searches and IRC.\n ')
     grp_hessian.add_argument('--frequency', type=str2bool, help='Perform frequency analysis whenever Hessian is calculated, default is yes/true. \n')
     grp_hessian.add_argument('--thermo', type=float, nargs=2, help='Temperature (K) and pressure (bar) for harmonic free energy\n'
                              'following frequency analysis, default is 300 K and 1.0 bar.\n ')
@@ -385,6 +463,39 @@ def parse_optimizer_args(*args):
     grp_optparam.add_argument('--usedmax', type=str2bool, help='Use maximum component instead of RMS displacement when applying trust radius.\n ')
     grp_optparam.add_argument('--enforce', type=float, help='Enforce exact constraints when within provided tolerance (in a.u./radian, default 0.0)\n ')
     grp_optparam.add_argument('--conmethod', type=int, help='Set to 1 to enable alternate constraint algorithm (default 0).\n ')
+    grp_optparam.add_argument('--sparse', type=str2bool,
+                              help='Provide "yes" to use a sparse Wilson B-matrix, which reduces the cost of\n'
+                              'coordinate transformations for large systems (default no).\n ')
+    grp_optparam.add_argument('--gsolver', type=str,
+                              help='Method for applying the inverse G-matrix in coordinate transformations: svd\n'
+                              '(default), eigh, chol (Cholesky, for nonredundant coordinates) or lsqr\n'
+                              '(iterative, for very large systems).\n ')
+    grp_optparam.add_argument('--greuse', type=float,
+                              help='Reuse the G-matrix factorization in the Cartesian back-transformation while the\n'
+                              'RMS displacement from where it was computed is below this value in bohr (default\n'
+                              '0.0 = never).\n ')
+    grp_optparam.add_argument('--dlcsolver', type=str,
+                              help='Method for finding the nonredundant space when building delocalized internal\n'
+                              'coordinates: eigh (diagonalize G, default) or btb (diagonalize the smaller\n'
+                              'B^T.B, faster when there are many primitives).\n ')
+    grp_optparam.add_argument('--blockdlc', type=str2bool,
+                              help='Provide "yes" to build and store delocalized internal coordinates separately for\n'
+                              'each set of primitives that do not share atoms, e.g. each fragment in TRIC\n'
+                              '(default no).\n ')
+    grp_optparam.add_argument('--blockthreads', type=int,
+                              help='Number of threads for diagonalizing the blocks when --blockdlc is used (default\n'
+                              '1).\n ')
+    grp_optparam.add_argument('--cachemem', type=float,
+                              help='Memory budget in MB for cached B-matrices and G-matrix inverses of the internal\n'
+                              'coordinates; least recently used values are discarded beyond this (default 512).\n ')
+    grp_optparam.add_argument('--lbfgs', type=int,
+                              help='Provide a number of updates (e.g. 20) to use a limited-memory BFGS Hessian built\n'
+                              'on the diagonal guess Hessian, which reduces the cost per step for very large\n'
+                              'systems (default 0 = full Hessian).\n ')
+    grp_optparam.add_argument('--speculate', type=str2bool,
+                              help='Provide "yes" to evaluate the reduced step that would follow a rejected step at\n'
+                              'the same time as each step using Work Queue or a local process pool (requires\n'
+                              '--wqport or --cores), which saves time when many steps are rejected.\n ')
     grp_optparam.add_argument('--reset', type=str2bool, help='Reset approximate Hessian to guess when eigenvalues are under epsilon.\n '
                               'Defaults to True for minimization and False for transition states.\n ')
     grp_optparam.add_argument('--epsilon', type=float, help='Small eigenvalue threshold for resetting Hessian, default 1e-5.\n ')
@@ -485,6 +596,9 @@ def parse_neb_args(*args):
                           '"gaussian" = Gaussian09/16          "ase" = ASE calculator, use --ase-class/--ase-kwargs\n '
                           '"quick" = QUICK\n')
     grp_univ.add_argument('--nt', type=int, help='Specify number of threads for running in parallel\n(for TeraChem this should be number of GPUs)')
+    grp_univ.add_argument('--cores', type=int,
+                          help='Number of CPU cores for running the image calculations concurrently on this machine\n'
+                          'using a local process pool; up to cores/nt calculations run at once.\n ')
 
     grp_nebparam = parser.add_argument_group('nebparam', 'Control the NEB calculation')
     grp_nebparam.add_argument('--maxg', type=float, help='Converge when the maximum RMS-gradient of all images falls below this threshold (default 0.05 ev/Ang).\n ')
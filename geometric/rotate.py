@@ -125,6 +125,10 @@ def build_F(x, y, r=np.array([0.0, 0.0, 0.0, 0.0])):
         F[i,i] += r[i]
     return F
 
+# Derivatives of the F-matrix with respect to the elements of the correlation matrix;
+# F is linear in R, so these are constant and dFdR[i, j] is the F-matrix built from R = e_i e_j^T
+dFdR = np.array([[build_F(np.eye(3)[[i]], np.eye(3)[[j]]) for j in range(3)] for i in range(3)])
+
 def al(p):
     """
     Given a quaternion p, return the 4x4 matrix A_L(p)
@@ -358,12 +362,9 @@ def get_R_der(x, y, fdcheck=False):
     y = y - np.mean(y,axis=0)
     # 3 x 3 x N_atoms x 3
     ADiffR = np.zeros((x.shape[0], 3, 3, 3), dtype=float)
-    for u in range(x.shape[0]):
-        for w in range(3):
-            for i in range(3):
-                for j in range(3):
-                    if i == w:
-                        ADiffR[u, w, i, j] = y[u, j]
+    # Only the row of R corresponding to the Cartesian direction w depends on x[u, w]
+    for w in range(3):
+        ADiffR[:, w, w, :] = y
     if fdcheck:
         h = 1e-4
         R0 = build_correlation(x, y)
@@ -403,34 +404,8 @@ def get_F_der(x, y, fdcheck=False):
     x = x - np.mean(x,axis=0)
     y = y - np.mean(y,axis=0)
     dR = get_R_der(x, y)
-    dF = np.zeros((x.shape[0], 3, 4, 4),dtype=float)
-    for u in range(x.shape[0]):
-        for w in range(3):
-            dR11 = dR[u,w,0,0]
-            dR12 = dR[u,w,0,1]
-            dR13 = dR[u,w,0,2]
-            dR21 = dR[u,w,1,0]
-            dR22 = dR[u,w,1,1]
-            dR23 = dR[u,w,1,2]
-            dR31 = dR[u,w,2,0]
-            dR32 = dR[u,w,2,1]
-            dR33 = dR[u,w,2,2]
-            dF[u,w,0,0] = dR11 + dR22 + dR33
-            dF[u,w,0,1] = dR23 - dR32
-            dF[u,w,0,2] = dR31 - dR13
-            dF[u,w,0,3] = dR12 - dR21
-            dF[u,w,1,0] = dR23 - dR32
-            dF[u,w,1,1] = dR11 - dR22 - dR33
-            dF[u,w,1,2] = dR12 + dR21
-            dF[u,w,1,3] = dR13 + dR31
-            dF[u,w,2,0] = dR31 - dR13
-            dF[u,w,2,1] = dR12 + dR21
-            dF[u,w,2,2] = dR22 - dR33 - dR11
-            dF[u,w,2,3] = dR23 + dR32
-            dF[u,w,3,0] = dR12 - dR21
-            dF[u,w,3,1] = dR13 + dR31
-            dF[u,w,3,2] = dR23 + dR32
-            dF[u,w,3,3] = dR33 - dR22 - dR11
+    # F is linear in R, so dF[u, w] = sum_ij dR[u, w, i, j] * dFdR[i, j]
+    dF = np.einsum('uwij,ijpr->uwpr', dR, dFdR)
     if fdcheck:
         h = 1e-4
         F0 = build_F(x, y)
@@ -464,7 +439,7 @@ def get_q_der(x, y, second=False, fdcheck=False, use_loops=False, r=np.array([0.
     fdcheck : bool
         If true, perform a finite difference check and return finite difference gradients
     use_loops : bool
-        If true, use the slower reference implementation that uses for loops (only in second derivs)
+        If true, use the slower reference implementation that uses for loops
 
     Returns
     -------
@@ -482,16 +457,24 @@ def get_q_der(x, y, second=False, fdcheck=False, use_loops=False, r=np.array([0.
     y = y - np.mean(y,axis=0)
     q, l = get_quat(x, y, eig=True, r=r)
     F = build_F(x, y, r=r)
-    dF = get_F_der(x, y)
     mat = np.eye(4)*l - F
     # pinv = np.matrix(np.linalg.pinv(np.eye(4)*l - F))
     Minv = invert_svd(np.eye(4)*l - F, thresh=1e-6)
-    dq = np.zeros((x.shape[0], 3, 4), dtype=float)
-    for u in range(x.shape[0]):
-        for w in range(3):
-            # dquw = Minv*np.matrix(dF[u, w])*np.matrix(q).T
-            dquw = multi_dot([Minv,dF[u, w],q.T])
-            dq[u, w] = np.array(dquw).flatten()
+    if use_loops or second:
+        dF = get_F_der(x, y)
+    if use_loops:
+        # Reference implementation using for loops
+        dq = np.zeros((x.shape[0], 3, 4), dtype=float)
+        for u in range(x.shape[0]):
+            for w in range(3):
+                # dquw = Minv*np.matrix(dF[u, w])*np.matrix(q).T
+                dquw = multi_dot([Minv,dF[u, w],q.T])
+                dq[u, w] = np.array(dquw).flatten()
+    else:
+        # dF[u, w] is a linear combination of the nine constant matrices dFdR[w, j] with coefficients y[u, j],
+        # so contract Minv and q with dFdR once and the per-atom work is a single (N, 3) x (3, 12) product.
+        dqdR = np.einsum('pr,wjrs,s->jwp', Minv, dFdR, q)
+        dq = np.dot(y, dqdR.reshape(3, 12)).reshape(x.shape[0], 3, 4)
 
     if second:
         if use_loops:
@@ -581,25 +564,64 @@ def get_q_der(x, y, second=False, fdcheck=False, use_loops=False, r=np.array([0.
     else:
         return dq
 
-def get_rot_der(x, y, second=False, fdcheck=False, r=np.array([0.0, 0.0, 0.0, 0.0])):
+def get_rot_der(x, y, second=False, fdcheck=False, use_loops=False, r=np.array([0.0, 0.0, 0.0, 0.0])):
+    """
+    Calculate the derivatives of the rotation matrix that brings x into maximal
+    coincidence with y, with respect to the coordinates of x.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Trial coordinates, dimensionality (number of atoms) x 3
+    y : numpy.ndarray
+        Target coordinates, dimensionalty must match trial coordinates
+    second : bool
+        If true, return the second derivative matrix as well.
+    fdcheck : bool
+        If true, perform a finite difference check and return finite difference gradients
+    use_loops : bool
+        If true, use the slower reference implementation that uses for loops (only in first derivs)
+
+    Returns
+    -------
+    numpy.ndarray
+        u, w, i, j: 
+        First two dimensions are (n_atoms, 3), the variables being differentiated
+        Second two dimensions are (3, 3), the elements of the rotation matrix derivatives
+        with respect to atom u, dimension w
+    numpy.ndarray (if second=True)
+        u, w, a, b, i, j: 
+        First four dimensions are (n_atoms, 3, n_atoms, 3), the variables being differentiated
+        Last two dimensions are (3, 3), the elements of the rotation matrix second derivatives
+    """
     q = get_quat(x, y, r=r)
     qc = conj(q)
 
     if second:
-        dq, dq2 = get_q_der(x, y, second=True, r=r)
+        dq, dq2 = get_q_der(x, y, second=True, use_loops=use_loops, r=r)
     else:
-        dq = get_q_der(x, y, second=False, r=r)
+        dq = get_q_der(x, y, second=False, use_loops=use_loops, r=r)
 
     # Form the first derivative; apply form_rot to dq
-    dU = np.zeros((x.shape[0], 3, 3, 3), dtype=float)
     # The derivative of the conjugate
     dqc = dq.copy()
     dqc[:, :, 1:] *= -1
 
-    for u in range(x.shape[0]):
-        for w in range(3):
-            dU[u, w]  = np.dot(al(dq[u, w]), ar(qc))[1:, 1:]
-            dU[u, w] += np.dot(al(q), ar(dqc[u, w]))[1:, 1:]
+    if use_loops:
+        # Reference implementation using for loops
+        dU = np.zeros((x.shape[0], 3, 3, 3), dtype=float)
+        for u in range(x.shape[0]):
+            for w in range(3):
+                dU[u, w]  = np.dot(al(dq[u, w]), ar(qc))[1:, 1:]
+                dU[u, w] += np.dot(al(q), ar(dqc[u, w]))[1:, 1:]
+    else:
+        # A_L and A_R are linear in their argument, so dU is a contraction of dq
+        # with the rotation matrix derivatives along each quaternion element.
+        dUdq = np.zeros((4, 3, 3), dtype=float)
+        for p in range(4):
+            ep = np.eye(4)[p]
+            dUdq[p] = (np.dot(al(ep), ar(qc)) + np.dot(al(q), ar(conj(ep))))[1:, 1:]
+        dU = np.dot(dq, dUdq.reshape(4, 9)).reshape(x.shape[0], 3, 3, 3)
 
     if second:
         dq2c = dq2.copy()
@@ -754,7 +776,6 @@ def get_expmap_der(x, y, second=False, fdcheck=False, use_loops=False, r=np.arra
     """
     # t0 = time.time()
     q = get_quat(x,y,r=r)
-    v = get_expmap(x,y,r=r)
     if second:
         fac, dfac, dfac2 = calc_fac_dfac(q[0], second=True)
     else:
@@ -818,16 +839,18 @@ def get_expmap_der(x, y, second=False, fdcheck=False, use_loops=False, r=np.arra
                 
     # Dimensionality: Number of atoms, number of dimensions (3), number of elements in q (4)
     if second:
-        dqdx, dqdx2 = get_q_der(x, y, second=True, r=r)
+        dqdx, dqdx2 = get_q_der(x, y, second=True, use_loops=use_loops, r=r)
     else:
-        dqdx = get_q_der(x, y, r=r)
+        dqdx = get_q_der(x, y, use_loops=use_loops, r=r)
     # Dimensionality: Number of atoms, number of dimensions (3), number of elements in v (3)
-    dvdx = np.zeros((x.shape[0], 3, 3), dtype=float)
-    for u in range(x.shape[0]):
-        for w in range(3):
-            dqdx_uw = dqdx[u, w]
-            for p in range(4):
-                dvdx[u, w, :] += dvdq[p, :] * dqdx[u, w, p]
+    if use_loops:
+        dvdx = np.zeros((x.shape[0], 3, 3), dtype=float)
+        for u in range(x.shape[0]):
+            for w in range(3):
+                for p in range(4):
+                    dvdx[u, w, :] += dvdq[p, :] * dqdx[u, w, p]
+    else:
+        dvdx = np.dot(dqdx, dvdq)
     if second:
         if use_loops:
             # Reference implementation using for loops
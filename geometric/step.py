@@ -33,11 +33,96 @@ POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import division
 import numpy as np
+import scipy.sparse.linalg
 from numpy.linalg import multi_dot
 
+from .internal import geometry_token
 from .nifty import row, col, flat, invert_svd, bohr2ang, ang2bohr, logger, pvec1d, pmat2d
 from .rotate import get_rot, sorted_eigh
 
+# Matrices larger than this are partially diagonalized using the Lanczos method
+# when only a few eigenpairs at either end of the spectrum are needed.
+lanczos_min_dim = 100
+
+class EighCache(object):
+    """
+    The eigendecomposition of the last Hessian passed to hessian_eigh(), which is reused
+    as long as the Hessian is unchanged, e.g. for every trial step in the trust radius search,
+    and the last eigenvector of the large P-RFO matrix for that Hessian, used as the starting
+    vector for the next one.  Each Optimizer keeps its own, so that optimizations running
+    side by side (e.g. in a BatchOptimizer) do not overwrite each other's.
+    """
+    def __init__(self):
+        self.token = None
+        self.vals = None
+        self.vecs = None
+        self.rfo_guess = None
+
+def hessian_eigh(H, cache=None):
+    """
+    Return the eigenvalues (ascending) and eigenvectors of a symmetric matrix.
+    If an EighCache is provided, the result for the last matrix is stored in it
+    and returned again without diagonalizing if the matrix contents are the same.
+    """
+    if cache is None:
+        return sorted_eigh(H, asc=True)
+    token = (H.shape, geometry_token(H))
+    if cache.token != token:
+        cache.vals, cache.vecs = sorted_eigh(H, asc=True)
+        cache.token = token
+        # The P-RFO starting vector belongs to the previous Hessian
+        cache.rfo_guess = None
+    return cache.vals, cache.vecs
+
+def partial_eigh(M, k=1, which='SA', v0=None):
+    """
+    Return k eigenvalues (ascending) and eigenvectors from one end of the spectrum
+    of a symmetric matrix.  Matrices larger than lanczos_min_dim use the Lanczos method
+    (scipy.sparse.linalg.eigsh), and smaller ones are fully diagonalized.
+
+    Parameters
+    ----------
+    M : np.ndarray or scipy.sparse.linalg.LinearOperator
+        Symmetric matrix, which is only used through matrix-vector products
+        in the Lanczos method
+    k : int
+        Number of eigenpairs
+    which : str
+        'SA' for the lowest or 'LA' for the highest eigenvalues
+    v0 : np.ndarray, optional
+        Starting vector for the Lanczos method, e.g. an eigenvector of a similar matrix
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        Eigenvalues with shape (k,) and eigenvectors with shape (n, k)
+    """
+    n = M.shape[0]
+    if n > max(lanczos_min_dim, k+1):
+        try:
+            vals, vecs = scipy.sparse.linalg.eigsh(M, k=k, which=which, v0=v0)
+            idx = np.argsort(vals)
+            vals, vecs = vals[idx], vecs[:, idx]
+        except scipy.sparse.linalg.ArpackNoConvergence:
+            logger.info("Lanczos method did not converge, using full diagonalization\n")
+            n = 0
+    if n <= max(lanczos_min_dim, k+1):
+        if not isinstance(M, np.ndarray):
+            M = M.dot(np.eye(M.shape[0]))
+        vals, vecs = sorted_eigh(M, asc=True)
+        vals, vecs = (vals[:k], vecs[:, :k]) if which == 'SA' else (vals[-k:], vecs[:, -k:])
+    return vals, vecs
+
+def hessian_eigvals(H, cache=None):
+    """
+    Return the eigenvalues of a symmetric matrix in ascending order, using the
+    eigendecomposition stored in the EighCache if the matrix is the same, otherwise
+    computing the eigenvalues only (which is cheaper than also computing eigenvectors).
+    """
+    if cache is not None and cache.token == (H.shape, geometry_token(H)):
+        return cache.vals
+    return np.linalg.eigvalsh(H)
+
 def between(s, a, b):
     if a < b:
         return s > a and s < b
@@ -147,7 +232,7 @@ class Froot(object):
     this function and not just its value, for example: Did we converge
     to a root? Under what conditions are we allowed to exit the algorithm?
     """
-    def __init__(self, trust, v0, X, G, H, IC, params):
+    def __init__(self, trust, v0, X, G, H, IC, params, cache=None):
         self.counter = 0
         self.stores = {}
         self.trust = trust
@@ -162,6 +247,7 @@ class Froot(object):
         self.G = G
         self.H = H
         self.IC = IC
+        self.cache = cache
 
     def evaluate(self, trial):
         """
@@ -183,7 +269,8 @@ class Froot(object):
                 cnorm = self.stores[trial]
                 self.from_above = False
             else:
-                dy, expect = trust_step(trial, v0, X, G, H, IC, self.params.transition, self.params.verbose)
+                dy, expect = trust_step(trial, v0, X, G, H, IC, self.params.transition, self.params.verbose,
+                                        cache=self.cache)
                 cnorm = get_cartesian_norm(X, dy, IC, self.params.enforce, self.params.verbose, self.params.usedmax)
                 # Early "convergence"; this signals whether we have found a valid step that is
                 # above the current target, but below the original trust radius. This happens
@@ -308,7 +395,116 @@ def get_hessian_update_bfgs(Dy, Dg, H):
     Hup = Mat1-Mat2
     return Hup
 
-def update_hessian(IC, H0, xyz_seq, gradx_seq, params, trust_limit=False, max_updates=1):
+class LBFGSHessian(object):
+    """
+    Limited-memory BFGS approximation to the internal coordinate Hessian.
+
+    The Hessian is represented by a diagonal starting matrix B0 (the diagonal of the
+    guess Hessian) and the m most recent pairs of steps s and gradient differences y,
+    using the compact representation of Byrd, Nocedal and Schnabel (1994):
+
+    B = B0 - W.M^-1.W^T,  W = [B0.S, Y],  M = [[S^T.B0.S, L], [L^T, -D]]
+
+    where D is the diagonal and L the strictly lower triangle of S^T.Y.  Products with
+    B and solutions of (B + vI).x = g are computed without forming B, so the storage
+    and the cost of each step are O(n*m) instead of O(n^2) or O(n^3).
+    """
+    def __init__(self, diag, m):
+        """
+        Parameters
+        ----------
+        diag : np.ndarray
+            Diagonal of the starting Hessian, with shape (n,)
+        m : int
+            Maximum number of (s, y) pairs to keep
+        """
+        self.diag = np.array(diag, dtype=float).flatten()
+        self.m = m
+        self.S = []
+        self.Y = []
+        self.compact = None
+
+    @property
+    def shape(self):
+        return (len(self.diag), len(self.diag))
+
+    def __len__(self):
+        return len(self.diag)
+
+    def copy(self):
+        H = LBFGSHessian(self.diag, self.m)
+        H.S = list(self.S)
+        H.Y = list(self.Y)
+        return H
+
+    def update(self, Dy, Dg, epsilon=0.0):
+        """
+        Add a step and gradient difference to the history, discarding the oldest
+        pair beyond m.  Pairs with curvature Dy.Dg below epsilon*|Dy|^2 would make
+        the Hessian lose positive definiteness and are skipped.
+
+        Returns
+        -------
+        bool
+            True if the pair was added
+        """
+        Dy = np.array(Dy, dtype=float).flatten()
+        Dg = np.array(Dg, dtype=float).flatten()
+        if np.dot(Dy, Dg) <= epsilon*np.dot(Dy, Dy):
+            return False
+        self.S.append(Dy)
+        self.Y.append(Dg)
+        if len(self.S) > self.m:
+            self.S.pop(0)
+            self.Y.pop(0)
+        self.compact = None
+        return True
+
+    def getCompact(self):
+        """ Return the (n, 2k) matrix W and the (2k, 2k) middle matrix M of the compact representation. """
+        if self.compact is None:
+            S = np.array(self.S).T
+            Y = np.array(self.Y).T
+            BS = self.diag[:, np.newaxis]*S
+            SY = np.dot(S.T, Y)
+            L = np.tril(SY, -1)
+            M = np.block([[np.dot(S.T, BS), L], [L.T, -np.diag(np.diag(SY))]])
+            self.compact = (np.hstack((BS, Y)), M)
+        return self.compact
+
+    def dot(self, v):
+        """ Return the product of the Hessian with a vector. """
+        v = np.asarray(v, dtype=float)
+        Hv = self.diag*v
+        if len(self.S) > 0:
+            W, M = self.getCompact()
+            Hv -= np.dot(W, np.linalg.solve(M, np.dot(W.T, v)))
+        return Hv
+
+    def solve(self, g, v=0.0):
+        """
+        Return the solution x of (B + vI).x = g using the Sherman-Morrison-Woodbury formula:
+
+        (A - W.M^-1.W^T)^-1 = A^-1 + A^-1.W.(M - W^T.A^-1.W)^-1.W^T.A^-1,  A = B0 + vI
+        """
+        g = np.asarray(g, dtype=float)
+        Ainv = 1.0/(self.diag + v)
+        x = Ainv*g
+        if len(self.S) > 0:
+            W, M = self.getCompact()
+            AiW = Ainv[:, np.newaxis]*W
+            x += np.dot(AiW, np.linalg.solve(M - np.dot(W.T, AiW), np.dot(W.T, x)))
+        return x
+
+    def toarray(self):
+        """ Return the Hessian as a dense (n, n) array. """
+        H = np.diag(self.diag)
+        if len(self.S) > 0:
+            W, M = self.getCompact()
+            H -= multi_dot([W, np.linalg.inv(M), W.T])
+        return H
+
+def update_hessian(IC, H0, xyz_seq, gradx_seq, params, trust_limit=False, max_updates=1, cache=None):
     if len(xyz_seq) < 2:
         logger.info("In update_hessian : xyz_seq contains only one element, nothing to do.\n")
         return H0
@@ -350,6 +546,11 @@ def update_hessian(IC, H0, xyz_seq, gradx_seq, params, trust_limit=False, max_up
         # Catch some abnormal cases of extremely small changes.
         if np.linalg.norm(Dg) < 1e-6: continue
         if np.linalg.norm(Dy) < 1e-6: continue
+        if isinstance(H, LBFGSHessian):
+            # Limited-memory BFGS: store the pair instead of updating a dense matrix
+            if not H.update(Dy, Dg, params.epsilon) and params.verbose:
+                logger.info("L-BFGS update skipped due to small curvature (%.3e)\n" % np.dot(Dy.T, Dg)[0,0])
+            continue
         if params.transition:
             ts_bfgs = False
             if ts_bfgs: Hup = get_hessian_update_tsbfgs(Dy, Dg, H)
@@ -373,8 +574,10 @@ def update_hessian(IC, H0, xyz_seq, gradx_seq, params, trust_limit=False, max_up
             logger.info(msg+'\n')
             
     # Return the guess Hessian if performing energy minimization and eigenvalues become negative.
-    if not params.transition and not params.irc:
-        Eig = sorted_eigh(H, asc=True)[0]
+    # (Not needed for L-BFGS which remains positive definite.)
+    if not params.transition and not params.irc and not isinstance(H, LBFGSHessian):
+        # The eigendecomposition is stored and reused for the next optimization step.
+        Eig = hessian_eigh(H, cache)[0]
         if np.min(Eig) <= params.epsilon and params.reset:
             logger.info("Eigenvalues below %.4e (%.4e) - returning guess\n" % (params.epsilon, np.min(Eig)))
             H = IC.guess_hessian(xyz_seq[-1])
@@ -421,7 +624,7 @@ def force_positive_definite(H):
             Hs -= Hvals[i] * np.outer(Hvecs[:,i], Hvecs[:,i])
     return Hs
 
-def get_delta_prime_trm(v, X, G, H, IC, verbose=0):
+def get_delta_prime_trm(v, X, G, H, IC, verbose=0, cache=None):
     """
     Returns the Newton-Raphson step given a multiple of the diagonal
     added to the Hessian, the expected decrease in the energy, and
@@ -441,6 +644,8 @@ def get_delta_prime_trm(v, X, G, H, IC, verbose=0):
         Object describing the internal coordinate system
     verbose : int
         Print diagnostic messages
+    cache : EighCache, optional
+        Stores the eigendecomposition of H for reuse with other values of v
 
     Returns
     -------
@@ -457,6 +662,23 @@ def get_delta_prime_trm(v, X, G, H, IC, verbose=0):
         GC, HC = IC.augmentGH(X, G, H) if (IC.haveConstraints() or IC.rigid) else (G, H)
     else:
         GC, HC = (G, H)
+    if len(GC) == len(G):
+        # Without constraints, (H + vI)^-1 is obtained from the eigendecomposition of H,
+        # which is computed once and reused for each value of v.
+        Hvals, Hvecs = hessian_eigh(HC, cache)
+        seig = Hvals + v
+        if verbose >= 2:
+            logger.info("sorted(eig) : % .5e % .5e % .5e ... % .5e % .5e % .5e\n"
+                        % (seig[0], seig[1], seig[2], seig[-3], seig[-2], seig[-1]))
+        # Same as invert_svd(), the components with near-zero eigenvalues are not inverted.
+        sinv = np.zeros_like(seig)
+        sinv[np.abs(seig) > 1e-12] = 1.0/seig[np.abs(seig) > 1e-12]
+        Gproj = np.dot(Hvecs.T, G)
+        dy = -1 * np.dot(Hvecs, sinv*Gproj)
+        d_prime = np.dot(Hvecs, sinv**2*Gproj)
+        dy_prime = np.dot(dy,d_prime)/np.linalg.norm(dy)
+        sol = flat(0.5*multi_dot([row(dy),H,col(dy)]))[0] + np.dot(dy,G)
+        return dy, sol, dy_prime
     HT = HC + v*np.eye(len(HC))
     # The constrained degrees of freedom should not have anything added to diagonal
     for i in range(len(G), len(GC)):
@@ -470,7 +692,7 @@ def get_delta_prime_trm(v, X, G, H, IC, verbose=0):
         ht_txt = 'HT.v_%.5f.txt' % v
         np.savetxt(ht_txt, HT, fmt='% 14.10f')
         logger.info("\x1b[1;91mSVD Error - saving %s, increasing v by 0.001 and trying again\x1b[0m (% .5f -> % .5f)\n" % (ht_txt, v, v+0.001))
-        return get_delta_prime_trm(v+0.001, X, G, H, IC)
+        return get_delta_prime_trm(v+0.001, X, G, H, IC, cache=cache)
     dyc = flat(-1 * np.dot(Hi,col(GC)))
     dy = dyc[:len(G)]
 
@@ -480,7 +702,43 @@ def get_delta_prime_trm(v, X, G, H, IC, verbose=0):
     sol = flat(0.5*multi_dot([row(dy),H,col(dy)]))[0] + np.dot(dy,G)
     return dy, sol, dy_prime
 
-def rfo_gen_evp(M, a):
+def get_delta_prime_lbfgs(v, G, H, verbose=0):
+    """
+    Returns the Newton-Raphson step for a limited-memory BFGS Hessian given a multiple
+    of the identity added to the Hessian, the expected decrease in the energy, and the
+    derivative of the step length w/r.t. v.  The linear equations are solved using the
+    compact representation of the Hessian, so the cost is O(n*m).
+
+    Parameters
+    ----------
+    v : float
+        Number that is added to the Hessian diagonal
+    G : np.ndarray
+        Flat array containing internal gradient
+    H : LBFGSHessian
+        Limited-memory internal Hessian
+    verbose : int
+        Print diagnostic messages
+
+    Returns
+    -------
+    dy : np.ndarray
+        The internal coordinate step
+    expect : float
+        Expected change of the objective function
+    dy_prime : float
+        Derivative of the internal coordinate step size w/r.t. v
+    """
+    if verbose >= 2:
+        logger.info("L-BFGS Hessian with %i updates, diagonal range % .5e ... % .5e\n"
+                    % (len(H.S), np.min(H.diag), np.max(H.diag)))
+    dy = -1 * H.solve(G, v)
+    d_prime = -1 * H.solve(dy, v)
+    dy_prime = np.dot(dy,d_prime)/np.linalg.norm(dy)
+    sol = 0.5*np.dot(dy, H.dot(dy)) + np.dot(dy,G)
+    return dy, sol, dy_prime
+
+def rfo_gen_evp(M, a, k=None, v0=None):
     """
     Solve the generalized eigenvalue problem often encountered
     in restricted step RFO, given by:
@@ -493,21 +751,28 @@ def rfo_gen_evp(M, a):
 
     [[ 1  0  ]
      [ 0 a*I ]]
+
+    If k is provided, only the k lowest eigenpairs are computed (see partial_eigh),
+    and M may also be a scipy.sparse.linalg.LinearOperator.  v0 is an optional
+    starting vector, e.g. the eigenvector from a previous value of a.
     """
-    # Values on the diagonal of the matrix
-    av = np.ones(M.shape[0])
-    av[1:] = a
-    # A to the -1/2 power
-    Amh = np.diag(av**-0.5)
-    # Form A^-1/2 * M * A^-1/2
-    Mp = multi_dot([Amh, M, Amh])
-    # Solve for eigenvalues and eigenvectors, which are actually v' = (A^1/2)*v
-    eigvals, eigvecsp = sorted_eigh(Mp, asc=True)
+    # Values on the diagonal of A to the -1/2 power
+    amh = np.ones(M.shape[0])
+    amh[1:] = a**-0.5
+    if k is None:
+        # Form A^-1/2 * M * A^-1/2
+        Mp = M * np.outer(amh, amh)
+        # Solve for eigenvalues and eigenvectors, which are actually v' = (A^1/2)*v
+        eigvals, eigvecsp = sorted_eigh(Mp, asc=True)
+    else:
+        Mp = scipy.sparse.linalg.LinearOperator(M.shape, matvec=lambda x: amh*M.dot(amh*np.asarray(x).flatten()),
+                                                dtype=float)
+        eigvals, eigvecsp = partial_eigh(Mp, k, 'SA', v0=(None if v0 is None else v0/amh))
     # Get the eigenvectors of the generalized EVP as v = (A^-1/2) v'
-    eigvecs = np.dot(Amh, eigvecsp)
+    eigvecs = amh[:, np.newaxis]*eigvecsp
     return eigvals, eigvecs
 
-def get_delta_prime_rs_p_rfo(alpha, X, G, H, IC, verbose=0):
+def get_delta_prime_rs_p_rfo(alpha, X, G, H, IC, verbose=0, cache=None):
     """
     Return the restricted-step rational functional optimization
     step, given a particular value of alpha. The step is given by:
@@ -538,6 +803,8 @@ def get_delta_prime_rs_p_rfo(alpha, X, G, H, IC, verbose=0):
         Object describing the internal coordinate system
     verbose : int
         Print diagnostic messages
+    cache : EighCache, optional
+        Stores the eigendecomposition of H for reuse with other values of alpha
 
     Returns
     -------
@@ -554,7 +821,8 @@ def get_delta_prime_rs_p_rfo(alpha, X, G, H, IC, verbose=0):
     if verbose >= 4: logger.info("        === RS-P-RFO method with alpha = %.5f ===\n" % alpha)
 
     # Sorted eigenvalues and corresponding eigenvectors of the Hessian
-    Hvals, Hvecs = sorted_eigh(H, asc=True)
+    # (computed once and reused for each value of alpha)
+    Hvals, Hvecs = hessian_eigh(H, cache)
 
     # Projection of gradient along the Hessian eigenvectors
     Gproj = np.dot(Hvecs.T, G)
@@ -567,17 +835,20 @@ def get_delta_prime_rs_p_rfo(alpha, X, G, H, IC, verbose=0):
     # with the "extra" row in the upper left.
     # Form the small P-RFO matrix, which is a 2x2 matrix
     prfo_tv = np.array([[0, Gproj[tv]], [Gproj[tv], Hvals[tv]]])
-    # Form the large P-RFO matrix, which is the same size as H itself
-    prfo_ot = np.zeros_like(H)
-    # Fill matrix (except top left) with the non-'tv' eigenvalues
-    prfo_ot[1:, 1:] = np.diag(Hvals[ot])
-    # Fill the top row and left column with the non-'tv' gradient components
-    prfo_ot[0, 1:] = Gproj[ot]
-    prfo_ot[1:, 0] = Gproj[ot]
+    # The large P-RFO matrix is the same size as H itself, with the non-'tv' eigenvalues
+    # on the diagonal (except top left) and the non-'tv' gradient components in the top row
+    # and left column.  Only its lowest eigenvalue is needed, which is found using products
+    # with the matrix starting from the eigenvector for the previous value of alpha.
+    def prfo_ot_dot(x):
+        return np.concatenate(([np.dot(Gproj[ot], x[1:])], Gproj[ot]*x[0] + Hvals[ot]*x[1:]))
+    prfo_ot_op = scipy.sparse.linalg.LinearOperator(H.shape, matvec=prfo_ot_dot, dtype=float)
 
     # Solve the generalized eigenvector problems
     tv_vals, tv_vecs = rfo_gen_evp(prfo_tv, alpha)
-    ot_vals, ot_vecs = rfo_gen_evp(prfo_ot, alpha)
+    guess = None if cache is None else cache.rfo_guess
+    if guess is not None and len(guess) != len(G): guess = None
+    ot_vals, ot_vecs = rfo_gen_evp(prfo_ot_op, alpha, k=1, v0=guess)
+    if cache is not None: cache.rfo_guess = ot_vecs[:, 0]
 
     ## Form the P-RFO step.
     dy_tv = -Gproj[tv]*Hvecs[:,tv]/(Hvals[tv]-tv_vals[-1]*alpha)
@@ -611,6 +882,7 @@ def get_delta_prime_rs_p_rfo(alpha, X, G, H, IC, verbose=0):
     expect = flat(0.5*multi_dot([row(dy),H,col(dy)]))[0] + np.dot(dy,G)
 
     if verbose >= 5: # pragma: no cover
+        prfo_ot = prfo_ot_op.dot(np.eye(H.shape[0]))
         logger.info("        Largest / smallest eigvals of small / large P-RFO matrix: % .5f % .5f\n" % (tv_vals[-1], ot_vals[0]))
         logger.info("        Small P-RFO matrix:\n        ")
         pmat2d(prfo_tv, precision=5, format='f')
@@ -718,7 +990,7 @@ def get_delta_prime_rfo(alpha, X, G, H, IC, verbose=0): # pragma: no cover
     dyprime1 = dyprime2 / (2*np.sqrt(dy2))
     return dy, expect, dyprime1
 
-def get_delta_prime(v, X, G, H, IC, rfo, verbose=0):
+def get_delta_prime(v, X, G, H, IC, rfo, verbose=0, cache=None):
     """
     Return the internal coordinate step given a parameter "v".
     "v" refers to the multiple of the identity added to the Hessian
@@ -734,14 +1006,16 @@ def get_delta_prime(v, X, G, H, IC, rfo, verbose=0):
         Flat array of Cartesian coordinates in atomic units
     G : np.ndarray
         Flat array containing internal gradient
-    H : np.ndarray
-        Square array containing internal Hessian
+    H : np.ndarray or LBFGSHessian
+        Square array containing internal Hessian, or limited-memory Hessian (always uses TRM)
     IC : InternalCoordinates
         Object describing the internal coordinate system
     rfo : bool
         If True, use rational functional optimization, otherwise use trust-radius method
     verbose : int
         Print diagnostic messages
+    cache : EighCache, optional
+        Stores the eigendecomposition of H for reuse with other values of v
 
     Returns
     -------
@@ -752,16 +1026,19 @@ def get_delta_prime(v, X, G, H, IC, rfo, verbose=0):
     dy_prime : float
         Derivative of the internal coordinate step size w/r.t. v
     """
-    if rfo:
+    if isinstance(H, LBFGSHessian):
+        method="L-BFGS trust radius Newton-Raphson"
+        dy, expect, dy_prime = get_delta_prime_lbfgs(v, G, H, verbose)
+    elif rfo:
         method="Restricted step P-RFO"
-        dy, expect, dy_prime = get_delta_prime_rs_p_rfo(v, X, G, H, IC, verbose)
+        dy, expect, dy_prime = get_delta_prime_rs_p_rfo(v, X, G, H, IC, verbose, cache)
     else:
         method="Trust radius Newton-Raphson"
-        dy, expect, dy_prime = get_delta_prime_trm(v, X, G, H, IC, verbose)
+        dy, expect, dy_prime = get_delta_prime_trm(v, X, G, H, IC, verbose, cache)
     if verbose >= 2: logger.info("      %s step with v = %10.5f : expect-deltaE = %.5f, Internal-step = %.5f\n" % (method, v, expect, np.linalg.norm(dy)))
     return dy, expect, dy_prime
 
-def trust_step(target, v0, X, G, H, IC, rfo, verbose=0):
+def trust_step(target, v0, X, G, H, IC, rfo, verbose=0, cache=None):
     """
     Apply an iteration formula to find the trust radius step,
     given the target value of the trust radius.
@@ -784,6 +1061,8 @@ def trust_step(target, v0, X, G, H, IC, rfo, verbose=0):
         If True, use rational functional optimization, otherwise use trust-radius method
     verbose : int
         Print diagnostic messages
+    cache : EighCache, optional
+        Stores the eigendecomposition of H for reuse with other values of v
 
     Returns
     -------
@@ -793,7 +1072,10 @@ def trust_step(target, v0, X, G, H, IC, rfo, verbose=0):
         Expected change of the objective function
     """
     if verbose >= 2: logger.info("    trust_step targeting internal coordinate step of length %.4f\n" % target)
-    dy, sol, dy_prime = get_delta_prime(v0, X, G, H, IC, rfo, verbose)
+    if cache is None:
+        # The eigendecomposition is still reused for each value of v in this search
+        cache = EighCache()
+    dy, sol, dy_prime = get_delta_prime(v0, X, G, H, IC, rfo, verbose, cache)
 
     ndy = np.linalg.norm(dy)
     if ndy < target:
@@ -812,15 +1094,15 @@ def trust_step(target, v0, X, G, H, IC, rfo, verbose=0):
         else:
             # Iterative formula from Hebden (1973), equation 5.2.10 in "Practical methods of optimization" by Fletcher
             v += (1-ndy/target)*(ndy/dy_prime)
-        dy, sol, dy_prime, = get_delta_prime(v, X, G, H, IC, rfo, verbose)
+        dy, sol, dy_prime, = get_delta_prime(v, X, G, H, IC, rfo, verbose, cache)
         ndy = np.linalg.norm(dy)
         if np.abs((ndy-target)/target) < 0.001:
-            if verbose >= 3: get_delta_prime(v, X, G, H, IC, rfo, verbose+1)
+            if verbose >= 3: get_delta_prime(v, X, G, H, IC, rfo, verbose+1, cache)
             if verbose: logger.info("    trust_step Iter:  %4i, v = %.5f, dy on target:   %.5f ---> %.5f\n" % (niter, v, ndy, target))
             return dy, sol
         # With Lagrange multipliers it may be impossible to go under a target step size
         elif niter > 10 and np.abs(ndy_last-ndy)/ndy < 0.001:
-            if verbose >= 3: get_delta_prime(v, X, G, H, IC, rfo, verbose+1)
+            if verbose >= 3: get_delta_prime(v, X, G, H, IC, rfo, verbose+1, cache)
             if verbose: logger.info("    trust_step Iter:  %4i, v = %.5f, dy over target: %.5f -x-> %.5f\n" % (niter, v, ndy, target))
             return dy, sol
         elif verbose >= 2: logger.info("    trust_step Iter:  %4i, v = %.5f, dy -> target:   %.5f ---> %.5f\n" % (niter, v, ndy, target))
@@ -835,6 +1117,6 @@ def trust_step(target, v0, X, G, H, IC, rfo, verbose=0):
             # logger.info("    trust_step Iter:  %4i, randomizing\n" % niter)
             v += np.random.random() * niter / 100
         if niter%1000 == 999:
-            if verbose >= 3: get_delta_prime(v, X, G, H, IC, rfo, verbose+1)
+            if verbose >= 3: get_delta_prime(v, X, G, H, IC, rfo, verbose+1, cache)
             if verbose: logger.info("    trust_step Iter:  %4i, v = %.5f, dy at max-iter: %.5f -x-> %.5f\n" % (niter, v, ndy, target))
             return m_dy, m_sol
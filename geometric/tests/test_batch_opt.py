@@ -1,9 +1,10 @@
 """
-A set of tests for using the QCEngine project
+A set of tests for the BatchOptimizer, including the QCEngine project
 """
 
 import copy
 import numpy as np
+import geometric
 import tempfile
 import logging
 import math
@@ -12,6 +13,7 @@ from geometric.molecule import bohr2ang
 logger = logging.getLogger(__name__)
 
 from . import addons
+from .test_customengine import model, water_molecule
 import geometric.optimize as gt 
 from geometric.internal import CartesianCoordinates,\
     PrimitiveInternalCoordinates, DelocalizedInternalCoordinates
@@ -43,120 +45,85 @@ _geo2 = [0.0139,  -0.4830,   0.2848,
          0.0628,  -0.2860,   0.7675,
          0.0953,  -1.0031,   0.4339]
 
-@addons.using_qcengine
-@addons.using_rdkit
-
-
-
-
-class BatchOptimizer(object):
-    """ Demo BatchOptmizer for runnig pytest test """
-    
-    def __init__(self, **kwargs):
-        self.kwargs = kwargs
-        self.params = gt.OptParams(**kwargs)
-        
-        
-    def _initOptimizer(self, schemas):
-        """ initilize all OptObjects for the schmas passed.
-        
-        Arguements
-        ----------
-        schemas: list of schemas for qcengine
-        
-        return
-        ------
-        list of OptOject's for each schema
-        """
-        
-        #=========================================#
-        #| Set up the internal coordinate system |#
-        #=========================================#
-        # First item in tuple: The class to be initialized
-        # Second item in tuple: Whether to connect non-bonded fragments
-        # Third item in tuple: Whether to throw in all Cartesian (no effect if second item is True)
-        CoordSysDict = {'cart':(CartesianCoordinates, False, False),
-                        'prim':(PrimitiveInternalCoordinates, True, False),
-                        'dlc':(DelocalizedInternalCoordinates, True, False),
-                        'hdlc':(DelocalizedInternalCoordinates, False, True),
-                        'tric':(DelocalizedInternalCoordinates, False, False)}
-        coordsys = self.kwargs.get('coordsys', 'tric')
-        CoordClass, connect, addcart = CoordSysDict[coordsys.lower()]
-
-        optimizers = []
-        for schema in schemas:
-            M, engine = gt.get_molecule_engine(engine='qcengine', qcschema=schema, **self.kwargs)
-            coords = M.xyzs[0].flatten() * ang2bohr
-    
-            # Read in the constraints
-            constraints = self.kwargs.get('constraints', None) #Constraint input file (optional)
-            if constraints is not None:
-                Cons, CVals = gt.ParseConstraints(M, open(constraints).read())
-            else:
-                Cons = None
-                CVals = None
-            
-            IC = CoordClass(M, build=True, connect=connect, addcart=addcart, constraints=Cons, 
-                            cvals=CVals[0] if CVals is not None else None)
-            tmpDir = tempfile.mkdtemp(".tmp", "batchOpt")
-
-            optimizer = gt.Optimizer(coords, M, IC, engine, tmpDir, self.params)
-            optimizer.calcEnergyForce()
-            optimizer.prepareFirstStep()
-            logger.debug("[AU]: e=%.5f bl=%.5f,%.5f g=%.4f" % (
-                    optimizer.E, optimizer.X[0],optimizer.X[3], optimizer.gradx[0]))
-            optimizers.append(optimizer)
-            
-        return optimizers
-    
+def _init_optimizers(schemas, **kwargs):
+    """ Create an Optimizer object for each of the schemas passed.
+
+    Arguments
+    ---------
+    schemas: list of schemas for qcengine
+
+    return
+    ------
+    list of Optimizer's for each schema
+    """
+    params = gt.OptParams(**kwargs)
+    optimizers = []
+    for schema in schemas:
+        M, engine = gt.get_molecule_engine(engine='qcengine', qcschema=schema, **kwargs)
+        coords = M.xyzs[0].flatten() * ang2bohr
+        IC = DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+        tmpDir = tempfile.mkdtemp(".tmp", "batchOpt")
+        optimizers.append(gt.Optimizer(coords, M, IC, engine, tmpDir, params))
+    return optimizers
+
+
+class ModelEngine(geometric.engine.Engine):
+    """ Engine for the model potential used by the batch test without external dependencies """
+    def __init__(self, molecule, fail_after=None):
+        super(ModelEngine, self).__init__(molecule)
+        self.fail_after = fail_after
+        self.ncalc = 0
+
+    def calc_new(self, coords, dirname):
+        self.ncalc += 1
+        if self.fail_after is not None and self.ncalc > self.fail_after:
+            raise geometric.errors.EngineError("Model calculation failed")
+        energy, gradient = model(coords.reshape(-1,3))
+        return {'energy': energy, 'gradient': gradient.ravel()}
+
+
+class CountingBatchOptimizer(gt.BatchOptimizer):
+    """ Records the size of each batch passed to calcBatch() """
+    def __init__(self, optimizers):
+        super(CountingBatchOptimizer, self).__init__(optimizers, verbose=1)
+        self.batch_sizes = []
+
+    def calcBatch(self, optimizers):
+        self.batch_sizes.append(len(optimizers))
+        return super(CountingBatchOptimizer, self).calcBatch(optimizers)
+
+
+def test_batch_model(localizer):
+    """ Run three optimizations in lockstep where one of them fails partway through """
+    geos = [np.array([[0., 0.3, 0], [0.9, 0.8, 0], [-0.9, 0.5, 0]]),
+            np.array([[0., 0.0, 0], [0.9, 0.0, 0], [-0.4, 0.9, 0]]),
+            np.array([[0., 0.3, 0], [0.9, 0.8, 0], [-0.9, 0.5, 0]])]
+    params = gt.OptParams()
+    optimizers = []
+    for i, geo in enumerate(geos):
+        M = water_molecule(geo)
+        engine = ModelEngine(M, fail_after=(3 if i == 2 else None))
+        IC = DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+        optimizers.append(gt.Optimizer(M.xyzs[0].flatten()*ang2bohr, M, IC, engine, "batch_%i.tmp" % i, params))
+    bOptimizer = CountingBatchOptimizer(optimizers)
+    ret = bOptimizer.optimizeBatch()
+
+    assert bOptimizer.status == ['converged', 'converged', 'failed']
+    assert isinstance(bOptimizer.errors[2], geometric.errors.EngineError)
+    # Results are returned in the order of the optimizers, and agree with a serial optimization
+    M = water_molecule(geos[0])
+    IC = DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+    ref = gt.Optimize(M.xyzs[0].flatten()*ang2bohr, M, IC, ModelEngine(M), "serial.tmp", params)
+    assert len(ret[0]) == len(ref)
+    assert np.allclose(ret[0].xyzs[-1], ref.xyzs[-1], atol=1e-6)
+    for m in ret[:2]:
+        assert model(m.xyzs[-1] * ang2bohr)[0] < 1e-8
+    # All structures in each round are evaluated in one batch, and retired optimizations drop out
+    assert bOptimizer.batch_sizes[0] == 3
+    assert max(bOptimizer.batch_sizes[4:]) <= 2
+    assert bOptimizer.stats['rounds'] == max(len(m) for m in ret[:2]) - 1
+    assert bOptimizer.stats['gradients'] == sum(bOptimizer.batch_sizes)
 
-    def _batchComputeEnergyAndForces(self, optimizers):
-        """ This just an mockup. if this was NNP this would work in one batch
-            on the GPU.
-        """
-        for optimizer in optimizers:
-            if optimizer.state == gt.OPT_STATE.NEEDS_EVALUATION:
-                optimizer.calcEnergyForce()
-                logger.debug("[AU]: e=%.5f bl=%.5f,%.5f g=%.4f" % (
-                    optimizer.E, optimizer.X[0],optimizer.X[3], optimizer.gradx[0]))
-    
-    def optimizeMols(self, schemas):
-        """ Optmize all molecules as represented by the schemas.
-        
-            return
-            ------
-            list of optimized Molecule's
-        """
-        optimizers = self._initOptimizer(schemas)
-        res = []
-        
-        # Optimization Loop, while not all have completed optimization
-        while len(optimizers) > 0:
-            nextOptObjs = []
-            
-            # take one step, energy and gradient must have been stored in optObj
-            for optimizer in optimizers:    
-                optimizer.step()
-
-            self._batchComputeEnergyAndForces(optimizers)
-
-            # evaluate step
-            for optimizer in optimizers:    
-                if optimizer.state == gt.OPT_STATE.NEEDS_EVALUATION:
-                    
-                    optimizer.evaluateStep() 
-                    if optimizer.state in [gt.OPT_STATE.CONVERGED, gt.OPT_STATE.FAILED]:
-                        logger.info("Optmization convereged!")
-                        res.append(optimizer.progress)
-                        continue
-                nextOptObjs.append(optimizer)
-            if len(nextOptObjs) == 0: break  ######## All Done
-             
-            # step and evaluation completed, next step for remaining conformations
-            optimizers = nextOptObjs
-            
-        return res
- 
 
 @addons.using_qcengine
 @addons.using_rdkit
@@ -168,8 +135,8 @@ def test_rdkit_simple():
     
     opts = {"qcengine": True, "input": "tmp_data", "qce_program": "rdkit"}
 
-    bOptimizer = BatchOptimizer(**opts)
-    ret = bOptimizer.optimizeMols([schema1, schema2])
+    bOptimizer = gt.BatchOptimizer(_init_optimizers([schema1, schema2], **opts))
+    ret = bOptimizer.optimizeBatch()
 
     # Currently in angstrom
     ref = np.array([0., 0., -0.0644928042, 0., -0.7830365196, 0.5416895554, 0., 0.7830365196, 0.5416895554])
@@ -222,8 +189,8 @@ def test_rdkit_N2():
     
     opts = {"qcengine": True, "input": "tmp_data", "qce_program": "rdkit"}
 
-    bOptimizer = BatchOptimizer(**opts)
-    ret = bOptimizer.optimizeMols([schema1, schema2])
+    bOptimizer = gt.BatchOptimizer(_init_optimizers([schema1, schema2], **opts))
+    ret = bOptimizer.optimizeBatch()
 
     # Currently in angstrom
     ref = np.array([-0.05729, 0., 0.,   1.06272, 0., 0.])
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import os
 import tempfile
 import numpy as np
+import pytest
 import geometric
 import geometric.molecule
 from . import addons
@@ -28,6 +30,18 @@ def model(coords):
     grad-= np.einsum('ij,ijx->jx', 2*w*(dist-b)/(dist+1e-60), dr)
     return e, grad
 
+def water_molecule(xyz=None):
+    """ Water molecule for the model Hamiltonian; the default geometry is in Angstrom """
+    molecule = geometric.molecule.Molecule()
+    molecule.elem = ['O', 'H', 'H']
+    if xyz is None:
+        xyz = np.array((( 0. , 0.3, 0),
+                        ( 0.9, 0.8, 0),
+                        (-0.9, 0.5, 0),
+                       ))
+    molecule.xyzs = [np.array(xyz, dtype=float)]
+    return molecule
+
 class CustomEngine(geometric.engine.Engine):
     def __init__(self, molecule):
         super(CustomEngine, self).__init__(molecule)
@@ -38,13 +52,7 @@ class CustomEngine(geometric.engine.Engine):
 
 
 def test_customengine(localizer):
-    molecule = geometric.molecule.Molecule()
-    molecule.elem = ['O', 'H', 'H']
-    molecule.xyzs = [np.array((( 0. , 0.3, 0),
-                               ( 0.9, 0.8, 0),
-                               (-0.9, 0.5, 0),
-                              ))  # In Angstrom
-                    ]
+    molecule = water_molecule()
     customengine = CustomEngine(molecule)
 
     # tmpf = tempfile.mktemp()
@@ -55,5 +63,122 @@ def test_customengine(localizer):
     e = model(coords)[0]
     assert e < 1e-8
 
+def test_customengine_lbfgs(localizer):
+    molecule = water_molecule()
+    customengine = CustomEngine(molecule)
+
+    with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmpf:
+        m = geometric.optimize.run_optimizer(customengine=customengine, check=1, input=tmpf.name, lbfgs=5)
+
+    coords = m.xyzs[-1] / Bohr
+    e = model(coords)[0]
+    assert e < 1e-6
+
+class QueueEngine(CustomEngine):
+    """ Custom engine that evaluates "Work Queue" calculations immediately on a rough surface. """
+    def __init__(self, molecule):
+        super(QueueEngine, self).__init__(molecule)
+        self.queued = {}
+        self.ncalc = 0
+
+    def calc_new(self, coords, dirname):
+        self.ncalc += 1
+        energy, gradient = model(coords.reshape(-1,3))
+        gradient = gradient.ravel()
+        energy += 0.5*np.sin(20*coords[0])
+        gradient[0] += 10*np.cos(20*coords[0])
+        return {'energy': energy, 'gradient': gradient}
+
+    def calc_wq_new(self, coords, dirname):
+        if not os.path.exists(dirname): os.makedirs(dirname)
+        self.queued[dirname] = self.calc_new(coords, dirname)
+
+    def read_result(self, dirname, check_coord=None):
+        if dirname not in self.queued:
+            raise geometric.errors.EngineError("No queued calculation in %s" % dirname)
+        return self.queued.pop(dirname)
+
+    def copy_scratch(self, src, dest):
+        return
+
+class FakeWorkQueue(object):
+    def empty(self):
+        return True
+
+def test_customengine_speculate(localizer, monkeypatch):
+    monkeypatch.setattr(geometric.optimize, 'getWorkQueue', lambda: FakeWorkQueue())
+    # Record whether each step is a fallback step that was already evaluated
+    prepare_step = geometric.optimize.Optimizer.prepare_step
+    steps = []
+    def record_step(self):
+        steps.append(self.fallback is not None)
+        return prepare_step(self)
+    monkeypatch.setattr(geometric.optimize.Optimizer, 'prepare_step', record_step)
+    result = {}
+    nsteps = {}
+    for speculate in [False, True]:
+        del steps[:]
+        molecule = water_molecule()
+        customengine = QueueEngine(molecule)
+        with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmpf:
+            m = geometric.optimize.run_optimizer(customengine=customengine, input=tmpf.name, transition=True,
+                                                 trust=0.1, tmax=0.3, speculate=speculate)
+        result[speculate] = (m, customengine.ncalc)
+        nsteps[speculate] = (len(steps), sum(steps))
+    # Taking the evaluated fallback steps does not change the optimization trajectory,
+    # but the fallback steps are evaluated together with every step.
+    m0, m1 = result[False][0], result[True][0]
+    assert len(m0) == len(m1)
+    np.testing.assert_allclose(m0.xyzs[-1], m1.xyzs[-1], atol=1e-6)
+    assert result[True][1] > result[False][1]
+    # Fallback steps go through the same checks at the start of each step as other steps
+    assert nsteps[False][0] == nsteps[True][0]
+    assert nsteps[False][1] == 0 and nsteps[True][1] > 0
+
+def test_customengine_submit(localizer):
+    molecule = water_molecule()
+    coords = molecule.xyzs[0].flatten() / Bohr
+    displaced = [coords + 0.01*i for i in range(4)]
+    # Without a local process pool, submit() returns futures that are already done
+    customengine = CustomEngine(molecule)
+    future = customengine.submit(displaced[0], "calc_serial")
+    assert future.done()
+    np.testing.assert_allclose(future.result()['gradient'], model(displaced[0].reshape(-1,3))[1].ravel())
+    # With the pool, calculations run in worker processes and results are stored when they are collected
+    geometric.nifty.createLocalPool(2)
+    try:
+        futures = [customengine.submit(x, "calc_%i" % i) for i, x in enumerate(displaced)]
+        for future in futures:
+            future.result()
+        assert len(customengine.stored_calcs) == 1
+        for x, future in zip(displaced, futures):
+            e, g = model(x.reshape(-1,3))
+            result = customengine.collect(future, x)
+            assert np.isclose(result['energy'], e)
+            np.testing.assert_allclose(result['gradient'], g.ravel())
+    finally:
+        geometric.nifty.destroyLocalPool()
+    assert len(customengine.stored_calcs) == 4
+    # The first structure was already calculated, so it is not submitted again
+    assert not os.path.exists("calc_0")
+    assert all(os.path.isdir("calc_%i" % i) for i in range(1, 4))
+    # Clearing the stored results can keep some of them
+    customengine.clearCalcs(keep=[displaced[2]])
+    assert len(customengine.stored_calcs) == 1
+    customengine.calc(displaced[2], "calc_2_again")
+    assert not os.path.exists("calc_2_again")
+
+class FailingEngine(CustomEngine):
+    """ Custom engine whose calculations always fail. """
+    def calc_new(self, coords, dirname):
+        raise geometric.errors.EngineError("Calculation failed")
+
+def test_customengine_pool_error(localizer):
+    # The local process pool is shut down when the optimization fails
+    with tempfile.NamedTemporaryFile(mode="w+", delete=False) as tmpf:
+        with pytest.raises(geometric.errors.EngineError):
+            geometric.optimize.run_optimizer(customengine=FailingEngine(water_molecule()), input=tmpf.name, cores=2)
+    assert geometric.nifty.getLocalPool() is None
+
 if __name__ == '__main__':
     test_customengine()
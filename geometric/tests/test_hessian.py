@@ -9,6 +9,7 @@ import os, shutil
 import numpy as np
 import tempfile
 from . import addons
+from .test_customengine import model, water_molecule
 from geometric.internal import *
 
 datad = addons.datad
@@ -44,6 +45,72 @@ def test_hessian_assort():
     assert np.allclose(fgrad_dlc, agrad_dlc, atol=1.e-6)
     assert np.allclose(fhess_dlc, ahess_dlc, atol=1.e-6)
 
+def test_lbfgs_hessian():
+    M = geometric.molecule.Molecule(os.path.join(datad, 'assort.xyz'))
+    coords = M.xyzs[0].flatten() * ang2bohr
+    IC = DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+    # The L-BFGS Hessian starts from the diagonal of the guess Hessian
+    H0 = np.diag(np.diag(IC.guess_hessian(coords)))
+    np.testing.assert_almost_equal(np.diag(H0), IC.guess_hessian_diagonal(coords))
+    H = geometric.step.LBFGSHessian(IC.guess_hessian_diagonal(coords), 3)
+    # Compare with dense BFGS updates using the last 3 of 5 steps on a model quadratic surface
+    np.random.seed(0)
+    A = np.random.random((len(H), len(H)))
+    A = np.dot(A, A.T) + np.eye(len(H))
+    steps = [np.random.random(len(H)) for i in range(5)]
+    for dy in steps:
+        assert H.update(dy, np.dot(A, dy))
+        assert len(H.S) <= 3
+    assert not H.update(steps[0], -steps[0])
+    Hd = H0.copy()
+    for dy in steps[-3:]:
+        Hd += geometric.step.get_hessian_update_bfgs(dy[:, np.newaxis], np.dot(A, dy)[:, np.newaxis], Hd)
+    np.testing.assert_almost_equal(H.toarray(), Hd)
+    g = np.random.random(len(H))
+    np.testing.assert_almost_equal(H.dot(g), np.dot(Hd, g))
+    np.testing.assert_almost_equal(H.solve(g, 0.1), np.linalg.solve(Hd + 0.1*np.eye(len(H)), g))
+    # The step and its derivative w/r.t. v are the same as the dense trust radius Newton-Raphson step
+    for v in [0.0, 0.5]:
+        ref = geometric.step.get_delta_prime_trm(v, coords, g, Hd, None)
+        ans = geometric.step.get_delta_prime(v, coords, g, H, IC, False)
+        np.testing.assert_almost_equal(ans[0], ref[0])
+        np.testing.assert_almost_equal(ans[1:], ref[1:])
+
+def test_step_eigh(monkeypatch):
+    M = geometric.molecule.Molecule(os.path.join(datad, 'assort.xyz'))
+    coords = M.xyzs[0].flatten() * ang2bohr
+    IC = DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+    np.random.seed(0)
+    A = np.random.random((len(IC.Internals), len(IC.Internals)))
+    H = IC.guess_hessian(coords) + 0.01*(A + A.T)
+    H[0, 0] -= 1.0
+    G = np.random.random(len(IC.Internals)) - 0.5
+    # The eigendecomposition is only computed once for the same Hessian
+    cache = geometric.step.EighCache()
+    Hvals, Hvecs = geometric.step.hessian_eigh(H, cache)
+    assert geometric.step.hessian_eigh(H.copy(), cache)[1] is Hvecs
+    assert geometric.step.hessian_eigh(H.copy())[1] is not Hvecs
+    np.testing.assert_almost_equal(geometric.step.hessian_eigvals(H, cache), np.linalg.eigvalsh(H))
+    # The trust radius Newton-Raphson step from the eigendecomposition is the same as from the SVD
+    for v in [0.0, 1.5]:
+        Hi = geometric.nifty.invert_svd(H + v*np.eye(len(H)))
+        dy, expect, dy_prime = geometric.step.get_delta_prime_trm(v, coords, G, H, IC, cache=cache)
+        np.testing.assert_almost_equal(dy, -np.dot(Hi, G))
+        np.testing.assert_almost_equal(dy_prime, np.dot(dy, -np.dot(Hi, dy))/np.linalg.norm(dy))
+    # RS-P-RFO steps using the Lanczos method for the large P-RFO matrix are the same as full diagonalization
+    alphas = [1.0, 1.2, 1.5]
+    monkeypatch.setattr(geometric.step, 'lanczos_min_dim', 10**6)
+    ref = [geometric.step.get_delta_prime_rs_p_rfo(alpha, coords, G, H, IC) for alpha in alphas]
+    monkeypatch.setattr(geometric.step, 'lanczos_min_dim', 5)
+    for alpha, (dy0, expect0, dy_prime0) in zip(alphas, ref):
+        dy, expect, dy_prime = geometric.step.get_delta_prime_rs_p_rfo(alpha, coords, G, H, IC, cache=cache)
+        np.testing.assert_almost_equal(dy, dy0)
+        np.testing.assert_almost_equal(dy_prime, dy_prime0)
+    # The P-RFO starting vector is kept for the same Hessian and dropped when the Hessian changes
+    assert cache.rfo_guess is not None
+    geometric.step.hessian_eigh(H + 0.01*np.eye(len(H)), cache)
+    assert cache.rfo_guess is None
+
 @addons.using_psi4
 @addons.using_bigchem
 def test_psi4_bigchem_hessian(bigchem_frequency):
@@ -142,6 +209,142 @@ class TestASEWorkQueueHessian:
         geometric.nifty.destroyWorkQueue()
 
 
+class ModelHessianEngine(geometric.engine.Engine):
+    """ Engine for the water model potential that writes its results to disk and records its number of threads """
+    def __init__(self, molecule):
+        super(ModelHessianEngine, self).__init__(molecule)
+        self.threads = None
+
+    def calc_new(self, coords, dirname):
+        energy, gradient = model(coords.reshape(-1,3))
+        np.savetxt(os.path.join(dirname, 'result.txt'), np.concatenate([[energy], gradient.ravel(), coords]))
+        return {'energy': energy, 'gradient': gradient.ravel(), 'threads': self.threads}
+
+    def read_result(self, dirname, check_coord=None):
+        if not os.path.exists(os.path.join(dirname, 'result.txt')):
+            raise geometric.errors.EngineError("Result not found in %s" % dirname)
+        data = np.loadtxt(os.path.join(dirname, 'result.txt'))
+        nc = (len(data)-1)//2
+        if check_coord is not None and not np.allclose(data[1+nc:], check_coord, atol=1e-8):
+            raise geometric.errors.CheckCoordError("Coordinates do not match")
+        return {'energy': data[0], 'gradient': data[1:1+nc], 'read': True}
+
+    def copy_scratch(self, src, dest):
+        if not os.path.exists(dest): os.makedirs(dest)
+
+def test_local_parallel_hessian(localizer):
+    molecule = water_molecule()
+    coords = molecule.xyzs[0].flatten()*ang2bohr
+    hessian_ref = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, ModelHessianEngine(molecule),
+                                                                'serial.tmp')
+    # Leave behind one finished displacement as if the calculation had been interrupted
+    finished = coords.copy()
+    finished[0] += 1.0e-3
+    engine = ModelHessianEngine(molecule)
+    os.makedirs(os.path.join('parallel.tmp', 'hessian', 'displace', '001p'))
+    engine.calc_new(finished, os.path.join('parallel.tmp', 'hessian', 'displace', '001p'))
+    hessian = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'parallel.tmp',
+                                                            workers=2, cores=4)
+    np.testing.assert_allclose(hessian, hessian_ref, atol=1e-8)
+    results = [calc['result'] for calc in engine.stored_calcs.values()]
+    # The central point and the finished displacement are not calculated by the workers
+    assert len(results) == 2*len(coords)+1
+    assert sum([result.get('read', False) for result in results]) == 1
+    assert sum([result.get('threads', None) == 2 for result in results]) == 2*len(coords)-1
+    # The local process pool only exists during the calculation, and an existing pool is restored afterwards
+    assert geometric.nifty.getLocalPool() is None
+    geometric.nifty.createLocalPool(3)
+    try:
+        hessian = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, ModelHessianEngine(molecule),
+                                                                'restore.tmp', workers=2, cores=4)
+        np.testing.assert_allclose(hessian, hessian_ref, atol=1e-8)
+        assert geometric.nifty.getLocalPool().workers == 3
+        assert geometric.nifty.getLocalPool().threads == 1
+    finally:
+        geometric.nifty.destroyLocalPool()
+
+def test_hessian_scheme(localizer):
+    molecule = water_molecule()
+    coords = molecule.xyzs[0].flatten()*ang2bohr
+    nc = len(coords)
+    hessian_ref = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, ModelHessianEngine(molecule),
+                                                                'central.tmp')
+    # Forward differences use one gradient per coordinate and the gradient of the central point
+    engine = ModelHessianEngine(molecule)
+    hessian = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'forward.tmp',
+                                                            diff='forward', step=1.0e-4)
+    assert len(engine.stored_calcs) == nc+1
+    np.testing.assert_allclose(hessian, hessian.T)
+    np.testing.assert_allclose(hessian, hessian_ref, atol=1e-3)
+    # Only displace the second atom; the block between the other atoms is taken from the guess or set to zero
+    guess = np.arange(nc*nc, dtype=float).reshape(nc, nc)
+    guess += guess.T
+    for fill in [guess, None]:
+        engine = ModelHessianEngine(molecule)
+        hessian = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'subset.tmp',
+                                                                read_data=False, atoms=[1], guess=fill)
+        assert len(engine.stored_calcs) == 7
+        np.testing.assert_allclose(hessian, hessian.T)
+        np.testing.assert_allclose(hessian[3:6], hessian_ref[3:6], atol=1e-6)
+        rest = [0, 1, 2, 6, 7, 8]
+        np.testing.assert_allclose(hessian[np.ix_(rest, rest)], 0.0 if fill is None else guess[np.ix_(rest, rest)])
+    with pytest.raises(ValueError):
+        geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'bad.tmp', diff='backward')
+    # Hessian data is only read if it was calculated using the same scheme
+    hesstxt = os.path.join('forward.tmp', 'hessian', 'hessian.txt')
+    scheme = geometric.normal_modes.hessian_scheme('forward', 1.0e-4)
+    assert geometric.normal_modes.read_hessian_scheme(hesstxt) == scheme
+    engine = ModelHessianEngine(molecule)
+    geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'forward.tmp', diff='forward', step=1.0e-4)
+    assert len(engine.stored_calcs) == 0
+    engine = ModelHessianEngine(molecule)
+    hessian = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'forward.tmp')
+    assert len(engine.stored_calcs) == 2*nc+1
+    np.testing.assert_allclose(hessian, hessian_ref, atol=1e-8)
+    # Files without a header were calculated using the default scheme
+    np.savetxt(os.path.join('central.tmp', 'hessian', 'hessian.txt'), hessian_ref)
+    engine = ModelHessianEngine(molecule)
+    geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'central.tmp')
+    assert len(engine.stored_calcs) == 0
+    engine = ModelHessianEngine(molecule)
+    geometric.normal_modes.calc_cartesian_hessian(coords, molecule, engine, 'central.tmp', atoms=[1])
+    assert len(engine.stored_calcs) == 7
+
+def test_lowest_hessian(localizer):
+    molecule = water_molecule()
+    coords = molecule.xyzs[0].flatten()*ang2bohr
+    hessian_ref = geometric.normal_modes.calc_cartesian_hessian(coords, molecule, ModelHessianEngine(molecule),
+                                                                'full.tmp')
+    freqs_ref, modes_ref, _ = geometric.normal_modes.frequency_analysis(coords, hessian_ref, molecule.elem)
+    IC = DelocalizedInternalCoordinates(molecule, build=True, connect=False, addcart=False)
+    engine = ModelHessianEngine(molecule)
+    gradient = engine.calc(coords, 'lowest.tmp')['gradient']
+    guess = IC.calcHessCart(coords, IC.calcGrad(coords, gradient), IC.guess_hessian(coords))
+    hessian = geometric.normal_modes.calc_lowest_hessian(coords, molecule, engine, 'lowest.tmp', guess, nmodes=1)
+    np.testing.assert_allclose(hessian, hessian.T, atol=1e-10)
+    # The lowest mode agrees with the full finite difference Hessian using fewer gradients
+    assert len(engine.stored_calcs) < 2*len(coords)+1
+    freqs, modes, _ = geometric.normal_modes.frequency_analysis(coords, hessian, molecule.elem)
+    assert abs(freqs[0] - freqs_ref[0]) < 1.0
+    assert abs(np.dot(modes[0].ravel(), modes_ref[0].ravel())) > 0.999
+    assert os.path.exists(os.path.join('lowest.tmp', 'hessian', 'hessian_lowest.txt'))
+    # The Hessian is read back if it was calculated at the same coordinates using the same scheme
+    engine = ModelHessianEngine(molecule)
+    lowest = geometric.normal_modes.calc_lowest_hessian(coords, molecule, engine, 'lowest.tmp', guess, nmodes=1)
+    np.testing.assert_allclose(lowest, hessian)
+    assert len(engine.stored_calcs) == 0
+    geometric.normal_modes.calc_lowest_hessian(coords, molecule, engine, 'lowest.tmp', guess, nmodes=2)
+    assert len(engine.stored_calcs) > 0
+    engine = ModelHessianEngine(molecule)
+    geometric.normal_modes.calc_lowest_hessian(coords+0.01, molecule, engine, 'lowest.tmp', guess, nmodes=2)
+    assert len(engine.stored_calcs) > 0
+    # The Hessian of the final structure is the full finite difference Hessian
+    params = geometric.params.OptParams(hessian_modes=1)
+    optimizer = geometric.optimize.Optimizer(coords, molecule, IC, ModelHessianEngine(molecule), 'final.tmp', params)
+    optimizer.calcEnergyForce()
+    np.testing.assert_allclose(optimizer.calcCartesianHessian(read_data=False, final=True), hessian_ref, atol=1e-8)
+    np.testing.assert_allclose(optimizer.calcCartesianHessian(read_data=False), hessian, atol=1e-8)
+
 @addons.using_psi4
 def test_hessian_conversion(localizer):
     shutil.copy2(os.path.join(datad, 'hcn_tsguess.psi4in'), os.getcwd())
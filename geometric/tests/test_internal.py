@@ -4,6 +4,7 @@ A set of tests for energy minimization
 
 import copy
 import numpy as np
+from numpy.linalg import multi_dot
 import json, os, shutil
 from . import addons
 import geometric
@@ -92,3 +93,452 @@ def test_update_internals():
     assert IC_1.update(IC_1) == False
     assert IC_1.update(IC_2) == True
     assert IC_1.join(IC_2) == False
+
+def test_packed_primitives():
+    """
+    Check that the packed (grouped by type) evaluation of primitive ICs
+    gives the same values, derivatives and differences as the per-object path.
+    """
+    for fnm in ['water6.pdb', 'hcn_minimized.xyz', 'propynimine-ts-optimized.xyz', 'ala.pdb']:
+        M = geometric.molecule.Molecule(os.path.join(datad, fnm))
+        coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+        coords2 = coords + 0.05 * np.random.RandomState(0).randn(len(coords))
+        for connect, addcart in [(False, False), (False, True), (True, False)]:
+            IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=connect, addcart=addcart)
+            packed = (IC.calculate(coords), IC.derivatives(coords), IC.calcDiff(coords2, coords))
+            IC.packed = False
+            unpacked = (IC.calculate(coords), IC.derivatives(coords), IC.calcDiff(coords2, coords))
+            for p, u in zip(packed, unpacked):
+                np.testing.assert_allclose(p, u, atol=1e-12)
+            IC.packed = True
+            # The packing must follow changes to the list of primitives.
+            IC.delete(IC.Internals[0])
+            assert IC.calculate(coords).shape[0] == len(IC.Internals)
+
+def test_sparse_wilsonB():
+    """
+    Check that the sparse B-matrix path gives the same G-matrix, internal gradient
+    and Cartesian back-transformation as the dense path.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    gradx = np.random.RandomState(0).randn(len(coords))
+    for IC in [geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False),
+               geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)]:
+        answers = []
+        for sparse in [False, True]:
+            IC.sparse = sparse
+            if hasattr(IC, 'Prims'): IC.Prims.sparse = sparse
+            IC.clearCache()
+            gradq = IC.calcGrad(coords, gradx)
+            dQ = 0.01 * np.random.RandomState(1).randn(len(gradq))
+            answers.append((IC.GMatrix(coords), gradq, IC.newCartesian(coords, dQ, verbose=0)))
+            # Force newCartesian to recompute for the next pass
+            del IC.stored_xyz
+        for dense, sparse in zip(*answers):
+            np.testing.assert_allclose(dense, sparse, atol=1e-10)
+    IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+    np.testing.assert_allclose(IC.wilsonB_sparse(coords).toarray(), IC.wilsonB(coords), atol=1e-12)
+
+def test_gsolver():
+    """
+    Check that solving with the factorized or iterative G-matrix methods gives the
+    same internal gradient and Cartesian back-transformation as the SVD pseudo-inverse.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    gradx = np.random.RandomState(0).randn(len(coords))
+    for IC in [geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False),
+               geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)]:
+        answers = []
+        for gsolver, greuse in [('svd', 0.0), ('eigh', 0.0), ('chol', 0.0), ('lsqr', 0.0), ('eigh', 0.1)]:
+            IC.gsolver = gsolver
+            IC.greuse = greuse
+            IC.clearCache()
+            gradq = IC.calcGrad(coords, gradx)
+            dQ = 0.01 * np.random.RandomState(1).randn(len(gradq))
+            answers.append((gradq, IC.newCartesian(coords, dQ, verbose=0)))
+            del IC.stored_xyz
+        for gradq, xyz in answers[1:]:
+            np.testing.assert_allclose(gradq, answers[0][0], atol=1e-8)
+            # newCartesian converges to ~1e-6 so different solvers may stop at slightly different points
+            np.testing.assert_allclose(xyz, answers[0][1], atol=1e-6)
+    with pytest.raises(RuntimeError):
+        IC.gsolver = 'inv'
+
+def test_dlcsolver():
+    """
+    Check that building the DLCs from B^T.B gives the same coordinates as
+    diagonalizing the G-matrix, with and without constraints.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'ala.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    Cons, CVals = geometric.prepare.parse_constraints(M, open(os.path.join(datad, 'ala_constraints.txt')).read())
+    kwargs_con = {'constraints':Cons, 'cvals':CVals[0]}
+    for conmethod, kwargs in [(0, {}), (0, kwargs_con), (1, kwargs_con)]:
+        Vecs = []
+        for dlcsolver in ['eigh', 'btb']:
+            IC = geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False,
+                                                                   conmethod=conmethod, dlcsolver=dlcsolver, **kwargs)
+            Vecs.append(IC.Vecs)
+        assert Vecs[0].shape == Vecs[1].shape
+        # Columns may differ by sign
+        np.testing.assert_allclose(np.abs(Vecs[0]), np.abs(Vecs[1]), atol=1e-8)
+    with pytest.raises(RuntimeError):
+        IC.dlcsolver = 'lanczos'
+
+def test_block_dlc():
+    """
+    Check that DLCs built separately for each fragment span the same space as the
+    usual ones, and that the block products agree with the dense vectors.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    coords2 = coords + 0.02 * np.random.RandomState(0).randn(len(coords))
+    dense = geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+    IC = geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False,
+                                                         blockdlc=True, blockthreads=2)
+    assert IC.VecBlocks.nblocks == 6
+    Vecs = IC.Vecs
+    np.testing.assert_allclose(Vecs.dot(Vecs.T), dense.Vecs.dot(dense.Vecs.T), atol=1e-10)
+    Prims = IC.Prims
+    np.testing.assert_allclose(IC.calculate(coords), Prims.calculate(coords).dot(Vecs))
+    np.testing.assert_allclose(IC.calcDiff(coords2, coords), Prims.calcDiff(coords2, coords).dot(Vecs), atol=1e-12)
+    np.testing.assert_allclose(IC.derivatives(coords), np.tensordot(Vecs, Prims.derivatives(coords), axes=(0, 0)),
+                               atol=1e-12)
+    np.testing.assert_allclose(IC.guess_hessian(coords), multi_dot([Vecs.T, Prims.guess_hessian(coords), Vecs]),
+                               atol=1e-12)
+    frames = np.array([coords, coords2])
+    np.testing.assert_allclose(IC.derivatives_batch(frames),
+                               np.einsum('pi,fpaj->fiaj', Vecs, Prims.derivatives_batch(frames)), atol=1e-12)
+    np.testing.assert_allclose(IC.second_derivatives(coords),
+                               np.tensordot(Vecs, Prims.second_derivatives(coords), axes=(0, 0)), atol=1e-12)
+    # The dense copy of the blocks is cached, and writing to it fails instead of changing a temporary copy
+    assert IC.Vecs is Vecs
+    with pytest.raises(ValueError):
+        IC.Vecs[0, 0] = 1.0
+    # Setting dense vectors replaces the blocks
+    IC.Vecs = dense.Vecs
+    assert IC.VecBlocks is None
+    np.testing.assert_allclose(IC.calculate(coords), dense.calculate(coords))
+
+def test_orthogonalize_dlc():
+    """
+    Check that a redundant constraint is dropped when building constrained DLCs and
+    that the constrained DLCs are orthonormal and complete.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    Cons, CVals = geometric.prepare.parse_constraints(M, "$freeze\ndistance 1 2\ndistance 1 3\n"
+                                                         "angle 2 1 3\ndistance 2 3\n")
+    IC = geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False,
+                                                         constraints=Cons, cvals=CVals[0])
+    assert [str(c) for c in IC.droppedConstraints] == ['Distance 2-3']
+    assert len(IC.Prims.cPrims) == 3 and IC.cDLC == [0, 1, 2]
+    assert IC.Vecs.shape == (55, 54)
+    np.testing.assert_allclose(IC.Vecs.T.dot(IC.Vecs), np.eye(54), atol=1e-12)
+    # The constrained DLCs are Gram-Schmidt orthogonalized in order
+    C = np.random.RandomState(0).randn(10, 3)
+    C = np.hstack((C, C[:, :1]+C[:, 1:2]))
+    C /= np.linalg.norm(C, axis=0)
+    V = np.linalg.qr(np.hstack((C[:, :3], np.random.RandomState(1).randn(10, 3))))[0]
+    U, dropped = geometric.internal.orthogonalize_dlc(C, V)
+    assert dropped == [3] and U.shape == (10, 6)
+    np.testing.assert_allclose(U.dot(U.T), V.dot(V.T), atol=1e-12)
+    assert np.dot(U[:, 0], C[:, 0]) > 0 and abs(np.dot(U[:, 1], C[:, 0])) < 1e-12
+    # Several redundant columns, including ones in the middle, are dropped together
+    C2 = np.hstack((C[:, :2], C[:, 3:], C[:, 2:3], C[:, :1]-C[:, 2:3]))
+    C2 /= np.linalg.norm(C2, axis=0)
+    U2, dropped = geometric.internal.orthogonalize_dlc(C2, V)
+    assert dropped == [2, 4] and U2.shape == (10, 6)
+    np.testing.assert_allclose(U2[:, :3], U[:, :3], atol=1e-12)
+
+def test_update_primitives(localizer):
+    """
+    Check that the coordinate system check does not rebuild anything when the bonds are
+    unchanged, and updates the primitives in place when a single bond is broken or formed.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'ala.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    IC = geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+    params = geometric.optimize.OptParams()
+    engine = geometric.engine.Engine(M)
+    optimizer = geometric.optimize.Optimizer(coords, M, IC, engine, 'update_primitives.tmp', params)
+    optimizer.gradx = np.zeros_like(coords)
+    optimizer.X_hist = [coords]
+    optimizer.Gx_hist = [optimizer.gradx]
+    builds = []
+    build_dlc = IC.build_dlc
+    def counting_build_dlc(xyz):
+        builds.append(xyz)
+        build_dlc(xyz)
+    IC.build_dlc = counting_build_dlc
+    # A small displacement does not change the bonds
+    optimizer.X = coords + 0.01
+    Internals = list(IC.Prims.Internals)
+    assert optimizer.checkCoordinateSystem() is False
+    assert optimizer.IC is IC and len(builds) == 0
+    assert all(p is q for p, q in zip(IC.Prims.Internals, Internals))
+    # Moving the last (hydrogen) atom away breaks its bond, which is handled in place
+    for dx in [3.0, 0.0]:
+        optimizer.X = coords.copy()
+        optimizer.X[-3:] += dx * geometric.nifty.ang2bohr
+        assert optimizer.checkCoordinateSystem() is True
+        assert optimizer.IC is IC
+        newmol = copy.deepcopy(M)
+        newmol.xyzs[0] = optimizer.X.reshape(-1, 3) * geometric.nifty.bohr2ang
+        ref = geometric.internal.PrimitiveInternalCoordinates(newmol, connect=False, addcart=False)
+        assert ref == IC.Prims and len(ref.Internals) == len(IC.Prims.Internals)
+        assert sorted(map(sorted, ref.frags)) == sorted(map(sorted, IC.frags))
+    assert len(builds) == 2
+    # The primitives that are not near the broken bond are the same objects as before
+    assert sum(any(p is q for q in Internals) for p in IC.Prims.Internals) > 0.8 * len(Internals)
+
+def test_primitive_choices():
+    """
+    Check that the almost-linear angles and out-of-plane coordinates computed with
+    array operations agree with the primitives chosen by makePrimitives().
+    """
+    for fnm in ['ala.pdb', 'hcn_minimized.xyz', 'water6.pdb', 'porphin.xyz']:
+        M = geometric.molecule.Molecule(os.path.join(datad, fnm))
+        IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+        edges = set((min(p.a, p.b), max(p.a, p.b)) for p in IC.Internals if type(p) is geometric.internal.Distance)
+        linear, oop = geometric.internal.primitive_choices(M.xyzs[0], edges)
+        assert oop == set((p.a, p.b, p.c, p.d) for p in IC.Internals if type(p) is geometric.internal.OutOfPlane)
+        assert linear == set((p.a, p.b, p.c) for p in IC.Internals if type(p) is geometric.internal.LinearAngle)
+
+def test_wilsonB_operator():
+    """
+    Check that products with the Wilson B-matrix linear operator match the dense
+    B-matrix for primitive, delocalized and block-delocalized coordinates.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    np.random.seed(0)
+    for ictype, blockdlc in [('prim', False), ('dlc', False), ('dlc', True)]:
+        if ictype == 'prim':
+            IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+        else:
+            IC = geometric.internal.DelocalizedInternalCoordinates(M, build=False, connect=False, addcart=False)
+            IC.blockdlc = blockdlc
+            IC.build_dlc(coords)
+        for MW in [False, True]:
+            Bmat = IC.wilsonB(coords)
+            if MW:
+                Bmat = Bmat / np.sqrt(IC.mass)[np.newaxis, :]
+            Bop = IC.wilsonB_operator(coords, MW=MW)
+            assert Bop.shape == Bmat.shape
+            x = np.random.randn(Bmat.shape[1])
+            y = np.random.randn(Bmat.shape[0], 2)
+            np.testing.assert_allclose(Bop.dot(x), Bmat.dot(x), atol=1e-12)
+            np.testing.assert_allclose(Bop.T.dot(y), Bmat.T.dot(y), atol=1e-12)
+            np.testing.assert_allclose(Bop.toarray(), Bmat, atol=1e-12)
+            np.testing.assert_allclose(Bop.block([0, 2]), Bmat[[0, 2]], atol=1e-12)
+        if ictype == 'dlc':
+            G = IC.GMatrix(coords, MW=True)
+            IC.sparse = True
+            IC.clearCache()
+            np.testing.assert_allclose(IC.GMatrix(coords, MW=True), G, atol=1e-12)
+
+def test_rotator_local_derivatives():
+    """
+    Check that rotators store their derivatives for the fragment atoms only, and that the
+    B-matrix assembled from the fragment-local blocks matches the per-object derivatives.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+    IC.packed = False
+    Bdense = IC.derivatives(coords).reshape(len(IC.Internals), -1)
+    np.testing.assert_allclose(IC.sparse_derivatives(coords).toarray(), Bdense, atol=1e-12)
+    IC.packed = True
+    np.testing.assert_allclose(IC.sparse_derivatives(coords).toarray(), Bdense, atol=1e-12)
+    for rot in IC.Rotators.values():
+        assert rot.stored_deriv.shape == (len(rot.a), 3, 3)
+        np.testing.assert_array_equal(rot.derivative(coords)[rot.a], rot.stored_deriv)
+        np.testing.assert_array_equal(rot.second_derivative(coords)[np.ix_(rot.a, range(3), rot.a)],
+                                      rot.second_derivative_local(coords))
+
+def test_geometry_token():
+    """
+    Check that Geometry tokens identify coordinates by content, survive reshaping,
+    and are used by the rotator caches.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    geom = geometric.internal.Geometry(coords)
+    assert geom.token == geometric.internal.geometry_token(coords.reshape(-1, 3).copy())
+    assert geom.reshape(-1, 3).token == geom.token
+    assert geometric.internal.as_geometry(geom) is geom
+    assert geom[3:].token is None and type(geom + 1.0) is np.ndarray
+    with pytest.raises(ValueError):
+        geom[0] = 0.0
+    coords1 = coords.copy()
+    coords1[0] = np.nextafter(coords1[0], 1.0)
+    assert geometric.internal.geometry_token(coords1) != geom.token
+    IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+    IC.calculate(geom)
+    rot = list(IC.Rotators.values())[0]
+    assert rot.stored_valtoken == geom.token
+    # Stored values are returned for equal coordinates and recomputed for different ones
+    assert rot.value(coords) is rot.stored_value
+    assert rot.value(coords1, store=False) is not rot.stored_value
+
+def test_ic_cache():
+    """
+    Check the memory budget, LRU eviction and counters of the cache used for
+    B-matrices and G-inverses.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water6.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    IC = geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)
+    IC.clearCache()
+    IC.wilsonB(coords)
+    B0 = IC.wilsonB(coords)
+    assert IC.wilsonB(coords) is B0
+    # Coordinates that differ in the last bit are stored separately
+    coords1 = coords.copy()
+    coords1[0] = np.nextafter(coords1[0], 1.0)
+    IC.wilsonB(coords1)
+    B1 = IC.wilsonB(coords1)
+    assert B1 is not B0 and IC.cache.stats()['entries'] == 2
+    # Uses the B-matrix at coords, so the one at coords1 is now the least recently used
+    Ginv = IC.GInverse(coords)
+    assert IC.cache.nbytes >= B0.nbytes + B1.nbytes + Ginv.nbytes
+    IC.setCacheBudget(IC.cache.nbytes - 1)
+    stats = IC.cache.stats()
+    assert stats['evictions'] == 1 and stats['entries'] == 2 and stats['hits'] == 4 and stats['misses'] == 3
+    assert IC.cache.get('wilsonB', coords1) is None
+    assert IC.cache.get('wilsonB', coords) is B0
+    total = IC.cacheStats()
+    assert total['misses'] > stats['misses']
+
+def test_batch_evaluation():
+    """
+    Check that evaluating several geometries at once agrees with evaluating them one by one.
+    """
+    for fnm in ['water6.pdb', 'hcn_minimized.xyz']:
+        M = geometric.molecule.Molecule(os.path.join(datad, fnm))
+        coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+        frames = coords + 0.05 * np.random.RandomState(0).randn(4, len(coords))
+        for IC in [geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False),
+                   geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)]:
+            np.testing.assert_allclose(IC.calculate_batch(frames), [IC.calculate(x) for x in frames], atol=1e-12)
+            np.testing.assert_allclose(IC.derivatives_batch(frames), [IC.derivatives(x) for x in frames], atol=1e-12)
+            np.testing.assert_allclose(IC.calcDiff_batch(frames, coords), [IC.calcDiff(x, coords) for x in frames],
+                                       atol=1e-12)
+            np.testing.assert_allclose(IC.calcDiff_batch(frames, frames[::-1]),
+                                       [IC.calcDiff(x, y) for x, y in zip(frames, frames[::-1])], atol=1e-12)
+
+def test_primitive_list():
+    """
+    Check that the hashed primitive list agrees with the __eq__ methods of the primitives.
+    """
+    from geometric.internal import PrimitiveList, Distance, Angle, LinearAngle, Dihedral, OutOfPlane, TranslationX
+    prims = PrimitiveList([Distance(0, 1), Angle(0, 1, 2), LinearAngle(0, 1, 2, 0), Dihedral(0, 1, 2, 3),
+                           OutOfPlane(0, 1, 2, 3),
+                           TranslationX([0, 1, 2], w=np.ones(3)/3)])
+    assert Distance(1, 0) in prims
+    assert Angle(2, 1, 0) in prims
+    assert LinearAngle(2, 1, 0, 0) in prims and LinearAngle(0, 1, 2, 1) not in prims
+    assert Dihedral(3, 2, 1, 0) in prims and Dihedral(0, 2, 1, 3) not in prims
+    assert OutOfPlane(0, 3, 2, 1) in prims
+    assert TranslationX([2, 1, 0], w=np.ones(3)/3) in prims and TranslationX([0, 1, 2], w=np.ones(3)) not in prims
+    assert prims.index(Dihedral(3, 2, 1, 0)) == 3
+    prims.remove(Angle(2, 1, 0))
+    assert Angle(0, 1, 2) not in prims and prims.index(Dihedral(0, 1, 2, 3)) == 2
+    prims.append(Angle(0, 1, 2))
+    assert prims.index(Angle(2, 1, 0)) == 5
+    # Building the primitives of a molecule gives the same list as before, with a working index
+    M = geometric.molecule.Molecule(os.path.join(datad, 'ala.pdb'))
+    IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+    assert isinstance(IC.Internals, PrimitiveList)
+    assert all(IC.Internals.index(p) == i for i, p in enumerate(IC.Internals))
+    IC2 = copy.deepcopy(IC)
+    assert IC2 == IC and len(IC2.Internals._members) == len(IC.Internals._members)
+
+def test_primitive_list_delete():
+    """
+    Check that positions stay correct through mixed removals and appends, and that deleting
+    primitives one at a time updates the index in place instead of rebuilding it.
+    """
+    from geometric.internal import PrimitiveList, Distance
+    np.random.seed(0)
+    prims = PrimitiveList([Distance(i, i+1) for i in range(200)])
+    ref = list(prims)
+    for it in range(300):
+        if np.random.rand() < 0.3:
+            prims.append(Distance(1000+it, 1001+it))
+            ref.append(Distance(1000+it, 1001+it))
+        else:
+            p = ref[np.random.randint(len(ref))]
+            prims.remove(p)
+            ref.remove(p)
+        i = np.random.randint(len(ref))
+        assert prims.index(ref[i]) == ref.index(ref[i])
+    assert list(prims) == ref
+    # Delete half of the primitives one at a time (see tools/benchmark-internal.py for timings)
+    M = geometric.molecule.Molecule()
+    M.elem = ['H', 'H']
+    M.xyzs = [np.array([[0.0, 0.0, 0.0], [0.7, 0.0, 0.0]])]
+    IC = geometric.internal.PrimitiveInternalCoordinates(M)
+    n = 200
+    IC.Internals = [Distance(i, i+1) for i in range(n)]
+    reindex = []
+    IC.Internals._reindex = lambda: reindex.append(1)
+    for i in range(0, n, 2):
+        IC.delete(Distance(i+1, i))
+        # The stored position of every remaining primitive still gives its place in the list
+        assert len(IC.Internals._pos) == len(IC.Internals)
+        assert len(IC.Internals._removed) == i//2+1
+        assert all(IC.Internals._position(p) == k for k, p in enumerate(IC.Internals))
+    assert len(reindex) == 0
+    assert len(IC.Internals) == n//2
+    assert IC.Internals.index(Distance(n-1, n)) == n//2-1
+
+def test_euclidean_mst():
+    """
+    Check that the neighbor-list minimum spanning tree is the same as the one from
+    networkx on the complete distance graph, including when the cutoff is too short
+    to connect all the fragments.
+    """
+    import networkx as nx
+    for fnm in ['water6.pdb', 'ala.pdb', 'hcn_minimized.xyz']:
+        M = geometric.molecule.Molecule(os.path.join(datad, fnm))[0]
+        AtomIterator, dxij = M.distance_matrix(pbc=False)
+        dgraph = nx.Graph()
+        dgraph.add_nodes_from(range(M.na))
+        for (i, j), d in zip(AtomIterator, dxij[0]):
+            dgraph.add_edge(i, j, weight=d)
+        ref = sorted([(int(i), int(j)) for i, j in nx.minimum_spanning_edges(dgraph, data=False)])
+        for cutoff in [4.0, 1.0]:
+            assert geometric.internal.euclidean_mst_edges(M.xyzs[0], cutoff=cutoff) == ref
+
+def test_guess_hessian_batch():
+    """
+    Check that the guess Hessian diagonals of several geometries computed together
+    agree with computing them one at a time.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'ala.pdb'))
+    coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+    frames = coords + 0.05 * np.random.RandomState(0).randn(3, len(coords))
+    IC = geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+    Hdiag = IC.guess_hessian_diagonal(frames)
+    for x, h in zip(frames, Hdiag):
+        np.testing.assert_allclose(np.diag(IC.guess_hessian(x)), h)
+    # Distances between bonded heavy atoms get the Schlegel force constants
+    assert np.min(Hdiag) > 0.0 and np.max(Hdiag) > 0.3
+
+def test_contract_second_derivatives():
+    """
+    Check that accumulating the atom-local second derivatives of each primitive
+    agrees with contracting the full second derivative array.
+    """
+    for fnm in ['water6.pdb', 'propynimine-ts-optimized.xyz']:
+        M = geometric.molecule.Molecule(os.path.join(datad, fnm))
+        coords = M.xyzs[0].flatten() * geometric.nifty.ang2bohr
+        for IC in [geometric.internal.PrimitiveInternalCoordinates(M, connect=False, addcart=False),
+                   geometric.internal.DelocalizedInternalCoordinates(M, build=True, connect=False, addcart=False)]:
+            coeffs = np.random.RandomState(0).randn(len(IC.Internals))
+            stream = IC.contractSecondDerivatives(coords, coeffs)
+            full = geometric.internal.InternalCoordinates.contractSecondDerivatives(IC, coords, coeffs)
+            np.testing.assert_allclose(stream, full, atol=1e-10)
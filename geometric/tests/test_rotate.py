@@ -52,6 +52,19 @@ def test_rot_der():
     assert np.allclose(a1, n1, atol=1.e-7)
     assert np.allclose(a2, n2, atol=1.e-7)
     
+def test_first_der_loops():
+    """
+    Check the vectorized first derivatives against the reference implementations that use for loops.
+    """
+    M = geometric.molecule.Molecule(os.path.join(datad, 'water5.xyz'))
+    x = M.xyzs[0]
+    y = M.xyzs[-1]
+    for func in [geometric.rotate.get_q_der, geometric.rotate.get_rot_der, geometric.rotate.get_expmap_der]:
+        a1 = func(x, y)
+        l1 = func(x, y, use_loops=True)
+        assert a1.shape == l1.shape
+        assert np.allclose(a1, l1, atol=1.e-14)
+
 def test_F_R_der():
     M = geometric.molecule.Molecule(os.path.join(datad, 'water5.xyz'))
     x = M.xyzs[0]
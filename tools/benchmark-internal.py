@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the evaluation of primitive internal coordinates (values,
+Wilson B-matrix rows and differences) using the packed (grouped by type)
+path and the original per-object path, the time to build delocalized
+internal coordinates for each method of finding the nonredundant space
+(--dlcsolver) and per fragment (--blockdlc), and the time per Cartesian back-transformation (newCartesian)
+for each method of applying the inverse G-matrix (--gsolver).
+The time to delete half of a list of primitives one at a time is also printed,
+which should scale linearly with the number of primitives.
+
+Usage: ./benchmark-internal.py [structure files]
+
+If no files are given, the trp-cage and heme performance test examples are used.
+"""
+
+import os, sys, time
+import numpy as np
+from geometric.molecule import Molecule
+from geometric.internal import PrimitiveInternalCoordinates, DelocalizedInternalCoordinates, Distance
+from geometric.nifty import ang2bohr
+
+here = os.path.dirname(os.path.abspath(__file__))
+perfd = os.path.join(here, '..', 'examples', '0-performance-tests')
+fnms = sys.argv[1:]
+if len(fnms) == 0:
+    fnms = [os.path.join(perfd, 'trp-cage_openmm', 'trpcage.pdb'),
+            os.path.join(perfd, 'heme', 'start.xyz')]
+
+def timeit(func, *args):
+    """ Return the best of three timings of func(*args) in seconds. """
+    best = None
+    for i in range(3):
+        t0 = time.time()
+        func(*args)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+for fnm in fnms:
+    M = Molecule(fnm)[0]
+    coords = M.xyzs[0].flatten() * ang2bohr
+    coords2 = coords + 0.01 * np.random.RandomState(0).randn(len(coords))
+    IC = PrimitiveInternalCoordinates(M, connect=False, addcart=False)
+    print("%s : %i atoms, %i primitives" % (os.path.basename(fnm), M.na, len(IC.Internals)))
+    print("%15s %12s %12s %10s" % ("Function", "Packed (s)", "Loop (s)", "Speedup"))
+    for name in ['calculate', 'derivatives', 'calcDiff']:
+        args = (coords, coords2) if name == 'calcDiff' else (coords,)
+        IC.packed = True
+        packed = timeit(getattr(IC, name), *args)
+        IC.packed = False
+        loop = timeit(getattr(IC, name), *args)
+        print("%15s %12.4f %12.4f %10.1f" % (name, packed, loop, loop/packed))
+    IC.packed = True
+    DLC = DelocalizedInternalCoordinates(M, build=False, connect=False, addcart=False)
+    print("%15s %12s" % ("dlcsolver", "Time (s)"))
+    for dlcsolver in ['eigh', 'btb']:
+        DLC.dlcsolver = dlcsolver
+        print("%15s %12.4f" % (dlcsolver, timeit(DLC.build_dlc, coords)))
+    DLC.blockdlc = True
+    print("%15s %12.4f" % ("btb blocked", timeit(DLC.build_dlc, coords)))
+    DLC.blockdlc = False
+    DLC.build_dlc(coords)
+    dQ = DLC.calcDiff(coords2, coords)
+    print("%15s %12s %12s" % ("gsolver", "Time (s)", "Max dx"))
+    reference = None
+    for gsolver, greuse in [('svd', 0.0), ('eigh', 0.0), ('chol', 0.0), ('chol', 0.01), ('lsqr', 0.0)]:
+        DLC.gsolver = gsolver
+        DLC.greuse = greuse
+        def backtransform():
+            DLC.clearCache()
+            if hasattr(DLC, 'stored_xyz'): del DLC.stored_xyz
+            return DLC.newCartesian(coords, dQ, verbose=0)
+        elapsed = timeit(backtransform)
+        xyz = backtransform()
+        if reference is None: reference = xyz
+        label = gsolver + (" reuse=%g" % greuse if greuse else "")
+        print("%15s %12.4f %12.2e" % (label, elapsed, np.max(np.abs(xyz-reference))))
+    print()
+
+def delete_half(IC, n):
+    IC.Internals = [Distance(i, i+1) for i in range(n)]
+    for i in range(0, n, 2):
+        IC.delete(Distance(i+1, i))
+
+M = Molecule()
+M.elem = ['H', 'H']
+M.xyzs = [np.array([[0.0, 0.0, 0.0], [0.7, 0.0, 0.0]])]
+IC = PrimitiveInternalCoordinates(M)
+print("%15s %12s" % ("Deleted", "Time (s)"))
+for n in [5000, 10000, 20000]:
+    print("%15i %12.4f" % (n//2, timeit(delete_half, IC, n)))
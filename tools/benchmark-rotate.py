@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the first derivatives of the superposition quaternion, rotation matrix
+and exponential map with respect to Cartesian coordinates (used by the TRIC
+rotation coordinates) for fragment sizes from 10 to 10,000 atoms, comparing the
+vectorized implementation to the reference implementation that uses for loops.
+
+Usage: ./benchmark-rotate.py [fragment sizes]
+"""
+
+import sys, time
+import numpy as np
+from geometric.rotate import get_q_der, get_rot_der, get_expmap_der
+
+sizes = [int(n) for n in sys.argv[1:]]
+if len(sizes) == 0:
+    sizes = [10, 100, 1000, 10000]
+
+def timeit(func, *args, **kwargs):
+    """ Return the best of three timings of func(*args, **kwargs) in seconds. """
+    best = None
+    for i in range(3):
+        t0 = time.time()
+        func(*args, **kwargs)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+print("%15s %8s %14s %12s %10s %12s" % ("Function", "Atoms", "Vectorized (s)", "Loop (s)", "Speedup", "Max diff"))
+for na in sizes:
+    # Random fragment and a rotated, slightly distorted copy as the reference
+    rng = np.random.RandomState(0)
+    x = rng.randn(na, 3) * na**(1.0/3)
+    theta = 0.3
+    rot = np.array([[np.cos(theta), -np.sin(theta), 0.0], [np.sin(theta), np.cos(theta), 0.0], [0.0, 0.0, 1.0]])
+    y = np.dot(x, rot.T) + 0.1 * rng.randn(na, 3)
+    for func in [get_q_der, get_rot_der, get_expmap_der]:
+        vec = timeit(func, x, y)
+        loop = timeit(func, x, y, use_loops=True)
+        maxdiff = np.max(np.abs(func(x, y) - func(x, y, use_loops=True)))
+        print("%15s %8i %14.5f %12.5f %10.1f %12.2e" % (func.__name__, na, vec, loop, loop/vec, maxdiff))